@@ -13,6 +13,9 @@ class FileLimitingLoader(BaseLoader):
     """Reduces the open file limit on celery child processes."""
     def on_worker_process_init(self):
         import settings
+        # Elastic connections of the parent cannot be used in the worker process
+        from amcat.tools import amcates_client
+        amcates_client.reset()
         try:
             sl, hl = resource.getrlimit(resource.RLIMIT_NOFILE)
             new_sl = settings.amcat_config.getint("celery", "worker_process_file_limit", fallback=16000)
@@ -0,0 +1,115 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Benchmark the LexisNexis parser: streaming the articles from the open file (read_articles) against
+parsing the decoded text of the whole file at once (split_header, split_body and parse_article). The
+latter can be taken from another version of the parser with --baseline, e.g. the last version of
+lexisnexis.py before read_articles was added, saved as /tmp/lexisnexis_old.py:
+
+    python manage.py benchmark_lexisnexis --baseline /tmp/lexisnexis_old.py
+
+Reports the time, articles per second and peak memory allocated by either method.
+"""
+import importlib.util
+import os
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management import BaseCommand
+
+from amcat.scripts.article_upload.plugins import lexisnexis
+
+TEST_FILES = os.path.join(os.path.dirname(lexisnexis.__file__), "..", "tests", "test_files", "lexisnexis")
+
+
+def load_module(filename):
+    """Load another version of the lexisnexis module from the given file"""
+    spec = importlib.util.spec_from_file_location("lexisnexis_baseline", filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_text(module, filename):
+    with open(filename, encoding="utf-8") as f:
+        text = f.read()
+    header, body = module.split_header(text)
+    # The query is parsed from the header by read_articles as well, so it is part of the timing
+    _query = module.get_query(module.parse_header(header))
+    return len([art for art in map(module.parse_article, module.split_body(body)) if art])
+
+
+def parse_stream(module, filename):
+    with open(filename, encoding="utf-8") as f:
+        query, articles = module.read_articles(f)
+        return sum(1 for _ in articles)
+
+
+def measure(func, module, filename):
+    """@return: a tuple (number of articles, seconds, peak memory in bytes)"""
+    tracemalloc.start()
+    t = time.perf_counter()
+    try:
+        n = func(module, filename)
+        elapsed = time.perf_counter() - t
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return n, elapsed, peak
+
+
+def repeat_file(filename, n, out):
+    """Write the header and n copies of the documents of the given file to out"""
+    with open(filename, encoding="utf-8") as f:
+        header, body = lexisnexis.split_header(f.read())
+    out.write(header + "\n\n")
+    for _ in range(n):
+        out.write(body + "\n\n")
+    out.flush()
+
+
+class Command(BaseCommand):
+    help = "Benchmark streaming LexisNexis files against parsing them as a whole"
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="*", help="LexisNexis files (default: the test fixtures)")
+        parser.add_argument("--repeat", type=int, default=1, help="Parse n copies of the documents of each file")
+        parser.add_argument("--baseline", help="lexisnexis.py of another version, used to parse the whole text")
+
+    def handle(self, *args, **options):
+        files = options["files"] or sorted(os.path.join(TEST_FILES, fn) for fn in os.listdir(TEST_FILES)
+                                           if fn.endswith(".txt"))
+        baseline = load_module(options["baseline"]) if options["baseline"] else lexisnexis
+        methods = [("text", parse_text, baseline), ("stream", parse_stream, lexisnexis)]
+        for filename in files:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt") as tmp:
+                if options["repeat"] > 1:
+                    repeat_file(filename, options["repeat"], tmp)
+                    path = tmp.name
+                else:
+                    path = filename
+                size = os.path.getsize(path) / 1024 / 1024
+                self.stdout.write("{} ({:.1f} MB)".format(os.path.basename(filename), size))
+                for name, func, module in methods:
+                    n, elapsed, peak = measure(func, module, path)
+                    self.stdout.write("  {name:6} {n:6} articles {elapsed:8.2f}s {rate:8.0f} articles/s "
+                                      "peak {peak:8.1f} MB".format(rate=n / elapsed if elapsed else 0,
+                                                                   peak=peak / 1024 / 1024, **locals()))
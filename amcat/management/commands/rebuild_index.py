@@ -0,0 +1,48 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Rebuild the elastic index in a new versioned index, and atomically swap the index alias to it
+"""
+import logging
+
+from django.core.management import BaseCommand
+
+from amcat.tools import amcates_rebuild
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the elastic index (e.g. after changing the mapping or number of shards) without downtime'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", type=int, default=5)
+        parser.add_argument("--replicas", type=int, default=1)
+        parser.add_argument("--source", choices=[amcates_rebuild.SOURCE_POSTGRES, amcates_rebuild.SOURCE_INDEX],
+                            default=amcates_rebuild.SOURCE_POSTGRES,
+                            help="Index articles from postgres, or copy the documents of the current index")
+        parser.add_argument("--slices", type=int, help="Number of parallel slices when copying from the index")
+        parser.add_argument("--keep-old", action='store_true', help="Do not delete the old index")
+
+    def handle(self, *args, **options):
+        index = amcates_rebuild.rebuild(shards=options['shards'], replicas=options['replicas'],
+                                        source=options['source'], slices=options['slices'],
+                                        keep_old=options['keep_old'])
+        logging.info(f"Index rebuilt in {index}")
@@ -17,24 +17,188 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 
+"""
+Reindex articlesets, in parallel worker processes. Progress is checkpointed to a state file
+(completed and failed sets and, for a full refresh, the last article id reindexed per set), so an
+interrupted run can be resumed by running the same command with the same state file.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy
+from django import db
 from django.core.management import BaseCommand
+
 from amcat.models import ArticleSet, ProjectArticleSet
-import logging
+from amcat.tools import amcates, amcates_client
+
+log = logging.getLogger(__name__)
+
+_messages = None
+
+
+class ReindexState(object):
+    """Resumable state of a reindex run, stored as json"""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.completed = set()
+        self.checkpoints = {}
+        self.failed = {}
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                state = json.load(f)
+            self.completed = set(state["completed"])
+            self.checkpoints = {int(setid): aid for setid, aid in state.get("checkpoints", {}).items()}
+            self.failed = {int(setid): error for setid, error in state.get("failed", {}).items()}
+            log.info("Resuming from {filename}: {n} sets completed".format(n=len(self.completed), **locals()))
+
+    def save(self):
+        if not self.filename:
+            return
+        state = {"completed": sorted(self.completed), "checkpoints": self.checkpoints, "failed": self.failed}
+        # Write to a temporary file first, so a crash never leaves a corrupt state file
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.filename)
+
+
+def reindex_set(setid, full_refresh=False, verify=False, after=None, batch_size=1000, rate=None, report=None):
+    """
+    Reindex a single set. For a full refresh, the documents are reindexed in batches of batch_size,
+    in order of article id.
+
+    @param after: resume a full refresh after this article id (the last one reindexed). The set can
+                  change in between, so this is an id rather than a position in the set.
+    @param rate: maximum number of documents per second
+    @param report: function called with (setid, last_id, ndocs) after every batch
+    """
+    aset = ArticleSet.objects.get(pk=setid)
+    if not full_refresh:
+        aset.refresh_index(verify=verify)
+        if report:
+            report(setid, None, 0)
+        return
+
+    es = amcates.ES()
+    if after is None:
+        # Apply changes to set membership, which also removes articles no longer in the set
+        es.synchronize_articleset(aset, verify=verify)
+
+    ids = aset.get_article_ids().ids
+    if after is not None:
+        ids = ids[numpy.searchsorted(ids, after, side="right"):]
+    for start in range(0, len(ids), batch_size):
+        t = time.time()
+        batch = ids[start:start + batch_size].tolist()
+        es.add_articles(batch, batch_size=batch_size)
+        if rate:
+            time.sleep(max(0, len(batch) / rate - (time.time() - t)))
+        if report:
+            report(setid, batch[-1], len(batch))
+
+    es.refresh_sets(setid)
+    aset._refresh_property_cache()
+
+
+def _init_worker(messages):
+    global _messages
+    _messages = messages
+    amcates_client.reset()
+
+
+def _reindex_worker(setid, options):
+    try:
+        reindex_set(setid, report=lambda *args: _messages.put(("batch",) + args), **options)
+    except Exception as e:
+        log.exception("Reindexing set {setid} failed".format(**locals()))
+        _messages.put(("failed", setid, str(e), 0))
+    else:
+        _messages.put(("done", setid, None, 0))
+
+
+def reindex_sets(sets, full_refresh=True, verify=False, workers=1, state=None, batch_size=1000, rate=None):
+    """
+    Reindex the given sets in parallel, checkpointing progress to the given state
+
+    @param workers: number of worker processes
+    @param state: a ReindexState, its completed sets are skipped
+    @param rate: maximum number of documents per second (over all workers)
+    """
+    state = state or ReindexState()
+    todo = [setid for setid in sets if setid not in state.completed]
+    logging.info(f"Reindexing {len(todo)} articlesets ({len(sets) - len(todo)} already completed)")
+
+    start, ndocs, ndone = time.time(), 0, 0
+
+    def handle(kind, setid, value, n):
+        """Handle a message (batch, done or failed) from a worker, value is the last article id or error"""
+        nonlocal ndocs, ndone
+        if kind == "batch":
+            ndocs += n
+            if value is not None:
+                state.checkpoints[setid] = value
+        else:
+            ndone += 1
+            if kind == "done":
+                state.completed.add(setid)
+                state.checkpoints.pop(setid, None)
+                state.failed.pop(setid, None)
+            else:
+                state.failed[setid] = value
+        state.save()
+        elapsed = time.time() - start
+        logging.info(f"[{ndone:4}/{len(todo):4} sets] {ndocs} documents in {elapsed:.0f}s "
+                     f"({ndocs / max(elapsed, 1e-6):.0f} docs/s)")
+
+    options = dict(full_refresh=full_refresh, verify=verify, batch_size=batch_size,
+                   rate=rate / workers if rate else None)
+
+    if workers <= 1:
+        for setid in todo:
+            try:
+                reindex_set(setid, after=state.checkpoints.get(setid),
+                            report=lambda *args: handle("batch", *args), **options)
+            except Exception as e:
+                log.exception("Reindexing set {setid} failed".format(**locals()))
+                handle("failed", setid, str(e), 0)
+            else:
+                handle("done", setid, None, 0)
+        return state
+
+    # Connections cannot be shared with the worker processes
+    db.connections.close_all()
+    messages = multiprocessing.Queue()
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(messages,)) as pool:
+        results = [pool.apply_async(_reindex_worker, (setid, dict(options, after=state.checkpoints.get(setid))))
+                   for setid in todo]
+        while ndone < len(todo):
+            try:
+                handle(*messages.get(timeout=10))
+            except queue.Empty:
+                if all(r.ready() for r in results) and messages.empty():
+                    raise Exception("Worker processes exited without reporting all sets")
+    return state
 
-def reindex_sets(sets, full_refresh=True):
-    logging.info(f"Reindexing {len(sets)} articlesets: {sets}")
-    for i, setid in enumerate(sets):
-        logging.info(f"[{i:4}/{len(sets):4}] Reindexing set {setid}")
-        ArticleSet.objects.get(pk=setid).refresh_index(full_refresh=full_refresh)
 
-    
 class Command(BaseCommand):
     help = 'Reindex one or more projects or sets'
-    
+
     def add_arguments(self, parser):
         parser.add_argument("projectid", nargs="+", help="Project ID(s) or 'all'")
         parser.add_argument("--full", action='store_true', help="Full refresh (article content as well as set membership)")
-        
+        parser.add_argument("--verify", action='store_true', help="Compare all set membership instead of replaying "
+                                                                  "the change journal")
+        parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+        parser.add_argument("--state", help="State file to checkpoint progress to, and resume from if it exists")
+        parser.add_argument("--rate", type=float, help="Maximum number of documents per second (full refresh only)")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Documents per bulk request (full refresh only)")
+
     def handle(self, *args, **options):
         p = options['projectid']
         if p == ['all']:
@@ -42,8 +206,11 @@ class Command(BaseCommand):
             sets = sorted(ArticleSet.objects.all().values_list('pk', flat=True))
         else:
             projectids = [int(x) for x in p]
-            logging.info("Reindexing projects {projectids} (full_refresh={options['full']}), retrieving set list")
+            logging.info(f"Reindexing projects {projectids} (full_refresh={options['full']}), retrieving set list")
             sets = sorted(ProjectArticleSet.objects.filter(project_id__in=projectids).values_list('articleset_id', flat=True))
-        reindex_sets(sets, full_refresh=options['full'])
-    
-        
+
+        state = ReindexState(options['state'])
+        state = reindex_sets(sets, full_refresh=options['full'], verify=options['verify'], workers=options['workers'],
+                             state=state, batch_size=options['batch_size'], rate=options['rate'])
+        if state.failed:
+            logging.error(f"Reindexing failed for sets {sorted(state.failed)}, run again to retry")
@@ -0,0 +1,60 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import json
+import os
+import tempfile
+
+from django.conf import settings
+
+from amcat.management.commands.reindex import reindex_sets, ReindexState
+from amcat.tools import amcattest
+from amcat.tools.amcates import ES
+
+
+class TestReindex(amcattest.AmCATTestCase):
+    @amcattest.use_elastic
+    def test_resume(self):
+        s = amcattest.create_test_set(4)
+        ids = sorted(s.get_article_ids())
+        for aid in ids:
+            ES().es.delete(index=ES().index, doc_type=settings.ES_ARTICLE_DOCTYPE, id=aid)
+        ES().refresh()
+
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "state.json")
+
+            # Resume a full refresh of which the first two documents were done, after the first was removed
+            state = ReindexState(filename)
+            state.checkpoints[s.id] = ids[1]
+            state.failed[s.id] = "error"
+            state.save()
+            s.remove_articles([ids[0]], remove_from_index=False)
+            state = ReindexState(filename)
+            self.assertEqual((state.checkpoints, state.failed), ({s.id: ids[1]}, {s.id: "error"}))
+            reindex_sets([s.id], full_refresh=True, state=state, batch_size=1)
+            ES().refresh()
+            self.assertEqual(set(ES().query_ids(filters={"sets": s.id})), {ids[2], ids[3]})
+
+            with open(filename) as f:
+                self.assertEqual(json.load(f), {"completed": [s.id], "checkpoints": {}, "failed": {}})
+
+            # Completed sets are skipped
+            reindex_sets([s.id], full_refresh=True, state=ReindexState(filename))
+            ES().refresh()
+            self.assertEqual(set(ES().query_ids(filters={"sets": s.id})), {ids[2], ids[3]})
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('amcat', '0014_auto_20190315_1427'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleSetChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('article_id', models.IntegerField()),
+                ('action', models.SmallIntegerField(choices=[(1, 'add'), (2, 'remove')])),
+                ('articleset', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='amcat.ArticleSet')),
+            ],
+            options={
+                'db_table': 'articleset_changes',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='articlesetchange',
+            index_together=set([('articleset', 'id')]),
+        ),
+        # Existing sets were never synchronized with the journal, so their watermark is NULL.
+        # New sets start with an empty journal (default 0).
+        migrations.AddField(
+            model_name='articleset',
+            name='index_watermark',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='articleset',
+            name='index_watermark',
+            field=models.BigIntegerField(default=0, null=True),
+        ),
+    ]
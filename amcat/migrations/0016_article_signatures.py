@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import amcat.tools.hashing
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('amcat', '0015_articleset_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleSignature',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('key', models.CharField(max_length=56)),
+                ('article_hash', amcat.tools.hashing.HashField(db_index=False, max_length=28)),
+                ('signature', models.BinaryField()),
+                ('article', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='amcat.Article')),
+            ],
+            options={
+                'db_table': 'article_signatures',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='articlesignature',
+            unique_together=set([('article', 'key')]),
+        ),
+    ]
@@ -23,6 +23,7 @@ articles database table.
 """
 import collections
 import functools
+import hashlib
 import html
 
 import iso8601
@@ -30,14 +31,15 @@ import json
 import re
 import logging
 
-from typing import Dict, Any, Union
+from typing import Dict, Any, Union, Tuple
 from typing import List, Sequence, Set
 
 
 import datetime
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import PermissionDenied, ValidationError
-from django.db import models, connection
+from django.conf import settings
+from django.db import models, connection, transaction, IntegrityError
 from django.template.defaultfilters import escape as escape_filter
 from psycopg2._json import Json
 
@@ -46,7 +48,7 @@ from amcat.models.authorisation import Role
 from amcat.tools import amcates
 from amcat.tools.djangotoolkit import bulk_insert_returning_ids
 from amcat.tools.model import AmcatModel
-from amcat.tools.hashing import HashField
+from amcat.tools.hashing import HashField, ModelHashFilter
 from amcat.tools.progress import NullMonitor
 from amcat.tools.toolkit import splitlist
 
@@ -414,6 +416,39 @@ class Article(AmcatModel):
             for aid in Article.objects.filter(pk__in=batch).values_list("pk", flat=True):
                 yield aid
 
+    @classmethod
+    def get_ids_by_hash(cls, hashes, batch_size=1000):
+        """
+        Look up the ids of articles with the given hashes, using only the hash index
+
+        @param hashes: hashes as (hex) strings or Digests
+        @return: a dictionary of hex hash to article id, for all hashes present in the database
+        """
+        result = {}
+        for batch in splitlist(hashes, itemsperbatch=batch_size):
+            for hash, aid in Article.objects.filter(hash__in=batch).values_list("hash", "id"):
+                result[str(hash)] = aid
+        return result
+
+    @classmethod
+    def _mark_duplicates(cls, hashes: Dict[str, List["Article"]], use_filter=False):
+        """
+        Mark articles whose hash is already in the database as duplicates
+
+        @param hashes: mapping of hash to the new article(s) with this hash
+        @param use_filter: skip the database lookup for hashes not in the (in-process) hash filter
+        """
+        candidates = list(hashes)
+        if use_filter and candidates:
+            might_exist = _get_hash_filter().might_contain(candidates)
+            candidates = [h for h, maybe in zip(candidates, might_exist) if maybe]
+
+        for hash, aid in cls.get_ids_by_hash(candidates).items():
+            orig = Article(id=aid, hash=hash)
+            for dupe in hashes[hash]:
+                dupe._duplicate = orig
+                dupe.id = aid
+
     @classmethod
     def create_articles(cls, articles, articleset=None, articlesets=None, deduplicate=True,
                         monitor=NullMonitor(), add_to_index=True):
@@ -441,6 +476,7 @@ class Article(AmcatModel):
 
         # Determine which articles are dupes of each other, *then* query the database
         # to check if the database has any articles we just got.
+        use_filter = deduplicate and settings.ARTICLE_HASH_FILTER
         if deduplicate:
             hashes = collections.defaultdict(list)  # type: Dict[str, List[Article]]
 
@@ -451,13 +487,7 @@ class Article(AmcatModel):
                     hashes[a.hash].append(a)
             # Check database for duplicates
             monitor.update(message="Checking _duplicates based on hash..")
-            if hashes:
-                results = Article.objects.filter(hash__in=hashes.keys()).only("hash")
-                for orig in results:
-                    dupes = hashes[str(orig.hash)]
-                    for dupe in dupes:
-                        dupe._duplicate = orig
-                        dupe.id = orig.id
+            cls._mark_duplicates(hashes, use_filter=use_filter)
         else:
             monitor.update()
 
@@ -467,12 +497,27 @@ class Article(AmcatModel):
         if to_insert:
             for article in to_insert:
                 article.full_clean()
-            result = bulk_insert_returning_ids(to_insert)
+            if use_filter:
+                try:
+                    with transaction.atomic():
+                        result = bulk_insert_returning_ids(to_insert)
+                except IntegrityError:
+                    # The hash filter missed an existing article (see ModelHashFilter), check all hashes
+                    log.warning("Hash filter missed a duplicate, checking all hashes in database")
+                    cls._mark_duplicates(hashes, use_filter=False)
+                    to_insert = [a for a in articles if not a._duplicate]
+                    result = bulk_insert_returning_ids(to_insert) if to_insert else []
+            else:
+                result = bulk_insert_returning_ids(to_insert)
             for a, inserted in zip(to_insert, result):
                 a.id = inserted.id
             if add_to_index:
-                dicts = [a.get_article_dict(sets=[aset.id for aset in articlesets]) for a in to_insert]
-                amcates.ES().bulk_insert(dicts, batch_size=100, monitor=monitor)
+                dicts = (a.get_article_dict(sets=[aset.id for aset in articlesets]) for a in to_insert)
+                # The articles were just inserted in the database, so they cannot be in the index yet
+                errors = amcates.ES().parallel_bulk_insert(dicts, monitor=monitor, new=True)
+                if errors:
+                    raise amcates.ElasticSearchError(errors)
+                monitor.update()
         else:
             monitor.update()
 
@@ -491,7 +536,7 @@ class Article(AmcatModel):
         dupes = {a._duplicate.id for a in articles if a._duplicate} - new_ids
         for aset in articlesets:
             if new_ids:
-                aset.add_articles(new_ids, add_to_index=False, monitor=monitor)
+                aset.add_articles(new_ids, add_to_index=False, already_indexed=add_to_index, monitor=monitor)
             else:
                 monitor.update()
 
@@ -500,15 +545,98 @@ class Article(AmcatModel):
             else:
                 monitor.update()
 
-        # Add to articleset caches
-        properties = set()
-        for article in articles:
-            properties.update(article.properties.keys())
+        return articles
+
+    @classmethod
+    def create_articles_streaming(cls, articles, articleset=None, articlesets=None, chunk_size=1000,
+                                  monitor=NullMonitor(), **kargs):
+        """
+        Streaming version of create_articles: the given iterable of articles is consumed and saved in
+        chunks of chunk_size, so memory use depends on the chunk size instead of the number of articles.
+        Duplicates of articles in earlier chunks are detected as they are already in the database.
+        If consuming the articles fails, the chunks saved before the error are kept.
+
+        @param articles: an iterable (possibly a generator) of objects with the necessary properties
+        @param kargs: additional arguments passed to create_articles, e.g. deduplicate and add_to_index
+        @return: a generator yielding the saved articles, one chunk at a time
+        """
+        n = 0
+        for i, chunk in enumerate(splitlist(articles, itemsperbatch=chunk_size)):
+            cls.create_articles(chunk, articleset=articleset, articlesets=articlesets, **kargs)
+            n += len(chunk)
+            monitor.update(0, "Saved chunk {i}: {n} articles".format(i=i + 1, n=n))
+            yield from chunk
 
-        for articleset in articlesets:
-            articleset._add_to_property_cache(properties)
 
-        return articles
+class ArticleSignature(AmcatModel):
+    """
+    Signature of an article used for deduplication (see DeduplicateSet), so repeated runs only need to read
+    new articles from elastic. As the signature depends on the compared fields and the method, signatures are
+    stored per key (see get_key). The hash of the article is stored as well, so a changed article is read again.
+    """
+    id = models.BigAutoField(primary_key=True)
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, db_index=False)
+    key = models.CharField(max_length=56)
+    article_hash = HashField(max_length=224//8, db_index=False)
+    signature = models.BinaryField()
+
+    class Meta:
+        app_label = 'amcat'
+        db_table = "article_signatures"
+        # The index also serves the cascading delete of articles
+        unique_together = ("article", "key")
+
+    @classmethod
+    def get_key(cls, method: str, fields: Sequence[str], *parameters) -> str:
+        """Identify signatures computed with the given method on the given fields"""
+        key = json.dumps([method, sorted(fields)] + list(parameters))
+        return hashlib.sha224(key.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get_signatures(cls, key: str, hashes: Dict[int, Any]) -> Dict[int, bytes]:
+        """
+        Get the stored signatures of the given articles
+
+        @param hashes: a dictionary of article id to its current hash
+        @return: a dictionary of article id to signature, for all articles with a signature for their current hash
+        """
+        signatures = cls.objects.filter(key=key, article_id__in=list(hashes))
+        return {aid: bytes(signature)
+                for aid, hash, signature in signatures.values_list("article_id", "article_hash", "signature")
+                if hashes[aid] == hash}
+
+    @classmethod
+    def store(cls, key: str, signatures: Sequence[Tuple[int, Any, bytes]], batch_size=1000):
+        """
+        Store signatures, replacing existing signatures of the articles. This is done with an upsert,
+        so concurrent runs on overlapping sets do not conflict.
+
+        @param signatures: a sequence of (article id, article hash, signature) tuples
+        """
+        hash_field, signature_field = cls._meta.get_field("article_hash"), cls._meta.get_field("signature")
+        # Rows are locked in the order of their article ids, so concurrent runs cannot deadlock
+        signatures = sorted({aid: (aid, hash, signature) for aid, hash, signature in signatures}.items())
+        upsert = ("INSERT INTO {table} (article_id, key, article_hash, signature) VALUES {values} "
+                  "ON CONFLICT (article_id, key) DO UPDATE "
+                  "SET article_hash = EXCLUDED.article_hash, signature = EXCLUDED.signature")
+        with connection.cursor() as cursor:
+            for batch in splitlist(signatures, itemsperbatch=batch_size):
+                values = ", ".join(["(%s, %s, %s, %s)"] * len(batch))
+                params = [param for _, (aid, hash, signature) in batch
+                          for param in (aid, key, hash_field.get_db_prep_save(hash, connection),
+                                        signature_field.get_db_prep_save(signature, connection))]
+                cursor.execute(upsert.format(table=cls._meta.db_table, values=values), params)
+
+
+_hash_filter = None
+
+
+def _get_hash_filter() -> ModelHashFilter:
+    """Get the filter of all article hashes of this process, see settings.ARTICLE_HASH_FILTER"""
+    global _hash_filter
+    if _hash_filter is None:
+        _hash_filter = ModelHashFilter(Article)
+    return _hash_filter
 
 
 def _check_read_access(user, aids):
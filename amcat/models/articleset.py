@@ -22,34 +22,27 @@ Model module for Article Sets. A Set is a generic collection of articles,
 either created manually or as a result of importing articles or assigning
 codingjobs.
 """
-import functools
 import itertools
 import json
 import logging
-from typing import Set, Iterable
+from collections import Counter
+from contextlib import contextmanager
+from typing import Set, Iterable, Tuple
 
-import django_redis
-import redis
-from django import db
 from django.db import connection
 from django.db import models
 
 from amcat.models.article import Article
 from amcat.models.coding.codedarticle import CodedArticle
-from amcat.tools import amcates, toolkit
+from amcat.tools import amcates, amcates_cache, toolkit
 from amcat.tools.amcates import ES
+from amcat.tools.idset import IdSet
 from amcat.tools.model import AmcatModel
 from amcat.tools.progress import NullMonitor
 
 log = logging.getLogger(__name__)
 
 
-@functools.lru_cache()
-def _get_property_cache_key(id):
-    db_name = db.connections.databases['default']['NAME']
-    return "{}.articleset.{}.properties".format(db_name, id)
-
-
 def create_new_articleset(name, project):
     """Create a new articleset based on name. If articleset exists add postfix number to make articleset name unique."""
     name=ArticleSet.get_unique_name(project, name)
@@ -82,6 +75,10 @@ class ArticleSet(AmcatModel):
     provenance = models.TextField(null=True)
     featured = models.BooleanField(default=False)
 
+    # Id of the last ArticleSetChange applied to the index, or None if the index was never synchronized
+    # with the change journal (sets created before the journal existed).
+    index_watermark = models.BigIntegerField(null=True, default=0)
+
     class Meta():
         app_label = 'amcat'
         db_table = 'articlesets'
@@ -95,7 +92,8 @@ class ArticleSet(AmcatModel):
         from amcat.tools.amcates import ES
         return ES().count(filters={"sets": self.id})
 
-    def add_articles(self, article_ids, add_to_index=True, add_to_codingjobs=True, monitor=NullMonitor()):
+    def add_articles(self, article_ids, add_to_index=True, add_to_codingjobs=True, monitor=NullMonitor(),
+                     wait_for_visibility=None, already_indexed=False):
         """
         Add the given articles to this articleset. Implementation is exists of three parts:
 
@@ -108,13 +106,19 @@ class ArticleSet(AmcatModel):
 
         @param add_to_index: notify elasticsearch of changes
         @type add_to_index: bool
+
+        @param wait_for_visibility: refresh the index, so the changes are visible to searches when this
+                                    method returns (see ES.refresh_sets)
+
+        @param already_indexed: the articles are new and were indexed as members of this set (by
+                                create_articles), so the change does not need to be journaled
         """
         monitor = monitor.submonitor(total=4)
 
         article_ids = {(art if type(art) is int else art.id) for art in article_ids}
 
-        # Only use articles that exist
-        to_add = article_ids - self.get_article_ids()
+        # Only use articles that exist and are not yet in this set
+        to_add = article_ids - set(self._get_existing_article_ids(article_ids))
         to_add = list(Article.exists(to_add))
 
         monitor.update(message="Adding {n} articles to {aset}..".format(n=len(to_add), aset=self))
@@ -132,63 +136,48 @@ class ArticleSet(AmcatModel):
         if add_to_index:
             monitor.update(message="Adding {n} articles to index".format(n=len(to_add)))
             es = ES()
-            es.add_to_set(self.id, to_add, monitor=monitor)
-            es.refresh()  # We need to flush, or setting cache will fail
-            # Add to property cache
-            properties = ES().get_used_properties(article_ids=to_add)
-            self._add_to_property_cache(properties)
+            with ArticleSetChange.apply(self, to_add, ArticleSetChange.ADD):
+                es.add_to_set(self.id, to_add, monitor=monitor)
+            es.refresh_sets(self.id, wait_for_visibility=wait_for_visibility)
         else:
+            # New articles are found by their id, also when rebuilding the index
+            if not already_indexed:
+                ArticleSetChange.record(self, to_add, ArticleSetChange.ADD)
             monitor.update(2)
 
 
 
     def get_used_properties(self) -> Set[str]:
-        cache = django_redis.get_redis_connection()  # type: redis.client.StrictRedis
-        properties = cache.smembers(_get_property_cache_key(self.id))
-
-        if not properties:
-            properties = self._refresh_property_cache()
-        else:
-            properties = {p.decode() for p in properties}
-
-        return {p for p in properties if p}
-
-    def _add_to_property_cache(self, properties: Iterable[str]) -> Set[str]:
-        """Add properties to property cache"""
-        properties = {p.encode() for p in properties}
-        cache = django_redis.get_redis_connection()  # type: redis.client.StrictRedis
-        cache.sadd(_get_property_cache_key(self.id), "", *properties)
-        return {p.decode() for p in properties}
+        """Return the flexible properties used by articles in this set, using the property counters
+        maintained by elastic indexing operations (see amcates_cache)."""
+        counts = amcates_cache.get_property_counts(self.id)
+        if counts is None:
+            counts = self._refresh_property_cache()
+        return {p for p, n in counts.items() if n > 0}
 
     def _reset_property_cache(self):
         """Completely discard property cache"""
-        cache = django_redis.get_redis_connection()  # type: redis.client.StrictRedis
-        cache.delete(_get_property_cache_key(self.id))
+        amcates_cache.delete_property_counts(self.id)
 
     @classmethod
     def _reset_all_property_caches(cls):
         """Resets all property caches from all articlesets for current database. Use this
         function with care, it runs O(n) with N being the number of keys in Redis."""
-        cache = django_redis.get_redis_connection()  # type: redis.client.StrictRedis
-        cache_key = _get_property_cache_key("*")
-        cache_keys = cache.keys(cache_key)
-        if cache_keys:
-            cache.delete(*cache_keys)
-
-    def _refresh_property_cache(self) -> Set[str]:
-        """Discard property cache and recalculate properties"""
-        from amcat.tools.amcates import ES
+        amcates_cache.delete_all_property_counts()
+
+    def _refresh_property_cache(self) -> Counter:
+        """Discard property cache and recount properties"""
         es = ES()
         es.refresh()
-        properties = es.get_used_properties([self.id])
-        self._reset_property_cache()
-        return self._add_to_property_cache(properties)
+        counts = es.count_properties(amcates.build_filter(sets=[self.id]))
+        amcates_cache.set_property_counts(self.id, counts)
+        return counts
 
     def add(self, *articles):
         """add(*a) is an alias for add_articles(a)"""
         self.add_articles(articles)
 
-    def remove_articles(self, articles, remove_from_index=True, monitor=NullMonitor()):
+    def remove_articles(self, articles, remove_from_index=True, monitor=NullMonitor(), wait_for_visibility=None):
         """
         Remove article from this articleset. Also removes CodedArticles (from codingjobs) and updates
         index if `remove_from_index` is True.
@@ -198,6 +187,9 @@ class ArticleSet(AmcatModel):
 
         @param remove_from_index: notify elasticsearch of changes
         @type remove_from_index: bool
+
+        @param wait_for_visibility: refresh the index, so the changes are visible to searches when this
+                                    method returns (see ES.refresh_sets)
         """
         monitor = monitor.submonitor(4)
         to_remove = {(art if type(art) is int else art.id) for art in articles}
@@ -210,19 +202,22 @@ class ArticleSet(AmcatModel):
 
         if remove_from_index:
             monitor.update(message="Deleting from index")
-            amcates.ES().remove_from_set(self.id, to_remove)
+            es = amcates.ES()
+            with ArticleSetChange.apply(self, to_remove, ArticleSetChange.REMOVE):
+                es.remove_from_set(self.id, to_remove)
+            es.refresh_sets(self.id, wait_for_visibility=wait_for_visibility)
         else:
+            ArticleSetChange.record(self, to_remove, ArticleSetChange.REMOVE)
             monitor.update()
 
-        monitor.update(message="Deleting from cache")
-        self._reset_property_cache()
+        monitor.update()
 
-    def get_article_ids(self, use_elastic=False) -> Set[int]:
+    def get_article_ids(self, use_elastic=False) -> IdSet:
         """
         Return the sequence of ids of articles in this set.
         This is an optimized form of 'return [a.id for a in self.articles.all()]'
 
-        @rtype: set
+        @rtype: IdSet
         """
         if use_elastic:
             return self.get_article_ids_from_elastic()
@@ -230,26 +225,33 @@ class ArticleSet(AmcatModel):
         sql = str(ArticleSet.articles.through.objects.filter(articleset=self).values("article_id").query)
         cursor = connection.cursor()
         cursor.execute(sql)
-        result = {aid for (aid,) in cursor.fetchall()}
+        result = IdSet(aid for (aid,) in cursor)
         cursor.close() # no idea if it's needed, but Martijn told me to do it
         return result
 
-    def get_article_ids_from_elastic(self):
+    def _get_existing_article_ids(self, article_ids, batch_size=1000):
+        """Filter the given article ids, yielding only those already in this set"""
+        for batch in toolkit.splitlist(article_ids, itemsperbatch=batch_size):
+            yield from (ArticleSetArticle.objects.filter(articleset=self, article_id__in=batch)
+                        .values_list("article_id", flat=True))
+
+    def get_article_ids_from_elastic(self) -> IdSet:
         """
         Return the sequence of ids of articles in this set. As opposed to get_article_ids, this
         method uses elastic to fetch its data.
 
-        @rtype: set
+        @rtype: IdSet
         """
-        return set(ES().query_ids(filters={"sets" : [self.id]}))
+        return IdSet(ES().query_ids_array(filters={"sets" : [self.id]}, slices=None))
 
-    def refresh_index(self, full_refresh=False):
+    def refresh_index(self, full_refresh=False, verify=False):
         """
-        Make sure that the index for this set is up to date
+        Make sure that the index for this set is up to date, see ES.synchronize_articleset
         """
         from amcat.tools.amcates import ES
         ES().check_index()
-        ES().synchronize_articleset(self, full_refresh=full_refresh)
+        ES().synchronize_articleset(self, full_refresh=full_refresh, verify=verify)
+        amcates_cache.bump_generation(self.id)
         self.save()
 
         # Also make sure property cache checks out
@@ -257,7 +259,11 @@ class ArticleSet(AmcatModel):
         self._refresh_property_cache()
 
     def save(self, *args, **kargs):
+        is_new = self._state.adding
         super(ArticleSet, self).save(*args, **kargs)
+        if is_new:
+            # Make sure no results cached for a previous set with this id are used
+            amcates_cache.bump_generation(self.id)
         pa, created = ProjectArticleSet.objects.get_or_create(project=self.project,
                                                               articleset=self,
                                                               defaults=dict(is_favourite=True))
@@ -281,7 +287,7 @@ class ArticleSet(AmcatModel):
             ProjectArticleSet.objects.filter(project=project, articleset=aset).update(is_favourite=False)
         return aset
 
-    def delete(self, purge_orphans=True):
+    def delete(self, purge_orphans=True, monitor=NullMonitor()):
         "Delete the articleset and all articles from index and db"
         # which articles are only in this set?
         # check per N articles
@@ -289,6 +295,8 @@ class ArticleSet(AmcatModel):
         log.warn("Getting all articles")
 
         aids = list(self.articles.values_list("pk", flat=True))
+        # The journal of this set is deleted with it, so a rebuild of the index must copy its articles again
+        amcates_cache.record_rebuild_changes(aids)
         todelete = set(aids)
         log.warn("Finding orphans in {} articles".format(len(aids)))
         for aids in toolkit.splitlist(aids, itemsperbatch=1000):
@@ -303,17 +311,19 @@ class ArticleSet(AmcatModel):
             #Article.objects.filter(pk__in=aids)._raw_delete(Article.objects.db)
             Article.objects.filter(pk__in=aids).only("pk").delete()
 
-        log.warn("Getting set membership from elastic")
-        esaids = list(self.get_article_ids_from_elastic())
-        if esaids:
-            log.warn("Removing set membership from elastic ({} articles)".format(len(esaids)))
-            amcates.ES().remove_from_set(self.id, esaids)
+        monitor = monitor.submonitor(total=2)
+        log.warn("Removing set membership from elastic")
+        amcates.ES().remove_from_set(self.id, monitor=monitor)
+        amcates.ES().refresh_sets(self.id)
 
         if purge_orphans:
             amcates.ES().refresh()
-            amcates.ES().purge_orphans()
+            amcates.ES().purge_orphans(monitor=monitor)
+        else:
+            monitor.update()
 
         log.warn("Deleting set (and articlesetarticle references)")
+        self._reset_property_cache()
         super(ArticleSet, self).delete() # cascade deletes all article references
         log.warn("Done!")
 
@@ -330,3 +340,87 @@ class ProjectArticleSet(AmcatModel):
         app_label = 'amcat'
         db_table = "projects_articlesets"
         unique_together = ("project", "articleset")
+
+
+class ArticleSetChange(AmcatModel):
+    """
+    Journal of articles added to and removed from sets that are not (yet) applied to the index, written
+    by ArticleSet.add_articles and remove_articles. Synchronizing the index only needs to replay the
+    changes of a set since its index_watermark, see ES.synchronize_articleset. Changes are deleted once
+    they are applied to the index. Changes that are applied to the index directly are not journaled,
+    so the journal stays small. While the index is being rebuilt, the ids of all changed articles are
+    recorded separately (see amcates_cache.record_rebuild_changes).
+    """
+    ADD, REMOVE = 1, 2
+
+    id = models.BigAutoField(primary_key=True)
+    articleset = models.ForeignKey('amcat.ArticleSet', on_delete=models.CASCADE, db_index=False)
+    article_id = models.IntegerField()
+    action = models.SmallIntegerField(choices=[(ADD, "add"), (REMOVE, "remove")])
+
+    class Meta:
+        app_label = 'amcat'
+        db_table = "articleset_changes"
+        index_together = [("articleset", "id")]
+
+    @classmethod
+    def record(cls, articleset, article_ids, action, batch_size=1000):
+        """Record that the given articles were added to (or removed from) the set"""
+        article_ids = list(article_ids)
+        amcates_cache.record_rebuild_changes(article_ids)
+        cls.objects.bulk_create([cls(articleset=articleset, article_id=aid, action=action) for aid in article_ids],
+                                batch_size=batch_size)
+
+    @classmethod
+    def applied(cls, articleset, article_ids, action, batch_size=10000):
+        """
+        Note that the given change was applied to the index directly. Journaled changes of these articles
+        are superseded, and deleted.
+        """
+        amcates_cache.record_rebuild_changes(article_ids)
+        for batch in toolkit.splitlist(article_ids, itemsperbatch=batch_size):
+            cls.objects.filter(articleset=articleset, article_id__in=batch).delete()
+
+    @classmethod
+    @contextmanager
+    def apply(cls, articleset, article_ids, action):
+        """
+        Context manager applying a change to the index: if it fails, the change is journaled so it is
+        replayed by the next synchronization, otherwise it is marked as applied (see applied)
+        """
+        try:
+            yield
+        except Exception:
+            cls.record(articleset, article_ids, action)
+            raise
+        cls.applied(articleset, article_ids, action)
+
+    @classmethod
+    def get_changes(cls, articleset, until) -> Tuple[IdSet, IdSet, IdSet]:
+        """
+        Get the net effect of all changes to the given set up to the given change id
+
+        @return: a tuple of ids of changes, added articles and removed articles. If an article
+                 was added and removed, only the last change counts.
+        """
+        changes = (cls.objects.filter(articleset=articleset, id__lte=until).order_by("id")
+                   .values_list("id", "article_id", "action"))
+        change_ids, actions = [], {}
+        for change_id, article_id, action in changes.iterator():
+            change_ids.append(change_id)
+            actions[article_id] = action
+        added = IdSet(aid for aid, action in actions.items() if action == cls.ADD)
+        removed = IdSet(aid for aid, action in actions.items() if action == cls.REMOVE)
+        return IdSet(change_ids), added, removed
+
+    @classmethod
+    def get_last_id(cls, articleset) -> int:
+        """Get the id of the last change to the given set, or 0 if there are no changes"""
+        last = cls.objects.filter(articleset=articleset).order_by("-id").values_list("id", flat=True).first()
+        return last or 0
+
+    @classmethod
+    def delete_changes(cls, change_ids, batch_size=10000):
+        """Delete the given changes (after they were applied to the index)"""
+        for batch in toolkit.splitlist(change_ids, itemsperbatch=batch_size):
+            cls.objects.filter(id__in=batch).delete()
@@ -17,14 +17,18 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 import html
+from unittest.mock import patch
 
+from django.test import override_settings
 from iso8601.iso8601 import UTC
 
 from amcat.models import Article, word_len
 from amcat.models import PropertyMapping
+from amcat.models.article import _get_hash_filter
 from amcat.tools import amcattest
 from amcat.tools import amcates
 from amcat.tools.amcattest import create_test_article, create_test_set
+from amcat.tools.hashing import ModelHashFilter
 
 import datetime
 import random
@@ -206,6 +210,73 @@ class TestArticle(amcattest.AmCATTestCase):
         self.assertEqual(a1.id, a2.id)
         self.assertEqual(len(_q(title='internaldupe')), 1)
 
+    @amcattest.use_elastic
+    def test_create_streaming(self):
+        """Are articles saved per chunk, and deduplicated against earlier chunks?"""
+        s = amcattest.create_test_set()
+        project = amcattest.create_test_project()
+        articles = [Article(project=project, title="streaming {}".format(i), text="test", date='2001-01-01')
+                    for i in range(5)]
+        # a duplicate of an article in the first chunk, in the last chunk
+        articles.append(Article(project=project, title="streaming 0", text="test", date='2001-01-01'))
+
+        def generate():
+            for i, a in enumerate(articles):
+                # articles of earlier chunks are saved before the next chunk is consumed
+                if i == 2:
+                    self.assertIsNotNone(articles[1].id)
+                    self.assertIsNone(articles[2].id)
+                yield a
+
+        saved = list(Article.create_articles_streaming(generate(), articleset=s, chunk_size=2))
+        self.assertEqual(saved, articles)
+        self.assertEqual(articles[5].id, articles[0].id)
+        self.assertTrue(articles[5]._duplicate)
+        self.assertEqual(set(s.get_article_ids()), {a.id for a in articles[:5]})
+        amcates.ES().refresh()
+        self.assertEqual(_q(sets=s.id), {a.id for a in articles[:5]})
+
+    @amcattest.use_elastic
+    def test_create_streaming_error(self):
+        """Are chunks saved before an error kept?"""
+        s = amcattest.create_test_set()
+        articles = [create_test_article(create=False) for _i in range(3)]
+
+        def generate():
+            yield from articles
+            raise ValueError("parse error")
+
+        saved = []
+        with self.assertRaises(ValueError):
+            for a in Article.create_articles_streaming(generate(), articleset=s, chunk_size=2):
+                saved.append(a)
+        self.assertEqual(saved, articles[:2])
+        self.assertIsNone(articles[2].id)
+        self.assertEqual(set(s.get_article_ids()), {a.id for a in articles[:2]})
+
+    def test_get_ids_by_hash(self):
+        a1, a2 = create_test_article(), create_test_article()
+        unknown = "0" * 56
+        self.assertEqual(Article.get_ids_by_hash([a1.hash, str(a2.hash), unknown], batch_size=1),
+                         {str(a1.hash): a1.id, str(a2.hash): a2.id})
+        self.assertEqual(Article.get_ids_by_hash([]), {})
+
+    @amcattest.use_elastic
+    def test_deduplication_hash_filter(self):
+        art = dict(project=amcattest.create_test_project(), title="filtertest", text="test", date='2001-01-01')
+        with override_settings(ARTICLE_HASH_FILTER=True):
+            a1 = create_test_article(**art)
+            a2 = create_test_article(**art)
+            self.assertEqual(a2.id, a1.id)
+            self.assertTrue(a2._duplicate)
+            self.assertIn(a1.hash, _get_hash_filter().filter)
+
+            # If the filter misses an existing article, the insert fails and all hashes are checked
+            with patch.object(ModelHashFilter, "might_contain", lambda self, digests: [False] * len(digests)):
+                a3 = create_test_article(**art)
+            self.assertEqual(a3.id, a1.id)
+            self.assertTrue(a3._duplicate)
+
     def test_unicode_word_len(self):
         """Does the word counter eat unicode??"""
         u = u'Kim says: \u07c4\u07d0\u07f0\u07cb\u07f9'
@@ -18,7 +18,7 @@
 ###########################################################################
 from amcat.models import CodedArticle, Article, ArticleSet
 
-from amcat.tools import amcattest
+from amcat.tools import amcattest, amcates_cache
 from amcat.tools.amcates import ES
 
 import elasticsearch
@@ -126,3 +126,49 @@ class TestArticleSet(amcattest.AmCATTestCase):
 
         aset.remove_articles([a2.id])
         self.assertEqual(aset.get_used_properties(), set())
+
+    @amcattest.use_elastic
+    def test_property_counts(self):
+        aset = amcattest.create_test_set()
+        self.assertEqual(aset.get_used_properties(), set())
+
+        a1 = amcattest.create_test_article(properties={"aap": "noot", "jan": "mies"})
+        a2 = amcattest.create_test_article(properties={"aap": "paal"})
+        aset.add_articles([a1.id, a2.id])
+        self.assertEqual(amcates_cache.get_property_counts(aset.id), {"aap": 2, "jan": 1})
+
+        # Removing one of the articles does not remove a property used by the other
+        aset.remove_articles([a1.id])
+        self.assertEqual(aset.get_used_properties(), {"aap"})
+
+        # Adding articles already in the set does not change the counts
+        aset.add_articles([a2.id])
+        self.assertEqual(amcates_cache.get_property_counts(aset.id), {"aap": 1, "jan": 0})
+
+        # New articles are counted when they are indexed
+        article = amcattest.create_test_article(create=False, properties={"vuur": "paal"})
+        Article.create_articles([article], articleset=aset)
+        self.assertEqual(aset.get_used_properties(), {"aap", "vuur"})
+
+    @amcattest.use_elastic
+    def test_property_counts_unrefreshed(self):
+        """Are property counters correct if changes are not refreshed before the next change?"""
+        with self.settings(ES_WAIT_FOR_VISIBILITY=False):
+            aset, aset2 = amcattest.create_test_set(), amcattest.create_test_set()
+            amcates_cache.set_property_counts(aset.id, {})
+            amcates_cache.set_property_counts(aset2.id, {})
+
+            articles = [amcattest.create_test_article(create=False, properties={"aap": "noot"}),
+                        amcattest.create_test_article(create=False, properties={"aap": "mies", "jan": "vuur"})]
+            Article.create_articles(articles, articleset=aset)
+            self.assertEqual(amcates_cache.get_property_counts(aset.id), {"aap": 2, "jan": 1})
+
+            # Adding and removing the (unrefreshed) articles updates the counters of the other set
+            aset2.add_articles([a.id for a in articles])
+            self.assertEqual(amcates_cache.get_property_counts(aset2.id), {"aap": 2, "jan": 1})
+            aset2.remove_articles([articles[1].id])
+            self.assertEqual(amcates_cache.get_property_counts(aset2.id), {"aap": 1, "jan": 0})
+
+            aset.remove_articles([a.id for a in articles])
+            self.assertEqual(aset.get_used_properties(), set())
+            self.assertEqual(aset2.get_used_properties(), {"aap"})
@@ -20,18 +20,25 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 
+import binascii
 import collections
 import logging
+from functools import partial
 from itertools import chain
-from typing import Iterable, Tuple
+from typing import Iterable, Tuple, List, Sequence
 from hashlib import sha224 as hash_class
 
+import numpy
 from django import forms
 
 from amcat.forms.widgets import BootstrapMultipleSelect
-from amcat.models import ArticleSet
+from amcat.models import ArticleSet, ArticleSetArticle, ArticleSignature
 from amcat.scripts.script import Script
 from amcat.tools import amcates
+from amcat.tools.idset import IdSet
+from amcat.tools import minhash
+from amcat.tools.minhash import NearDuplicateIndex
+from amcat.tools.toolkit import splitlist
 
 log = logging.getLogger(__name__)
 
@@ -53,6 +60,11 @@ class DeduplicateSet(Script):
         dry_run = forms.BooleanField(initial=False, required=False,
                                      help_text="Prints all duplicates but doesn't remove them")
 
+        similarity = forms.FloatField(required=False, min_value=0, max_value=1,
+                                      help_text="If given, also remove near duplicates: articles of which the title "
+                                                "and text (unless ignored) are at least this similar (e.g. 0.9). "
+                                                "Other fields are not compared.")
+
         def __init__(self, *args, articleset=None, **kwargs):
             super().__init__(*args, **kwargs)
             articleset = articleset or kwargs.get('data', {}).get('articleset')
@@ -61,9 +73,34 @@ class DeduplicateSet(Script):
             properties = articleset.get_used_properties()
             self.fields['ignore_fields'].choices = [(f, f) for f in chain(STATIC_FIELDS, properties)]
 
-    def _run(self, articleset, save_duplicates_to, dry_run, ignore_fields, **_):
+    def _run(self, articleset, save_duplicates_to, dry_run, ignore_fields, similarity=None, **_):
+        if similarity:
+            to_remove = self.get_near_duplicates(articleset, set(ignore_fields), similarity, dry_run)
+        else:
+            to_remove = self.get_duplicates(articleset, set(ignore_fields), dry_run)
+
+        n = len(to_remove)
+        if not to_remove:
+            logging.info("No duplicates found!")
+        else:
+            if dry_run:
+                logging.info("{n} duplicate articles found, run without dry_run to remove".format(**locals()))
+            else:
+                logging.info("Removing {n} articles from set".format(**locals()))
+                articleset.remove_articles(to_remove)
+            if save_duplicates_to:
+                dupes_article_set = ArticleSet.create_set(articleset.project, save_duplicates_to, to_remove)
+        return n, dry_run
+
+    @classmethod
+    def get_duplicates(cls, articleset: ArticleSet, ignore_fields: set, dry_run=False) -> set:
+        """
+        Find articles with exactly the same values (see hash_articles) as another article in the set
+
+        @return: the ids of all duplicates, except the article with the lowest id of each group
+        """
         hashes = collections.defaultdict(set)
-        for i, (id, h) in enumerate(self.hash_articles(articleset, set(ignore_fields))):
+        for i, (id, h) in enumerate(cls.hash_articles(articleset, set(ignore_fields))):
             if not i % 100000:
                 logging.info("Collecting hashes, n={i}, |hashes|={n}".format(n=len(hashes), **locals()))
             hashes[h].add(id)
@@ -81,18 +118,44 @@ class DeduplicateSet(Script):
                 logging.info("Iterating over hashes {i}/{n}, |to_remove|={m}".format(n=len(hashes), m=len(to_remove),
                                                                                      **locals()))
 
-        n = len(to_remove)
-        if not to_remove:
-            logging.info("No duplicates found!")
-        else:
-            if dry_run:
-                logging.info("{n} duplicate articles found, run without dry_run to remove".format(**locals()))
-            else:
-                logging.info("Removing {n} articles from set".format(**locals()))
-                articleset.remove_articles(to_remove)
-            if save_duplicates_to:
-                dupes_article_set = ArticleSet.create_set(articleset.project, save_duplicates_to, to_remove)
-        return n, dry_run
+        return to_remove
+
+    @classmethod
+    def get_near_duplicates(cls, articleset: ArticleSet, ignore_fields: set, similarity: float, dry_run=False,
+                            chunk_size=1000) -> IdSet:
+        """
+        Find articles with nearly the same title and text as another article in the set, using MinHash
+        signatures (see amcat.tools.minhash). Signatures are computed in chunks (or reused, see get_signatures),
+        and kept in memory, which takes 128 bytes per article.
+
+        @param similarity: minimum (estimated) similarity of the word shingles of near duplicates
+        @return: the ids of all near duplicates, except the article with the lowest id of each group
+        """
+        fields = [f for f in ("title", "text") if f not in ignore_fields]
+        if not fields:
+            raise ValueError("Near duplicates are found on title and text, but both are ignored")
+
+        index = NearDuplicateIndex(capacity=max(1, articleset.get_count()))
+        key = ArticleSignature.get_key("minhash", fields, minhash.NUM_PERM, minhash.SHINGLE_SIZE)
+        signatures = cls.get_signatures(articleset, key, fields, partial(cls._minhash_hits, fields=fields))
+        for chunk in splitlist(signatures, itemsperbatch=chunk_size):
+            ids, chunk_signatures = zip(*chunk)
+            chunk_signatures = numpy.frombuffer(b"".join(chunk_signatures), dtype=numpy.uint16)
+            index.add_signatures(ids, chunk_signatures.reshape(-1, minhash.NUM_PERM))
+
+        logging.info("Finding near duplicates of {n} articles".format(n=len(index)))
+        ids = index.ids[:len(index)]
+        representatives = index.get_representatives(similarity)
+        duplicates = representatives != ids
+
+        if dry_run:
+            groups = collections.defaultdict(list)
+            for id, representative in zip(ids[duplicates].tolist(), representatives[duplicates].tolist()):
+                groups[representative].append(id)
+            for representative, dupes in groups.items():
+                logging.info("Near duplicates of {representative}: {dupes}".format(**locals()))
+
+        return IdSet(ids[duplicates])
 
     @classmethod
     def hash_articles(cls, articleset: ArticleSet, ignore_fields: set) -> Iterable[Tuple[int, str]]:
@@ -108,23 +171,55 @@ class DeduplicateSet(Script):
         @return                 An iterable of (<article_id>, <hash>) tuples.
         """
         all_fields = STATIC_FIELDS + list(articleset.get_used_properties())
-
-        if not ignore_fields:
-            fields = ["hash"]
-        else:
-            fields = sorted(f for f in all_fields if not f in ignore_fields)
-
-        x = amcates.ES().scan(query={"query": {"constant_score": {"filter": {"term": {"sets": articleset.id}}}}},
-                              fields=fields)
-        for x in amcates.ES().scan(query={"query": {"constant_score": {"filter": {"term": {"sets": articleset.id}}}}},
-                                   _source=fields):
-            if not ignore_fields:
-                yield int(x['_id']), x['_source']['hash']
-                continue
+        fields = sorted(f for f in all_fields if not f in ignore_fields)
+        key = ArticleSignature.get_key("hash", fields)
+        for id, signature in cls.get_signatures(articleset, key, fields, partial(cls._hash_hits, fields=fields)):
+            yield id, binascii.hexlify(signature).decode("ascii")
+
+    @staticmethod
+    def _hash_hits(hits, fields) -> List[bytes]:
+        result = []
+        for x in hits:
             art_tuple = tuple(str(x['_source'].get(k, [None])) for k in fields)
-            hash = hash_class(repr(art_tuple).encode()).hexdigest()
-            yield int(x['_id']), hash
+            result.append(hash_class(repr(art_tuple).encode()).digest())
+        return result
 
+    @staticmethod
+    def _minhash_hits(hits, fields) -> List[bytes]:
+        texts = ["\n\n".join(x['_source'].get(f) or "" for f in fields) for x in hits]
+        return [signature.tobytes() for signature in minhash.get_signatures(texts)]
+
+    @classmethod
+    def get_signatures(cls, articleset: ArticleSet, key: str, fields: Sequence[str], compute,
+                       batch_size=10000) -> Iterable[Tuple[int, bytes]]:
+        """
+        Yield the signatures of all articles in the set. Signatures stored by an earlier run (see ArticleSignature)
+        are reused if the article did not change since, so only new articles are read from elastic.
+
+        @param key: identifies the kind of signatures, see ArticleSignature.get_key
+        @param fields: fields that are read from elastic to compute a signature
+        @param compute: function returning a list of signatures (bytes) for a list of elastic hits
+        @return: an iterable of (<article_id>, <signature>) tuples
+        """
+        members = (ArticleSetArticle.objects.filter(articleset=articleset).order_by("article_id")
+                   .values_list("article_id", "article__hash"))
+        n = computed = 0
+        for batch in splitlist(members.iterator(), itemsperbatch=batch_size):
+            hashes = dict(batch)
+            stored = ArticleSignature.get_signatures(key, hashes)
+            yield from stored.items()
+
+            missing = [id for id in hashes if id not in stored]
+            if missing:
+                hits = list(amcates.ES().scan(query={"query": {"ids": {"values": missing}}}, _source=fields))
+                ids = [int(x['_id']) for x in hits]
+                signatures = compute(hits)
+                ArticleSignature.store(key, [(id, hashes[id], signature) for id, signature in zip(ids, signatures)])
+                yield from zip(ids, signatures)
+
+            n += len(hashes)
+            computed += len(missing)
+            logging.info("Collecting signatures, n={n}, computed={computed}".format(**locals()))
 
 if __name__ == '__main__':
     from amcat.scripts.tools.cli import run_cli
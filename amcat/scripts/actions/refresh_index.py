@@ -36,10 +36,11 @@ class RefreshIndex(Script):
     class options_form(forms.Form):
         articleset = forms.ModelChoiceField(queryset=ArticleSet.objects.all())
         full_refresh = forms.BooleanField(initial=False, required=False)
+        verify = forms.BooleanField(initial=False, required=False)
         
-    def _run(self, articleset, full_refresh):
-        log.info("Refreshing {articleset}, full_refresh={full_refresh}".format(**locals()))
-        articleset.refresh_index(full_refresh=full_refresh)
+    def _run(self, articleset, full_refresh, verify):
+        log.info("Refreshing {articleset}, full_refresh={full_refresh}, verify={verify}".format(**locals()))
+        articleset.refresh_index(full_refresh=full_refresh, verify=verify)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,12 @@
 import uuid
 import datetime
 from collections import Hashable
+from unittest.mock import patch
 
-from amcat.models import ArticleSet
+from amcat.models import ArticleSet, ArticleSignature
 from amcat.scripts.actions.deduplicate_set import DeduplicateSet
 from amcat.tools import amcattest
-from amcat.tools.amcates import ES
+from amcat.tools.amcates import ES, _ES
 
 
 class TestDeduplicateSet(amcattest.AmCATTestCase):
@@ -81,6 +82,25 @@ class TestDeduplicateSet(amcattest.AmCATTestCase):
         self.assertEqual(hashes[self.articles[2].id], hashes[self.articles[3].id])
         self.assertNotEqual(hashes[self.articles[0].id], hashes[self.articles[2].id])
 
+    @amcattest.use_elastic
+    def test_no_ignore_fields(self):
+        """Are articles that only differ in fields that are not compared (e.g. parent) found without ignore_fields?"""
+        self._set_up()
+        now = datetime.datetime.now()
+        parent = amcattest.create_test_article(articleset=self.test_set, title="a", text="b", date=now)
+        child = amcattest.create_test_article(articleset=self.test_set, title="a", text="b", date=now,
+                                              parent_hash=self.articles[0].hash)
+        self.assertNotEqual(parent.id, child.id)
+        ES().refresh()
+
+        hashes = dict(DeduplicateSet.hash_articles(self.test_set, ignore_fields=set()))
+        self.assertEqual(hashes[parent.id], hashes[child.id])
+        self.assertNotEqual(hashes[self.articles[0].id], hashes[self.articles[1].id])
+
+        n, _ = DeduplicateSet(options=self.base_options).run()
+        self.assertEqual(n, 1)
+        self.assertEqual(set(self.test_set.get_article_ids()), {a.id for a in self.articles} | {parent.id})
+
     @amcattest.use_elastic
     def test_hash_property_fields(self):
         self._set_up()
@@ -93,6 +113,59 @@ class TestDeduplicateSet(amcattest.AmCATTestCase):
         unique_hashes = set(hashes[self.articles[i].id] for i in range(5))
         self.assertEqual(len(unique_hashes), 5)
 
+    @amcattest.use_elastic
+    def test_near_duplicates(self):
+        text = ("The minister announced on Tuesday that the new budget will include significant cuts to defence "
+                "spending and increases in education, according to a statement released by the ministry.")
+        now = datetime.datetime.now()
+        articles = [
+            {"title": "Budget", "text": text, "date": now},
+            {"title": "Budget", "text": text + " (ANP)", "date": now},
+            {"title": "Budget", "text": text.replace("Tuesday", "Wednesday"), "date": now},
+            {"title": "Football", "text": "The match was cancelled because of the weather", "date": now},
+        ]
+        test_set = amcattest.create_test_set()
+        articles = [amcattest.create_test_article(articleset=test_set, **fields) for fields in articles]
+        ES().refresh()
+
+        self.assertEqual(DeduplicateSet.get_near_duplicates(test_set, set(), similarity=0.9), {articles[1].id})
+        self.assertEqual(DeduplicateSet.get_near_duplicates(test_set, set(), similarity=0.6, chunk_size=2),
+                         {articles[1].id, articles[2].id})
+
+        options = dict(articleset=test_set.id, ignore_fields=(), save_duplicates_to=None, dry_run=False,
+                       similarity=0.9)
+        n, _ = DeduplicateSet(options=options).run()
+        ES().refresh()
+        self.assertEqual(n, 1)
+        self.assertEqual(set(test_set.get_article_ids()), {articles[0].id, articles[2].id, articles[3].id})
+
+    @amcattest.use_elastic
+    def test_stored_signatures(self):
+        self._set_up()
+        ignore_fields = {"unique_id"}
+        hashes = dict(DeduplicateSet.hash_articles(self.test_set, ignore_fields))
+        self.assertEqual(ArticleSignature.objects.filter(article__in=self.articles).count(), 5)
+
+        # A second run reuses the stored signatures, and only reads new articles from elastic
+        new = amcattest.create_test_article(articleset=self.test_set, title="new")
+        ES().refresh()
+        scan = _ES.scan
+        with patch.object(_ES, "scan", autospec=True, side_effect=scan) as mock_scan:
+            hashes2 = dict(DeduplicateSet.hash_articles(self.test_set, ignore_fields))
+        self.assertEqual(mock_scan.call_count, 1)
+        self.assertEqual(mock_scan.call_args[1]["query"], {"query": {"ids": {"values": [new.id]}}})
+        self.assertEqual(hashes2, dict(hashes, **{new.id: hashes2[new.id]}))
+
+        # Storing signatures again replaces them
+        signatures = list(ArticleSignature.objects.filter(article__in=self.articles).values_list(
+            "article_id", "key", "article_hash", "signature"))
+        ArticleSignature.store(signatures[0][1], [(aid, hash, b"x") for aid, key, hash, _ in signatures])
+        stored = ArticleSignature.objects.filter(article__in=self.articles).values_list("signature", flat=True)
+        self.assertEqual({bytes(signature) for signature in stored}, {b"x"})
+
+        # Signatures depend on the compared fields
+        self.assertNotEqual(dict(DeduplicateSet.hash_articles(self.test_set, {"unique_id", "title"})), hashes2)
+
     def _get_es_like_articles(self, articles):
         """
         @param articles: A list of {field: value} dicts
@@ -460,6 +460,7 @@ class APAForm(UploadScript.form_class):
 @UploadPlugin(label="APA", mime_types=("text/rtf",))
 class APA(UploadScript):
     options_form = APAForm
+    parallel_parsing = True
 
     @classmethod
     def get_fields(cls, upload: models.UploadedFile):
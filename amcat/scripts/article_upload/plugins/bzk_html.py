@@ -43,6 +43,7 @@ DEFAULTS = {
 
 @UploadPlugin(name="BZK_HTML", label="BZK HTML")
 class BZK(UploadScript):
+    parallel_parsing = True
 
     @classmethod
     def get_fields(cls, upload):
@@ -29,14 +29,14 @@ import re
 from collections import OrderedDict
 from functools import lru_cache
 from io import StringIO
-from typing import Iterable, Tuple
+from typing import Iterable, Iterator, Optional, Tuple
 
 import django.core.files.uploadedfile
 from ruamel import yaml
 
 from amcat.models import UploadedFile as model_UploadedFile
 from amcat.models.article import Article
-from amcat.scripts.article_upload.upload import ArticleField, ParseError, UploadScript
+from amcat.scripts.article_upload.upload import ArticleField, ParseError, PreprocessError, UploadScript
 from amcat.scripts.article_upload.upload_plugins import UploadPlugin
 from amcat.tools import toolkit
 from amcat.tools.amcates import get_property_primitive_type
@@ -66,6 +66,18 @@ class RES:
 
     SPLIT_LANGUAGES = re.compile("[^\w ]")
 
+    # Patterns used by parse_article
+    DIGIT = re.compile("\d")
+    WHITESPACE = re.compile("\s+")
+    ONLINE_BLOCK_SEPARATOR = re.compile("\n *\n\s*")
+    ONLINE_WORDS = re.compile("(\d+) words")
+    HEADER_COPYRIGHT = re.compile("Copyright \d{4}")
+    TITLE_PREFIX = re.compile("[A-Z]+:")
+    YEAR = re.compile("(.*)(\d{4})$")
+    ISSUE = re.compile("[-\d]+[^\d]+\d+")
+    TIME = re.compile(r"\b\d?\d:\d\d\s(PM\b)?")
+    SOURCE_COPYRIGHT = re.compile("copyright\s\xa9?\s?(\d{4})?(.*)", re.I)
+
 
 MONTHS = dict(spring=3,
               summer=6,
@@ -193,7 +205,7 @@ def _strip_article(art):
 
 
 def _is_date(string, language_pool=None):
-    if not re.search("\d", string):
+    if not RES.DIGIT.search(string):
         return False  # no number = no date, optimizatino because dateparse is very slow on non-matches
     try:
         toolkit.read_date(string, language_pool=language_pool)
@@ -205,7 +217,7 @@ def _is_date(string, language_pool=None):
 
 def parse_online_article(art):
     # First, test for online articles with specific format
-    blocks = re.split("\n *\n\s*", _strip_article(art))
+    blocks = RES.ONLINE_BLOCK_SEPARATOR.split(_strip_article(art))
     if len(blocks) != 6:
         return
     medium, url, datestr, title, nwords, lead = blocks
@@ -214,7 +226,7 @@ def parse_online_article(art):
     if lead.startswith("Bewaar lees artikel"):
         lead = lead[len("Bewaar lees artikel"):]
 
-    m = re.match("(\d+) words", nwords)
+    m = RES.ONLINE_WORDS.match(nwords)
     if not m:
         return
     nwords = int(m.group(1))
@@ -237,6 +249,9 @@ def parse_article(art):
     The meta fields are of the form FIELDNAME: value and can contain various field names
     The body starts after either two blank lines, or if a line is not of the meta field form.
     The body ends with a 'load date', which is of form FIELDNAME: DATE ending with a four digit year
+
+    The parts are consumed from the front of a deque of lines, and all look-aheads use indices
+    instead of copies of the remaining lines.
     """
     online = parse_online_article(art)
     if online:
@@ -246,11 +261,12 @@ def parse_article(art):
     metadata_lang = None
 
     def next_is_indented(lines, skipblank=True):
-        if len(lines) <= 1: return False
-        if not lines[1].strip():
-            if not skipblank: return False
-            return next_is_indented(lines[1:])
-        return lines[1].startswith(" ")
+        for i in range(1, len(lines)):
+            if lines[i].strip():
+                return lines[i].startswith(" ")
+            if not skipblank:
+                return False
+        return False
 
     def followed_by_date_block(lines):
         # this text is followed by a date block
@@ -259,19 +275,21 @@ def parse_article(art):
         #          indented date line
         #          optional second indented date line
         # (blank line)
-        if len(lines) < 5: return False
-        if ((not lines[1].strip()) and
-                lines[2].startswith(" ") and
-                (not lines[3].strip())):
-            return True
-        if ((not lines[1].strip()) and
-                lines[2].startswith(" ") and
-                lines[2].startswith(" ") and
-                (not lines[4].strip())):
-            return True
-        if not lines[1].strip(): return False
-        if lines[1].startswith(" "): return False
-        return followed_by_date_block(lines[1:])
+        i = 0
+        while len(lines) - i >= 5:
+            if ((not lines[i + 1].strip()) and
+                    lines[i + 2].startswith(" ") and
+                    (not lines[i + 3].strip())):
+                return True
+            if ((not lines[i + 1].strip()) and
+                    lines[i + 2].startswith(" ") and
+                    lines[i + 2].startswith(" ") and
+                    (not lines[i + 4].strip())):
+                return True
+            if not lines[i + 1].strip(): return False
+            if lines[i + 1].startswith(" "): return False
+            i += 1
+        return False
 
     def _in_header(lines):
         if not lines: return False
@@ -285,10 +303,10 @@ def parse_article(art):
 
         # non-indented TITLE or normal line followed by indented line
         if (not lines[0].startswith(" ")) and next_is_indented(lines):
-            header_headline.append(lines.pop(0))
+            header_headline.append(lines.popleft())
         else:
             while (not lines[0].startswith(" ")) and followed_by_date_block(lines):
-                header_headline.append(lines.pop(0))
+                header_headline.append(lines.popleft())
 
         # check again after possible removal of header_headline
         if not lines: return False
@@ -298,10 +316,10 @@ def parse_article(art):
     def _get_header(lines) -> dict:
         """Consume and return all lines that are indented (ie the list is changed in place)"""
         while _in_header(lines):
-            line = lines.pop(0)
+            line = lines.popleft()
             line = line.strip()
             if line:
-                if re.match('Copyright \d{4}', line):
+                if RES.HEADER_COPYRIGHT.match(line):
                     line = line[len('Copyright xxxx'):]
                 yield line
 
@@ -328,8 +346,8 @@ def parse_article(art):
                 target = byline
             else:
                 target.append(line)
-            del lines[0]
-        return (re.sub("\s+", " ", " ".join(x)) if x else None
+            lines.popleft()
+        return (RES.WHITESPACE.sub(" ", " ".join(x)) if x else None
                 for x in (headline, byline))
 
     def _get_meta(lines, after_body=False) -> Iterable[Tuple[str, str, str]]:
@@ -363,7 +381,7 @@ def parse_article(art):
                     next_line = next_block(lines)
                     if next_line and not RES.BODY_META.match(next_line):
                         break
-            del lines[0]
+            lines.popleft()
             if meta_match:
                 key, val = meta_match.groups()
                 orig_key = key
@@ -376,20 +394,19 @@ def parse_article(art):
                 key = BODY_KEYS_MAP.get(key, key)
                 # multi-line meta: add following non-blank lines
                 while lines and lines[0].strip():
-                    val += " " + lines.pop(0)
-                val = re.sub("\s+", " ", val)
+                    val += " " + lines.popleft()
+                val = RES.WHITESPACE.sub(" ", val)
                 yield orig_key, key, val.strip()
 
     def _get_body(lines):
         """split lines into body and postmatter"""
         # index of headline or end of body
-        try:
-            i = next(i for (i, line) in enumerate(lines) if RES.BODY_END_OR_COPYRIGHT.match(line.strip()))
-            return lines[:i], lines[i:]
-        except StopIteration:
-            return lines, []
+        body = []
+        while lines and not RES.BODY_END_OR_COPYRIGHT.match(lines[0].strip()):
+            body.append(lines.popleft())
+        return body, lines
 
-    lines = _strip_article(art).split("\n")
+    lines = collections.deque(_strip_article(art).split("\n"))
 
     header = list(_get_header(lines))
     if not lines:
@@ -397,12 +414,12 @@ def parse_article(art):
         return
 
     if header_headline:
-        title = re.sub("\s+", " ", " ".join(header_headline)).strip()
+        title = RES.WHITESPACE.sub(" ", " ".join(header_headline)).strip()
         if ";" in title:
             title, byline = [x.strip() for x in title.split(";", 1)]
         else:
             byline = None
-        if re.match("[A-Z]+:", title):
+        if RES.TITLE_PREFIX.match(title):
             title = title.split(":", 1)[1]
     else:
         title, byline = _get_headline(lines)
@@ -470,18 +487,18 @@ def parse_article(art):
 
     def find_re_in(pattern, lines):
         for line in lines:
-            m = re.search(pattern, line)
+            m = pattern.search(line)
             if m: return m
 
     if date is None:
-        yearmatch = find_re_in("(.*)(\d{4})$", header)
+        yearmatch = find_re_in(RES.YEAR, header)
         if yearmatch:
             month, year = yearmatch.groups()
             month = MONTHS.get(month.replace(",", "").strip().lower(), 1)
             date = "{year}-{month:02}-01".format(**locals())
             source = header[0]
             # this is probably a journal, let's see if we can find an issue
-            issuematch = find_re_in("[-\d]+[^\d]+\d+", header)
+            issuematch = find_re_in(RES.ISSUE, header)
             if issuematch:
                 meta['issue'] = issuematch.group(0)
 
@@ -495,13 +512,13 @@ def parse_article(art):
     if dateline is not None and len(header) > dateline + 1:
         # next line might contain time
         timeline = header[dateline + 1]
-        m = re.search(r"\b\d?\d:\d\d\s(PM\b)?", timeline)
+        m = RES.TIME.search(timeline)
         if m and date.time().isoformat() == '00:00:00':
             time = toolkit.read_date("1990-01-01 {}".format(m.group(0)))
             datestr = " ".join([date.isoformat()[:10], m.group(0)])
             date = toolkit.read_date(datestr)
 
-    m = re.match("copyright\s\xa9?\s?(\d{4})?(.*)", source, re.I)
+    m = RES.SOURCE_COPYRIGHT.match(source)
     if m:
         source = m.group(2)
     source = source.strip()
@@ -515,7 +532,7 @@ def parse_article(art):
         if 'headline' in meta and 'title' not in meta:
             meta['title'] = meta.pop('headline')
         if 'title' in meta:
-            title = re.sub("\s+", " ", meta.pop('title')).strip()
+            title = RES.WHITESPACE.sub(" ", meta.pop('title')).strip()
             if ";" in title and not byline:
                 title, byline = [x.strip() for x in title.split(";", 1)]
         else:
@@ -548,12 +565,53 @@ def get_query(header):
             return header[key]
 
 
-def split_file(text):
-    header, body = split_header(text)
-    query = get_query(parse_header(header))
+def _split_documents(lines: Iterator[str]) -> Iterator[str]:
+    """Yield the text of every document, given the lines following the first document count"""
+    document = []
+    for line in lines:
+        if RES.DOCUMENT_COUNT.match(line):
+            yield "\n".join(document) + "\n" if document else ""
+            document = []
+        else:
+            document.append(line)
+
+    # Like split_header does for the whole body, strip trailing whitespace of the last document
+    last = "\n".join(document).rstrip()
+    yield last + "\n" if last else ""
+
+
+def split_lines(lines: Iterable[str]) -> Tuple[Optional[str], Iterator[str]]:
+    """
+    Streaming version of split_file. Reads the header from the given lines (e.g. an open file), and returns
+    the query and an iterator over the documents, which reads the remaining lines as it is consumed. Only
+    the lines of the current document are kept in memory.
+
+    @return: a tuple (query, iterator of document texts)
+    """
+    lines = (line.rstrip("\n") for line in lines)
+    header = []
+    for line in lines:
+        if RES.DOCUMENT_COUNT.match(line):
+            break
+        header.append(line)
+
+    query = get_query(parse_header("\n".join(header).strip()))
+    return query, _split_documents(lines)
+
+
+def read_articles(lines: Iterable[str]) -> Tuple[Optional[str], Iterator[dict]]:
+    """
+    Parse the given lines (e.g. an open file), yielding articles as the lines are read
+
+    @return: a tuple (query, iterator of article dicts as given by parse_article)
+    """
+    query, documents = split_lines(lines)
+    return query, (article for article in map(parse_article, documents) if article)
 
-    fragments = list(split_body(body))
-    return query, fragments
+
+def split_file(text):
+    query, fragments = split_lines(StringIO(text))
+    return query, list(fragments)
 
 
 @UploadPlugin(label="Lexis Nexis", default=True, mime_types=("text/plain",))
@@ -563,14 +621,35 @@ class LexisNexis(UploadScript):
     format with a 'cover page'. The script will extract the metadata (headline, source,
     date etc.) from the file automatically.
     """
+    parallel_parsing = True
+    parallel_state = ("ln_query",)
 
     @classmethod
     def _preprocess(cls, file: django.core.files.uploadedfile.UploadedFile) -> Tuple[any, any]:
-        text = file.read()
-        query, fragments = split_file(text)
-        arts = (parse_article(doc) for doc in fragments)
-        arts = [art for art in arts if art]
-        return query, arts
+        query, arts = read_articles(iter(file.readline, ""))
+        return query, list(arts)
+
+    @classmethod
+    def _get_parse_data(cls, file: django.core.files.uploadedfile.UploadedFile):
+        """
+        Stream the articles from the file while uploading, so only the current article is kept in memory.
+        If the file was preprocessed before (e.g. to get its fields), the cached articles are used instead,
+        which are loaded as a whole.
+        """
+        if os.path.exists(cls._get_cache_filename(file)):
+            return super()._get_parse_data(file)
+
+        def stream(arts):
+            try:
+                yield from arts
+            except Exception as e:
+                raise PreprocessError(file, e)
+
+        try:
+            query, arts = read_articles(iter(file.readline, ""))
+        except Exception as e:
+            raise PreprocessError(file, e)
+        return file, (query, stream(arts))
 
     @classmethod
     @lru_cache()
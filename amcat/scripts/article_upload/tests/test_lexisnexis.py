@@ -7,10 +7,11 @@ import shutil
 from typing import Tuple
 
 from django.core.files import File
+from django.test import override_settings
 
-from amcat.models import ArticleSet
+from amcat.models import Article, ArticleSet
 from amcat.scripts.article_upload.plugins.lexisnexis import (split_header, split_body, parse_header,
-    parse_article, get_query, LexisNexis, split_file)
+    parse_article, get_query, LexisNexis, split_file, read_articles)
 from amcat.scripts.article_upload.tests.test_upload import temporary_zipfile, create_test_upload
 from amcat.scripts.article_upload.upload import UploadForm
 from amcat.tools import amcattest
@@ -149,6 +150,17 @@ class TestLexisNexis(amcattest.AmCATTestCase):
         n_found = len(list(split_body(body)))
         self.assertEqual(n_found, 1)
 
+    def test_read_articles(self):
+        # Streaming gives the same documents as splitting the whole text
+        for file, text in [(self.test_file, self.test_text), (self.test_file2, self.test_text2)]:
+            header, body = split_header(text)
+            query = get_query(parse_header(header))
+            articles = [art for art in map(parse_article, split_body(body)) if art]
+            with open(file, encoding="utf-8") as f:
+                stream_query, stream_articles = read_articles(f)
+                self.assertEqual(stream_query, query)
+                self.assertEqual(list(stream_articles), articles)
+
 
     def get_articleset(self, file):
         project = amcattest.create_test_project()
@@ -197,3 +209,12 @@ class TestLexisNexis(amcattest.AmCATTestCase):
         testfile_n = len(self.test_body_sols)
         testfile2_n = 1
         self.assertEqual(len(arts), testfile_n + testfile2_n)
+
+    @amcattest.use_elastic
+    def test_zip_parallel(self):
+        """Are files parsed in worker processes saved in file order, keeping the query of the last file?"""
+        with override_settings(UPLOAD_PARSE_WORKERS=2), temporary_zipfile([self.test_file2, self.test_file]) as f:
+            aset = self.get_articleset(f)
+        articles = Article.objects.filter(pk__in=aset.get_article_ids()).order_by("id")
+        self.assertEqual([a.title for a in articles[1:]], [a['title'] for a in self.test_body_sols])
+        self.assertIn("LexisNexis query: '(((Japan OR Fukushima)", aset.provenance)
@@ -1,11 +1,13 @@
+import json
 import os
 import zipfile
 from contextlib import contextmanager
 
 from django.core.files.uploadedfile import SimpleUploadedFile
 
+from amcat.models import Article
 from amcat.models.uploadedfile import UploadedFile, upload_storage
-from amcat.scripts.article_upload.upload import UploadScript
+from amcat.scripts.article_upload.upload import UploadScript, UploadForm, PartialUploadError
 from amcat.tools import amcattest
 
 @contextmanager
@@ -36,7 +38,50 @@ def create_test_upload(file, encoding=None, project=None, user=None):
     upload.encoding_override(encoding)
     return upload
 
+class FailingUpload(UploadScript):
+    """Upload script that creates an article per line, and fails on a line reading 'error'"""
+    chunk_size = 2
+
+    def parse_file(self, file, _data):
+        for line in file.read().decode("utf-8").splitlines():
+            if line == "error":
+                raise ValueError("Cannot parse line")
+            yield Article(title=line, text=line, date="2001-01-01")
+
+
+def _run_failing_upload(lines):
+    from tempfile import NamedTemporaryFile
+    project = amcattest.create_test_project()
+    with NamedTemporaryFile(suffix=".txt", mode="w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+        f.flush()
+        upload = create_test_upload(f.name, project=project)
+    field_map = {field: {"type": "field", "value": field} for field in ("title", "text", "date")}
+    form = UploadForm(data={"project": project.id, "field_map": json.dumps(field_map),
+                            "encoding": "utf-8", "upload": upload.id})
+    if not form.is_valid():
+        raise Exception(form.errors)
+    return FailingUpload(form)
+
+
 class TestUpload(amcattest.AmCATTestCase):
+    @amcattest.use_elastic
+    def test_partial_upload(self):
+        """Is an upload that fails after saving a chunk reported as partially imported?"""
+        script = _run_failing_upload(["a", "b", "c", "error", "d"])
+        with self.assertRaises(PartialUploadError) as cm:
+            script.run()
+        aset = script.options['articleset']
+        self.assertEqual(cm.exception.n, 2)
+        self.assertEqual(cm.exception.articleset, aset)
+        self.assertIn("Cannot parse line", str(cm.exception))
+        self.assertEqual({a.title for a in aset.articles.all()}, {"a", "b"})
+        self.assertIn("incomplete", aset.provenance)
+
+        # If nothing was saved, the original error is raised
+        script = _run_failing_upload(["a", "error"])
+        self.assertRaises(ValueError, script.run)
+
     def todo_test_zip_file(self):
         from tempfile import NamedTemporaryFile
         from django.core.files import File
@@ -20,16 +20,21 @@
 """
 Base module for article upload scripts
 """
+import collections
 import datetime
+import itertools
 import json
+from array import array
 import logging
+import multiprocessing
 import os.path
 import zipfile
 from typing import Any, Iterable, Sequence, Tuple, Mapping
 
 import chardet
 from actionform import ActionForm
-from django import forms
+from django import db, forms
+from django.conf import settings
 from django.contrib.postgres.forms import JSONField
 from django.core.files.uploadedfile import UploadedFile
 from django.core.files.utils import FileProxyMixin
@@ -38,7 +43,7 @@ from django.core.serializers.json import DjangoJSONEncoder
 from amcat.forms.widgets import BootstrapSelect
 from amcat.models import Article, ArticleSet, Project, UploadedFile as model_UploadedFile
 from amcat.models.articleset import create_new_articleset
-from amcat.tools import amcates
+from amcat.tools import amcates, amcates_client
 from amcat.tools.progress import NullMonitor
 
 log = logging.getLogger(__name__)
@@ -111,6 +116,17 @@ class FileParseError(Exception):
 class PreprocessError(FileParseError):
     pass
 
+
+class PartialUploadError(Exception):
+    """Raised if an upload failed after some of its articles were already saved (see UploadScript.run)"""
+    def __init__(self, error, n, articleset):
+        self.error = error
+        self.n = n
+        self.articleset = articleset
+        super().__init__("{error} Note: the {n} articles saved before this error were imported into "
+                         "articleset {articleset}.".format(**locals()))
+
+
 class UploadForm(forms.Form):
     upload = forms.ModelChoiceField(queryset=model_UploadedFile.objects.all())
     project = forms.ModelChoiceField(queryset=Project.objects.all())
@@ -187,6 +203,16 @@ class UploadScript(ActionForm):
     """
     form_class = UploadForm
 
+    # Number of articles parsed before they are saved to the database and index
+    chunk_size = 1000
+
+    # Whether the files of an upload can be parsed in worker processes. This requires that _preprocess and
+    # parse_file only depend on the options of the script, and that the articles they return can be pickled.
+    parallel_parsing = False
+
+    # Attributes of the script set by parse_file, which are copied from the worker after parsing a file
+    parallel_state = ()
+
     @classmethod
     def get_fields(cls, upload: model_UploadedFile) -> Sequence[ArticleField]:
         """
@@ -225,7 +251,7 @@ class UploadScript(ActionForm):
         """
         if not cls.has_preprocess():
             return file, None
-        cachefn = file.file.name + "__upload_cache_{}.json".format(cls.__name__)
+        cachefn = cls._get_cache_filename(file)
         log.debug("Cache file {cachefn} exists? {}".format(os.path.exists(cachefn), **locals()))
         try:
             data = json.load(open(cachefn))
@@ -238,24 +264,39 @@ class UploadScript(ActionForm):
             json.dump(data, open(cachefn, "w"), cls=DjangoJSONEncoder, indent=2)
         return file, data
 
+    @classmethod
+    def _get_cache_filename(cls, file: UploadedFile) -> str:
+        return file.file.name + "__upload_cache_{}.json".format(cls.__name__)
+
+    @classmethod
+    def _get_parse_data(cls, file: UploadedFile) -> Tuple[UploadedFile, Any]:
+        """
+        Get the data passed to parse_file when uploading, by default the (cached) preprocessed data. Scripts
+        can override this to stream the articles from the file instead of loading all preprocessed data.
+        @return: A tuple (file, data)
+        """
+        return cls._get_preprocessed(file)
+
     @classmethod
     def has_preprocess(cls):
         return cls._preprocess.__func__ is not UploadScript._preprocess.__func__
 
     @classmethod
-    def _get_files(cls, upload: model_UploadedFile, monitor=NullMonitor()) -> Iterable[Tuple[UploadedFile, Any]]:
+    def _get_files(cls, upload: model_UploadedFile, monitor=NullMonitor(),
+                   parsing=False) -> Iterable[Tuple[UploadedFile, Any]]:
         """
         Get the files to upload, unpacking zip files if needed, and returning preprocessed data if applicable
         @param file: Full file path
         @param encoding: The encoding of the file
         @param monitor: A monitor with progress=0, total=100
+        @param parsing: return the data for parse_file (see _get_parse_data) instead of the preprocessed data
         @return: An iterable of (file, encoding, preprocessed_data_or_None)
         """
         monitor = monitor.submonitor(len(upload), weight=100)
         monitor.update(0, "Unpacking and preprocessing file(s).")
         for file in upload:
             monitor.update()
-            yield cls._get_preprocessed(file)
+            yield cls._get_parse_data(file) if parsing else cls._get_preprocessed(file)
 
 
     def __init__(self, form=None, file=None, **kargs):
@@ -289,6 +330,66 @@ class UploadScript(ActionForm):
         return ("[{timestamp}] Uploaded {n} articles from file {file!r} "
                 "using {self.__class__.__name__}".format(**locals()))
 
+    def _parse_files(self, files, nfiles, filemonitor):
+        """
+        Parse the given files, yielding articles as they are parsed. As articles are saved
+        while parsing, a ParseError is raised as soon as an error has been recorded; articles
+        in chunks saved before that point are kept.
+        """
+        for i, (file, data) in enumerate(files):
+            filemonitor.update(0, "Parsing file {iplus}/{nfiles}: {file.name}".format(iplus=i + 1, **locals()))
+            for article in self.parse_file(file, data):
+                if self.errors:
+                    break
+                _set_project(article, self.project)
+                yield article
+
+            if self.errors:
+                raise ParseError(" ".join(map(str, self.errors)))
+            filemonitor.update(1)
+
+    def _parse_files_parallel(self, upload, nfiles, filemonitor, workers):
+        """
+        Parse the files in worker processes (see parallel_parsing), yielding articles in the order of the files.
+        At most 2 * workers files are parsed ahead of the articles consumed by the caller, so memory use is
+        bounded, and saving the articles of a file overlaps with parsing the next files.
+        """
+        def get_files():
+            for file in upload:
+                # Workers open the file themselves, as a file opened before forking shares its position
+                file.close()
+                yield file.file.name, file.name, getattr(file, "archive_name", None)
+
+        files = get_files()
+        with multiprocessing.Pool(workers, initializer=_init_parse_worker, initargs=(self, upload)) as pool:
+            pending = collections.deque(pool.apply_async(_parse_file_worker, file)
+                                        for file in itertools.islice(files, 2 * workers))
+            i = 0
+            while pending:
+                name, articles, errors, state = pending.popleft().get()
+                for file in itertools.islice(files, 1):
+                    pending.append(pool.apply_async(_parse_file_worker, file))
+
+                i += 1
+                filemonitor.update(0, "Parsed file {i}/{nfiles}: {name}".format(**locals()))
+                self.errors.extend(errors)
+                for attr, value in state.items():
+                    setattr(self, attr, value)
+
+                for article in articles:
+                    if self.errors:
+                        break
+                    _set_project(article, self.project)
+                    yield article
+
+                if self.errors:
+                    raise ParseError(" ".join(map(str, self.errors)))
+                filemonitor.update(1)
+
+    def _add_provenance(self, aset, provenance):
+        aset.provenance = ("%s\n%s" % (aset.provenance or "", provenance)).strip()
+        aset.save()
+
     def run(self):
         upload = self.options['upload']
         upload.encoding_override(self.options['encoding'])
@@ -300,22 +401,31 @@ class UploadScript(ActionForm):
         monitor.update(10, u"Importing {self.__class__.__name__} from {upload.basename} into {self.project}"
                        .format(**locals()))
 
-        articles = []
-        files = self._get_files(upload)
         nfiles = len(upload)
-        filemonitor = monitor.submonitor(nfiles, weight=60)
-        for i, (file, data) in enumerate(files):
-            filemonitor.update(1, "Parsing file {i}/{nfiles}: {file.name}".format(**locals()))
-            articles += list(self.parse_file(file, data))
-
-        for article in articles:
-            _set_project(article, self.project)
+        # Articles are saved while the next ones are parsed, so the progress of both is tracked per file
+        filemonitor = monitor.submonitor(nfiles, weight=110)
+        workers = min(settings.UPLOAD_PARSE_WORKERS, nfiles)
+        if self.parallel_parsing and workers > 1 and not multiprocessing.current_process().daemon:
+            articles = self._parse_files_parallel(upload, nfiles, filemonitor, workers)
+        else:
+            articles = self._parse_files(self._get_files(upload, parsing=True), nfiles, filemonitor)
+        saved = Article.create_articles_streaming(articles, articleset=self.get_or_create_articleset(),
+                                                  chunk_size=self.chunk_size, monitor=filemonitor)
 
-        if self.errors:
-            raise ParseError(" ".join(map(str, self.errors)))
-        monitor.update(10, "All files parsed, saving {n} articles".format(n=len(articles)))
-        Article.create_articles(articles, articleset=self.get_or_create_articleset(),
-                                monitor=monitor.submonitor(40))
+        # Only keep ids of saved articles, so memory does not grow with the article texts
+        articles = array("l")
+        try:
+            for article in saved:
+                articles.append(article.id)
+        except Exception as e:
+            if not articles:
+                raise
+            # The chunks saved before the error are kept, so the upload was partially imported
+            aset = self.options['articleset']
+            log.warning("Upload into {aset} failed after saving {n} articles".format(n=len(articles), **locals()))
+            self._add_provenance(aset, "{} (incomplete, failed with: {})".format(
+                self.get_provenance(upload.basename, articles), e))
+            raise PartialUploadError(e, len(articles), aset) from e
 
         if not articles:
             raise Exception("No articles were imported")
@@ -323,9 +433,7 @@ class UploadScript(ActionForm):
         monitor.update(10, "Uploaded {n} articles, post-processing".format(n=len(articles)))
 
         aset = self.options['articleset']
-        new_provenance = self.get_provenance(upload.basename, articles)
-        aset.provenance = ("%s\n%s" % (aset.provenance or "", new_provenance)).strip()
-        aset.save()
+        self._add_provenance(aset, self.get_provenance(upload.basename, articles))
 
         if getattr(self, 'task', None):
             self.task.log_usage("articles", "upload", n=len(articles))
@@ -393,6 +501,37 @@ class PreprocessScript(ActionForm):
         self.progress_monitor.update(20, "Done")
         return fields
 
+_parse_worker_state = None
+
+
+def _init_parse_worker(script, upload):
+    global _parse_worker_state
+    _parse_worker_state = script, upload
+    # The database connections of the parent cannot be used (or closed) in the worker
+    for connection in db.connections.all():
+        connection.connection = None
+    amcates_client.reset()
+
+
+def _parse_file_worker(path, name, archive_name):
+    """Parse a single file in a worker process (see UploadScript._parse_files_parallel)"""
+    script, upload = _parse_worker_state
+    script.errors = []
+    file = upload._open(path, name)
+    if archive_name is not None:
+        file.archive_name = archive_name
+    try:
+        with file:
+            file, data = script._get_parse_data(file)
+            articles = list(script.parse_file(file, data))
+    except Exception as e:
+        # Exceptions are passed to the parent, but not all of them (or their arguments) can be pickled
+        log.exception("Error parsing {name}".format(**locals()))
+        raise ParseError(str(e)) from None
+    state = {attr: getattr(script, attr, None) for attr in script.parallel_state}
+    return name, articles, script.errors, state
+
+
 def _set_project(art, project):
     try:
         if getattr(art, "project", None) is not None:
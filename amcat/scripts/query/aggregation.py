@@ -338,15 +338,15 @@ class AggregationAction(QueryAction):
             primary, secondary, categories, aggregation = self.get_cache()
         except NotInCacheError:
             self.monitor.update(message="Executing query..")
-            narticles = selection.get_count()
-            self.monitor.update(message="Found {narticles} articles. Aggregating..".format(**locals()))
-
-            # Get aggregation
             order_by = form.cleaned_data["order_by"]
             primary = form.cleaned_data["primary"]
             secondary = form.cleaned_data["secondary"]
             categories = list(filter(None, [primary, secondary]))
-            aggregation = list(selection.get_aggregate(categories, flat=False))
+
+            # Count and aggregate in a single request
+            aggregation, = selection.get_aggregates([categories], flat=False)
+            narticles = selection.get_count()
+            self.monitor.update(message="Found {narticles} articles. Sorting..".format(**locals()))
             aggregation = sorted_aggregation(*order_by, aggregation)
 
             self.set_cache([primary, secondary, categories, aggregation])
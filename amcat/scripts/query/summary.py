@@ -127,6 +127,8 @@ class SummaryAction(QueryAction):
         with Timer() as timer:
             selection = SelectionSearch.get_instance(form)
             self.monitor.update(message="Executing query..")
+            # Fetch count and statistics in a single request
+            selection.get_aggregates(statistics=bool(show_aggregation))
             narticles = selection.get_count()
             self.monitor.update(message="Fetching articles..".format(**locals()))
             try:
@@ -17,42 +17,117 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 import datetime
+import json
+from array import array
+from collections import OrderedDict
 from itertools import count, takewhile
 
 import itertools
+import numpy
 
-__all__ = ("aggregate",)
+__all__ = ("aggregate", "AggregationPlan", "AggregationResult")
 
 
-def flatten(aggregation, categories, categories_values=()):
-    aggregation = iter(categories.pop(0).parse_aggregation_result(aggregation))
+class AggregationResult(object):
+    """
+    Columnar representation of an aggregation. Instead of a list of rows, it stores for every
+    category the list of distinct values, and the counts in a numpy array. Counts are either
+    sparse (codes holds for every row the index of its value in each category) or dense (codes
+    is None, and counts has one axis per category).
+    """
 
-    seen = set()
-    if not categories:
-        for key, aggr in aggregation:
-            if categories_values:
-                seen.add(key)
-            yield [key, aggr["doc_count"]]
-    else:
-        for key, sub in aggregation:
-            values = categories_values[1:] if categories_values else ()
-            flattened = flatten(sub, list(categories), list(values))
-
-            for row in flattened:
-                yield [key] + row
-
-            if categories_values:
-                seen.add(key)
-
-    # Fill zeros
-    if categories_values:
-        not_seen = categories_values[0] - seen
-        missing = [not_seen]
-        missing.extend(categories_values[1:])
-        if missing:
-            for subvals in map(list, itertools.product(*missing)):
-                subvals.append(0)
-                yield subvals
+    def __init__(self, values, codes, counts):
+        """
+        @param values: list with a list of distinct values per category
+        @param codes: (rows x categories) numpy array of indices into values, or None if dense
+        @param counts: numpy array with counts per row, or per combination of values if dense
+        """
+        self.values = values
+        self.codes = codes
+        self.counts = counts
+
+    @classmethod
+    def from_aggregation(cls, aggregation, categories) -> "AggregationResult":
+        """Parse a raw elastic aggregation result of build_aggregate(categories) in a single pass"""
+        values = [[] for _ in categories]
+        indices = [{} for _ in categories]
+        codes, counts = array("q"), array("q")
+        path = [0] * len(categories)
+        last = len(categories) - 1
+
+        def parse(aggregation, depth):
+            category_values, category_indices = values[depth], indices[depth]
+            for key, sub in categories[depth].parse_aggregation_result(aggregation):
+                try:
+                    path[depth] = category_indices[key]
+                except KeyError:
+                    path[depth] = category_indices[key] = len(category_values)
+                    category_values.append(key)
+
+                if depth == last:
+                    codes.extend(path)
+                    counts.append(sub["doc_count"])
+                else:
+                    parse(sub, depth + 1)
+
+        parse(aggregation, 0)
+        codes = numpy.frombuffer(codes, dtype=numpy.int64).reshape(-1, len(categories))
+        return cls(values, codes, numpy.frombuffer(counts, dtype=numpy.int64))
+
+    @property
+    def is_dense(self):
+        return self.codes is None
+
+    @property
+    def shape(self):
+        return tuple(len(v) for v in self.values)
+
+    def to_dense(self) -> numpy.ndarray:
+        """Return counts as an array with an axis per category, filled with zeros for
+        combinations of values that are not present in this aggregation"""
+        if self.is_dense:
+            return self.counts
+        dense = numpy.zeros(self.shape, dtype=numpy.int64)
+        dense[tuple(self.codes.T)] = self.counts
+        return dense
+
+    def fill_zeros(self) -> "AggregationResult":
+        """Return a dense aggregation with a count for every combination of values"""
+        return AggregationResult(self.values, None, self.to_dense())
+
+    def postprocess(self, categories, objects=True) -> "AggregationResult":
+        """Convert values to suitable Python values, and optionally to model objects. As
+        these conversions are done on the distinct values, they are done only once per value."""
+        values = []
+        for category, category_values in zip(categories, self.values):
+            category_values = [category.postprocess(value) for value in category_values]
+            if objects:
+                objs = category.get_objects(category_values)
+                category_values = [category.get_object(objs, value) for value in category_values]
+            values.append(category_values)
+        return AggregationResult(values, self.codes, self.counts)
+
+    def __len__(self):
+        return self.counts.size
+
+    def __iter__(self):
+        """Yield rows of the form (value, [value, ..] count)"""
+        if self.is_dense:
+            rows = itertools.product(*self.values)
+            for row, count in zip(rows, self.counts.ravel().tolist()):
+                yield row + (count,)
+        else:
+            values = self.values
+            columns = [[vals[code] for code in codes] for vals, codes in zip(values, self.codes.T.tolist())]
+            for row in zip(*columns, self.counts.tolist()):
+                yield row
+
+    def to_tuples(self, flat=True) -> list:
+        """Convert to a list of tuples. If flat, rows are (value, [value, ..] count), otherwise
+        ((value, [value, ..]), (count,))"""
+        if flat:
+            return list(self)
+        return [(row[:-1], row[-1:]) for row in self]
 
 
 def build_aggregate(categories):
@@ -68,10 +143,26 @@ def build_aggregate(categories):
 def build_query(query, filters, categories):
     yield "aggregations", build_aggregate(list(categories))
 
+    selection = build_selection(query, filters)
+    if selection is not None:
+        yield "query", selection
+
+
+def build_selection(query, filters):
     if query is not None or filters is not None:
         from amcat.tools.amcates import build_body
         body = build_body(query, filters, query_as_filter=True)
-        yield "query", {"constant_score": dict(body)}
+        return {"constant_score": dict(body)}
+
+
+def postprocess(raw_aggregations, categories, objects=True, flat=True, filter_zeros=False):
+    """Convert a raw aggregation result of build_aggregate(categories) to a list of rows"""
+    aggregation = AggregationResult.from_aggregation(raw_aggregations, categories)
+
+    if not filter_zeros:
+        aggregation = aggregation.fill_zeros()
+
+    return aggregation.postprocess(categories, objects).to_tuples(flat)
 
 
 def aggregate(query=None, filters=None, categories=(), objects=True, es=None, flat=True, filter_zeros=False):
@@ -81,33 +172,110 @@ def aggregate(query=None, filters=None, categories=(), objects=True, es=None, fl
         raise ValueError("You need to specify at least one category.")
 
     body = dict(build_query(query, filters, categories))
-    raw_result = (es or ES()).search(body, size=0)
-    aggregation = list(flatten(raw_result["aggregations"], list(categories)))
+    raw_result = (es or ES()).cached_search(body, size=0)
+    return postprocess(raw_result["aggregations"], categories, objects, flat, filter_zeros)
 
-    if not filter_zeros:
-        values = list(map(set, zip(*aggregation)))[:-1]
-        aggregation = list(flatten(raw_result["aggregations"], list(categories), values))
 
-    # Convert to suitable Python value
-    for i, category in enumerate(categories):
-        for row in aggregation:
-            row[i] = category.postprocess(row[i])
+class AggregationPlan(object):
+    """
+    Plans counts, statistics and aggregations on one or more selections, and executes them
+    in a single round trip to elastic. Requests on the same selection (query and filters) are
+    merged into one search body, with every aggregation nested under its own name. Bodies of
+    different selections are sent in one msearch request.
 
-    # Replace ids with model objects
-    if objects:
-        for i, category in enumerate(categories):
-            pks = [row[i] for row in aggregation]
-            objs = category.get_objects(pks)
-            for row in aggregation:
-                row[i] = category.get_object(objs, row[i])
+        >>> plan = AggregationPlan()
+        >>> count = plan.add_count(query, filters)
+        >>> aggr = plan.add_aggregate(None, filters, [TermCategory(terms)])
+        >>> results = plan.execute()
+        >>> results[count], results[aggr]
+    """
 
-    aggregation = map(tuple, aggregation)
+    def __init__(self, es=None):
+        self.es = es
+        self.selections = OrderedDict()  # selection key -> (selection, [(name, kind, args)])
+        self.n = 0
 
-    if not flat:
-        aggregation = ((row[:-1], row[-1:]) for row in aggregation)
+    def _add(self, query, filters, kind, args=None):
+        selection = build_selection(query, filters)
+        key = json.dumps(selection, sort_keys=True, default=str)
+        requests = self.selections.setdefault(key, (selection, []))[1]
+        name = "{}{}".format(kind, self.n)
+        requests.append((name, kind, args))
+        self.n += 1
+        return name
 
+    def add_count(self, query=None, filters=None):
+        """Plan counting the number of articles in the selection
+        @return: key of this count in the result of execute()"""
+        return self._add(query, filters, "count")
 
-    aggregation = list(aggregation)
+    def add_statistics(self, query=None, filters=None):
+        """Plan computing n, start_date and end_date of the selection (see ES.statistics)
+        @return: key of these statistics in the result of execute()"""
+        return self._add(query, filters, "statistics")
 
-    return aggregation
+    def add_aggregate(self, query=None, filters=None, categories=(), objects=True, flat=True, filter_zeros=False):
+        """Plan an aggregation, with the same arguments as aggregate()
+        @return: key of this aggregation in the result of execute()"""
+        if not categories:
+            raise ValueError("You need to specify at least one category.")
+        return self._add(query, filters, "aggregate", (list(categories), objects, flat, filter_zeros))
+
+    def _get_body(self, selection, requests):
+        aggregations = {}
+        for name, kind, args in requests:
+            if kind == "statistics":
+                aggregations[name] = {"stats": {"field": "date"}}
+            elif kind == "aggregate":
+                # Wrap in a no-op filter to prevent name clashes between aggregations
+                aggregations[name] = {
+                    "filter": {"match_all": {}},
+                    "aggregations": build_aggregate(list(args[0]))
+                }
+
+        body = {"size": 0}
+        if aggregations:
+            body["aggregations"] = aggregations
+        if selection is not None:
+            body["query"] = selection
+        return body
+
+    def _parse_result(self, raw_result, requests):
+        from amcat.tools.amcates import get_statistics_result
+        for name, kind, args in requests:
+            if kind == "count":
+                yield name, raw_result["hits"]["total"]
+            elif kind == "statistics":
+                yield name, get_statistics_result(raw_result["aggregations"][name])
+            else:
+                categories, objects, flat, filter_zeros = args
+                yield name, postprocess(raw_result["aggregations"][name], categories, objects, flat, filter_zeros)
+
+    def execute(self):
+        """Execute all planned requests
+        @return: a dictionary mapping the keys returned by the add_ methods to their results"""
+        from amcat.tools import amcates_cache
+        from amcat.tools.amcates import ES
+
+        es = self.es or ES()
+        selections = list(self.selections.values())
+        bodies = [self._get_body(selection, requests) for selection, requests in selections]
+
+        # Only send bodies not found in the result cache
+        cache_keys = [amcates_cache.get_cache_key(es.index, "search", body) for body in bodies]
+        raw_results = [amcates_cache.get_result(key) for key in cache_keys]
+        todo = [i for i, raw_result in enumerate(raw_results) if raw_result is None]
+
+        if len(todo) == 1:
+            raw_results[todo[0]] = es.search(bodies[todo[0]])
+        elif todo:
+            for i, raw_result in zip(todo, es.msearch([bodies[i] for i in todo])):
+                raw_results[i] = raw_result
+
+        for i in todo:
+            amcates_cache.set_result(cache_keys[i], raw_results[i])
 
+        result = {}
+        for raw_result, (_, requests) in zip(raw_results, selections):
+            result.update(self._parse_result(raw_result, requests))
+        return result
@@ -29,7 +29,7 @@ from django.db import connection
 
 from amcat.models import Coding, CodedArticle
 from amcat.tools.aggregate_orm.categories import TermCategory, SchemafieldCategory
-from amcat.tools.aggregate_orm.sqlobj import JOINS
+from amcat.tools.aggregate_orm.sqlobj import JOINS, ParametrizedStatement, execute_statement
 
 log = logging.getLogger(__name__)
 
@@ -37,7 +37,7 @@ __all__ = ("ORMAggregate",)
 
 
 def merge_aggregations(results):
-    results = [{tuple(row[:-1]): row[-1] for row in aggr} for aggr in results]
+    """Merge mappings of categories to value (one per value) to rows of categories + values"""
     keys = set(itertools.chain.from_iterable(aggr.keys() for aggr in results))
     return [list(key) + list(a.get(key) for a in results) for key in keys]
 
@@ -81,8 +81,7 @@ class ORMAggregate(object):
                 categories[i] = category.copy(self.terms)
 
         # Add global codings filter
-        codings_ids = tuple(self.codings.values_list("id", flat=True)) + (-1,)
-        wheres = ['codings_values.coding_id IN {}'.format(codings_ids)]
+        wheres = ['codings_values.coding_id IN (SELECT coding_id FROM codings_queryset)']
 
         # Gather all separate sql statements
         joins_needed = set()
@@ -104,11 +103,7 @@ class ORMAggregate(object):
                 joins.insert(0, getattr(JOINS, join).format(prefix=""))
                 seen.add(join)
 
-        setups.insert(0, "CREATE TEMPORARY TABLE codings_queryset AS ("
-                         "  SELECT coding_id "
-                         "  FROM codings "
-                         "  WHERE coding_id IN {}"
-                         ")".format(codings_ids))
+        setups[0:0] = self._get_codings_setup_statements()
         teardowns.append('DROP TABLE codings_queryset')
 
         for setup_statement in setups:
@@ -125,23 +120,43 @@ class ORMAggregate(object):
         for teardown_statement in teardowns:
             yield False, teardown_statement
 
-    def _execute_sql(self, queries):
-        results = []
+    def _get_codings_setup_statements(self):
+        """Create the codings_queryset table holding the ids of all codings to aggregate. The
+        codings QuerySet is evaluated by the database, so the ids never leave the server."""
+        sql, params = self.codings.order_by().values("id").query.sql_with_params()
+        yield ParametrizedStatement("CREATE TEMPORARY TABLE codings_queryset AS ({})".format(sql), params)
+        yield "ANALYSE codings_queryset"
+
+    def _stream_sql(self, queries):
+        """Execute the setup statements, query and teardown statements. The rows of the
+        query are streamed from a server side cursor."""
         with connection.cursor() as c:
             for collect_results, query in queries:
-                c.execute(query)
-                if collect_results:
-                    results.extend(map(list, c.fetchall()))
-            return results
-
-    def _execute_sqls(self, queries):
+                if not collect_results:
+                    execute_statement(c, query)
+                elif connection.settings_dict.get("DISABLE_SERVER_SIDE_CURSORS"):
+                    c.execute(query)
+                    yield from c
+                else:
+                    with connection.chunked_cursor() as sc:
+                        sc.execute(query)
+                        yield from sc
+
+    def _execute_sql(self, value__ncategories__queries):
+        """Execute queries for one value, and return a mapping of categories to postprocessed values"""
+        value, num_categories, queries = value__ncategories__queries
+        return {tuple(row[:num_categories]): value.postprocess(list(row[num_categories:]))
+                for row in self._stream_sql(queries)}
+
+    def _execute_sqls(self, values, num_categories, queries):
+        args = list(zip(values, itertools.repeat(num_categories), queries))
         if not self.threaded:
-            return list(map(self._execute_sql, queries))
+            return list(map(self._execute_sql, args))
 
         # Instantiate threadpool and use it to map over queries
         threadpool = ThreadPool(max(4, len(queries)))
         try:
-            return list(threadpool.map(self._execute_sql, queries))
+            return list(threadpool.map(self._execute_sql, args))
         finally:
             threadpool.close()
 
@@ -152,12 +167,7 @@ class ORMAggregate(object):
             value._set_first_field_aggregation(first_field_category)
 
         queries = [list(self._get_aggregate_sql(categories, value)) for value in values]
-        aggregations = list(self._execute_sqls(queries))
-        
-        # Convert to single value / Python type
-        for n, (value, rows) in enumerate(zip(values, aggregations)):
-            for row in rows:
-                row[len(categories):] = [value.postprocess(row[len(categories):])]
+        aggregations = self._execute_sqls(values, len(categories), queries)
 
         # Merge aggregations
         aggregation = list(merge_aggregations(aggregations))
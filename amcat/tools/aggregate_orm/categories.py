@@ -26,7 +26,7 @@ from uuid import uuid4
 
 from amcat.models import ArticleSet, Code, Article
 from amcat.models.coding.codebook import get_tree_levels
-from amcat.tools.aggregate_orm.sqlobj import SQLObject, JOINS
+from amcat.tools.aggregate_orm.sqlobj import SQLObject, JOINS, CopyStatement
 from amcat.tools.amcates import get_property_primitive_type
 
 log = logging.getLogger(__name__)
@@ -255,10 +255,8 @@ class TermCategory(Category):
         sql = "CREATE TEMPORARY TABLE T_{prefix}_terms (article_id int, term int);"
         yield sql.format(prefix=self.prefix)
 
-        values = tuple(self._get_values())
-        if values:
-            sql = "INSERT INTO T_{prefix}_terms (article_id, term) VALUES {values};"
-            yield sql.format(prefix=self.prefix, values=str(values)[1:-1])
+        table = "T_{prefix}_terms".format(prefix=self.prefix)
+        yield CopyStatement(table.lower(), ("article_id", "term"), self._get_values())
 
         # Create index
         sql = "CREATE INDEX T_{prefix}_article_id_index ON T_{prefix}_terms (article_id);"
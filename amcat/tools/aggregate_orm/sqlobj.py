@@ -16,10 +16,38 @@
 # You should have received a copy of the GNU Affero General Public        #
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
+import io
 import uuid
+from collections import namedtuple
+
 from amcat.models import Coding, CodingValue, CodedArticle, Article, CodingJob
 
 
+class ParametrizedStatement(namedtuple("ParametrizedStatement", ["sql", "params"])):
+    """SQL statement with parameters, e.g. the query of a QuerySet"""
+
+    def execute(self, cursor):
+        cursor.execute(self.sql, self.params)
+
+
+class CopyStatement(namedtuple("CopyStatement", ["table", "columns", "rows"])):
+    """Fill a (temporary) table with rows of numbers using COPY. This is much faster than
+    INSERTing a literal list of values, which also blows up the size of the SQL text."""
+
+    def execute(self, cursor):
+        data = "".join("\t".join(map(str, row)) + "\n" for row in self.rows)
+        cursor.copy_from(io.StringIO(data), self.table, columns=self.columns)
+
+
+def execute_statement(cursor, statement):
+    """Execute a setup / teardown statement, which is either an SQL string or an object
+    with an execute(cursor) method"""
+    if isinstance(statement, str):
+        cursor.execute(statement)
+    else:
+        statement.execute(cursor)
+
+
 class SQLObject(object):
     joins_needed = []
 
@@ -29,7 +57,8 @@ class SQLObject(object):
     def get_setup_statements(self):
         """Yield sql statements which should be executed before the aggregation
         begins. This could be used to create and populate temporary tables and
-        indices."""
+        indices. Statements are strings, or ParametrizedStatement / CopyStatement
+        objects."""
         return ()
 
     def get_teardown_statements(self):
@@ -16,7 +16,7 @@
 # You should have received a copy of the GNU Affero General Public        #
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
-import copy
+import collections
 import datetime
 import functools
 import io
@@ -24,22 +24,25 @@ import logging
 import os
 import re
 import pprint
+import time
 
+from array import array
 from collections import namedtuple
 from hashlib import sha224 as hash_class
 from json import dumps as serialize
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import Future
 from types import MappingProxyType
-from typing import Union
+from typing import Union, Deque, Tuple, Dict, List, Optional
 
 from django.conf import settings
-from elasticsearch import Elasticsearch, NotFoundError
-from elasticsearch.helpers import bulk, scan
+from elasticsearch import Elasticsearch, NotFoundError, TransportError
+from elasticsearch.helpers import scan
 
 import amcat.models
-from amcat.tools import queryparser, toolkit
+from amcat.tools import amcates_cache, amcates_client, queryparser, toolkit
 from amcat.tools.caching import cached
 from amcat.tools.hashing import Digest
+from amcat.tools.idset import IdSet
 from amcat.tools.progress import NullMonitor
 from amcat.tools.toolkit import multidict, splitlist
 
@@ -161,10 +164,30 @@ def get_properties(article: "amcat.models.Article"):
         yield k, _clean(v)
 
 
+def _get_raw_fields(article) -> dict:
+    fields = {field_name: getattr(article, field_name) for field_name in ARTICLE_FIELDS}
+    # Copy sets, so changing them in place invalidates the cached article dict
+    fields.update((k, set(v) if isinstance(v, set) else v) for k, v in article.properties.items())
+    return fields
+
+
 def get_article_dict(article, sets=None):
-    d = {field_name: _clean(getattr(article, field_name)) for field_name in ARTICLE_FIELDS}
-    d.update(get_properties(article))
-    d['hash'] = _hash_dict(d)
+    """
+    Return the elastic document for the given article. Cleaning the fields and computing the hash
+    are done once: the result is cached on the article, and reused as long as its fields do not
+    change (e.g. by compute_hash during deduplication and again when indexing).
+    """
+    raw = _get_raw_fields(article)
+    cached = getattr(article, "_article_dict", None)
+    if cached is not None and cached[0] == raw:
+        d = dict(cached[1])
+    else:
+        d = {k: _clean(v) for k, v in raw.items()}
+        d['hash'] = _hash_dict(d)
+        try:
+            article._article_dict = (raw, dict(d))
+        except AttributeError:
+            pass  # e.g. objects with __slots__
     d['id'] = article.id
     d["sets"] = sets
     return d
@@ -175,20 +198,23 @@ def _escape_bytes(b):
 
 
 def _hash_dict(d):
-    c = hash_class()
+    # Fields are joined in a single buffer, which is hashed in one call
+    parts = []
     for fn in sorted(d.keys()):
-        c.update(_escape_bytes(_encode_field(fn)))
-        c.update(_escape_bytes(_encode_field(d[fn])))
-        c.update(b",")
-    return c.hexdigest()
+        parts.append(_escape_bytes(fn.encode("utf-8")))
+        parts.append(_escape_bytes(_field_to_str(d[fn]).encode("utf-8")))
+        parts.append(b",")
+    return hash_class(b"".join(parts)).hexdigest()
 
 
-def _encode_field(object, encoding="utf-8"):
-    if isinstance(object, datetime.datetime):
-        return object.isoformat().encode(encoding)
+def _field_to_str(object):
+    if isinstance(object, str):
+        return object
+    elif isinstance(object, datetime.datetime):
+        return object.isoformat()
     elif isinstance(object, datetime.date):
-        return datetime.datetime(object.year, object.month, object.day).isoformat().encode(encoding)
-    return str(object).encode(encoding)
+        return datetime.datetime(object.year, object.month, object.day).isoformat()
+    return str(object)
 
 
 HIGHLIGHT_OPTIONS = {
@@ -209,8 +235,15 @@ HIGHLIGHT_OPTIONS = {
 }
 
 LEAD_SCRIPT_FIELD = {"file": "amcat_lead", "lang": "groovy"}
-UPDATE_SCRIPT_REMOVE_FROM_SET = {"file": "amcat_remove_from_set", "lang": "groovy"}
-UPDATE_SCRIPT_ADD_TO_SET = {"file": "amcat_add_to_set", "lang": "groovy"}
+UPDATE_SCRIPT_REMOVE_FROM_SET = {
+    "inline": "if (ctx._source.sets != null) {ctx._source.sets.removeIf(s -> s == params.set)}",
+    "lang": "painless"
+}
+UPDATE_SCRIPT_ADD_TO_SET = {
+    "inline": "def s = ctx._source; if (s.sets == null) {s.sets = [params.set]} "
+              "else if (!s.sets.contains(params.set)) {s.sets.add(params.set)}",
+    "lang": "painless"
+}
 
 
 def _get_bulk_body(articles, action):
@@ -223,6 +256,33 @@ def get_bulk_body(articles, action="index"):
     return "\n".join(_get_bulk_body(articles, action)) + "\n"
 
 
+# A document that could not be indexed by a bulk request
+BulkError = namedtuple("BulkError", ["id", "status", "error"])
+
+
+def sum_property_counts_deltas(deltas, exclude=()) -> Dict[int, collections.Counter]:
+    """
+    Combine the changes in property counters per article (see _ES._get_property_counts_deltas) to
+    changes per set, leaving out the given article ids (e.g. of articles that could not be indexed)
+    """
+    result = collections.defaultdict(collections.Counter)
+    for article_id, delta in deltas.items():
+        if article_id not in exclude:
+            for setid, counts in delta.items():
+                result[setid].update(counts)
+    return result
+
+
+def get_bulk_errors(response, action="index"):
+    """Yield a BulkError for every item in the given es.bulk response that failed"""
+    if not response["errors"]:
+        return
+    for item in response["items"]:
+        item = item[action]
+        if "error" in item:
+            yield BulkError(int(item["_id"]), item["status"], item["error"])
+
+
 class SearchResult(object):
     """Iterable collection of results that also has total"""
 
@@ -331,7 +391,13 @@ class _ES(object):
         self.port = port
         self.index = index
         self.doc_type = doc_type
-        self.es = Elasticsearch(hosts=[{"host": self.host, "port": self.port}, ], timeout=timeout, **args)
+        self.timeout = timeout
+        self.args = args
+
+    @property
+    def es(self) -> Elasticsearch:
+        """The (process wide, thread safe) client for this host"""
+        return amcates_client.get_client(self.host, self.port, self.timeout, **self.args)
 
     def check_properties(self, properties):
         """
@@ -357,7 +423,8 @@ class _ES(object):
 
     def get_mapping(self):
         m = self.es.indices.get_mapping(self.index, self.doc_type)
-        return m[self.index]['mappings'][self.doc_type]['properties']
+        # The response is keyed by the concrete index, which is not self.index if that is an alias
+        return next(iter(m.values()))['mappings'][self.doc_type]['properties']
 
     def get_properties(self):
         self.check_index()
@@ -366,6 +433,22 @@ class _ES(object):
     def refresh(self):
         self.es.indices.refresh()
 
+    def refresh_sets(self, *articleset_ids, wait_for_visibility=None):
+        """
+        Invalidate cached results on the given articlesets after changing them. Unless wait_for_visibility
+        is set, this does not refresh the index: the changes become visible with the next periodic
+        refresh of elastic (every ES_REFRESH_INTERVAL seconds), which coalesces the refreshes of
+        many small changes. Results on these sets are not cached until then.
+
+        @param wait_for_visibility: refresh the index, so changes are visible when this method returns.
+                                    Defaults to settings.ES_WAIT_FOR_VISIBILITY.
+        """
+        if wait_for_visibility is None:
+            wait_for_visibility = settings.ES_WAIT_FOR_VISIBILITY
+        if wait_for_visibility:
+            self.refresh()
+        amcates_cache.bump_generation(*articleset_ids, visible=wait_for_visibility)
+
     def highlight_article(self, aid: int, query: str) -> dict:
         """Highlight article given by an article id using a Lucene query. The resulting strings
         are safe to insert into an HTML document even if the original document contained malicious
@@ -385,8 +468,10 @@ class _ES(object):
         self.es.indices.clear_cache()
 
     def delete_index(self):
+        amcates_cache.bump_generation(amcates_cache.INDEX_GENERATION)
         try:
-            self.es.indices.delete(self.index)
+            # If the index is an alias, delete the (versioned) indices it points to
+            self.es.indices.delete(",".join(self.get_aliased_indices()) or self.index)
         except NotFoundError:
             pass
         except Exception as e:
@@ -397,7 +482,8 @@ class _ES(object):
     def create_index(self, shards=5, replicas=1):
         es_settings = settings.ES_SETTINGS.copy()
         es_settings.update({"number_of_shards": shards,
-                            "number_of_replicas": replicas})
+                            "number_of_replicas": replicas,
+                            "refresh_interval": "{}ms".format(int(settings.ES_REFRESH_INTERVAL * 1000))})
 
         body = {
             "settings": es_settings,
@@ -408,6 +494,30 @@ class _ES(object):
 
         self.es.indices.create(self.index, body)
 
+    def get_aliased_indices(self) -> list:
+        """Return the (versioned) indices self.index is an alias of, or [self.index] if it is a concrete index"""
+        if self.es.indices.exists_alias(name=self.index):
+            return sorted(self.es.indices.get_alias(name=self.index))
+        return [self.index] if self.es.indices.exists(self.index) else []
+
+    def swap_alias(self, new_index) -> list:
+        """
+        Atomically point the alias self.index to new_index. If self.index is still a concrete index,
+        it is deleted in the same request, as an alias cannot have the name of an existing index.
+
+        @return: the indices the alias pointed to before, which are not deleted
+        """
+        old = [] if not self.es.indices.exists_alias(name=self.index) else self.get_aliased_indices()
+        actions = [{"remove": {"index": index, "alias": self.index}} for index in old]
+        if not old and self.es.indices.exists(self.index):
+            actions.append({"remove_index": {"index": self.index}})
+        actions.append({"add": {"index": new_index, "alias": self.index}})
+
+        log.info("Pointing alias {self.index} to {new_index}, actions: {actions}".format(**locals()))
+        self.es.indices.update_aliases(body={"actions": actions})
+        amcates_cache.bump_generation(amcates_cache.INDEX_GENERATION)
+        return [index for index in old if index != new_index]
+
     def check_index(self):
         """
         Check whether the server is up and the index exists.
@@ -466,6 +576,33 @@ class _ES(object):
             log.debug("Search with body:\n {}".format(pprint.pformat(body)))
         return self.es.search(body=body, **kargs)
 
+    def cached_search(self, body, **options):
+        """
+        Perform a 'raw' search, using the shared result cache if the search is restricted to
+        one or more articlesets. Use this only for counts and aggregations, i.e. with size=0.
+        """
+        return amcates_cache.cached(self.index, "search", body, lambda: self.search(body, **options), **options)
+
+    def msearch(self, bodies, **options):
+        """
+        Perform multiple 'raw' searches on the underlying ES index in a single request
+
+        @param bodies: sequence of search bodies
+        @return: list of search results, in order of bodies
+        """
+        header = {"index": self.index, "type": self.doc_type}
+        request = []
+        for body in bodies:
+            request.extend((header, body))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Multi-search with bodies:\n {}".format(pprint.pformat(bodies)))
+
+        responses = self.es.msearch(body=request, **options)["responses"]
+        for response in responses:
+            if "error" in response:
+                raise TransportError(response.get("status", 500), "search_phase_execution_exception", response["error"])
+        return responses
+
     def scan(self, query, **kargs):
         """
         Perform a scan query on the es index
@@ -494,6 +631,44 @@ class _ES(object):
                 return
             yield int(a['_id'])
 
+    def _query_ids_slice(self, body__slice):
+        body, slice_id, max_slices = body__slice
+        if max_slices > 1:
+            body = dict(body, slice={"id": slice_id, "max": max_slices})
+
+        ids = array("l")
+        for hit in scan(self.es, query=body, index=self.index, doc_type=self.doc_type, size=1000, _source=False):
+            ids.append(int(hit['_id']))
+        return ids
+
+    def query_ids_array(self, query=None, filters=EMPTY_RO_DICT, body=None, slices=1) -> array:
+        """
+        Query the index returning the ids of all matched articles as a compact (unsorted) array of
+        integers, which takes 8 bytes per id instead of the ~70 needed for an int in a set. See
+        query_ids for the meaning of query, filters and body.
+
+        @param slices: split the scroll in this number of elastic slices, which are read in parallel. If None,
+                       the matches are counted first and settings.ES_SCROLL_SLICES slices are used if there
+                       are at least settings.ES_SCROLL_SLICES_MIN_HITS of them.
+        """
+        if body is None:
+            body = dict(build_body(query, filters, query_as_filter=True))
+
+        if slices is None:
+            n = self._count({"query": {"constant_score": body}})["count"]
+            slices = settings.ES_SCROLL_SLICES if n >= settings.ES_SCROLL_SLICES_MIN_HITS else 1
+
+        if slices <= 1:
+            return self._query_ids_slice((body, 0, 1))
+
+        executor = amcates_client.get_executor()
+        results = executor.map(self._query_ids_slice, [(body, i, slices) for i in range(slices)])
+
+        ids = array("l")
+        for result in results:
+            ids.extend(result)
+        return ids
+
     def query(self, query=None, filters=EMPTY_RO_DICT, highlight=False, lead=False, _source=(), score=True, **kwargs):
         """
         Execute a query for the given fields with the given query and filter
@@ -520,22 +695,109 @@ class _ES(object):
         result = self.search(body, _source=_source, **kwargs)
         return SearchResult(result, _source, score, body, query=query)
 
-    def query_all(self, *args, **kargs):
-        kargs.update({"from_": 0})
-        size = kargs.setdefault('size', 10000)
-        result = self.query(*args, **kargs)
-        total = result.total
-        for offset in range(size, total, size):
-            kargs['from_'] = offset
-            result2 = self.query(*args, **kargs)
-            result.hits += result2.hits
+    def query_all(self, query=None, filters=EMPTY_RO_DICT, _source=(), score=True, size=1000, **kwargs):
+        """
+        Execute a query for all matching documents. Documents are fetched using a single scroll
+        stream of pages of the given size, and yielded as Result objects as they arrive, so there
+        is no limit on the number of hits and they need not be kept in memory.
+        @param query: a elastic query string (i.e. lucene syntax, e.g. 'piet AND (ja* OR klaas)')
+        @param filters: field filter DSL query dict, defaults to build_filter(**filters)
+        @param score: if True, calculate the score of each document (returned as result.score)
+        @param size: number of documents to fetch per scroll request
+        @param kwargs: additional keyword arguments to pass to scan, e.g. scroll
+        @return: a generator of Result objects containing id, score, and the requested fields
+        """
+        body = dict(build_body(query, filters, query_as_filter=not score))
+        if score:
+            # Scroll sorts on _doc, which does not compute scores unless told to
+            body['track_scores'] = True
+
+        for hit in self.scan(body, size=size, _source=_source, **kwargs):
+            yield Result.from_hit(None, hit, _source, score)
+
+    def _get_properties_aggregation(self, properties):
+        """Filters aggregation counting documents with each of the given properties"""
+        return {"filters": {"filters": {prop: {"exists": {"field": prop}} for prop in properties}}}
+
+    def _parse_properties_aggregation(self, aggregation) -> collections.Counter:
+        return collections.Counter({prop: bucket["doc_count"] for prop, bucket in aggregation["buckets"].items()
+                                    if bucket["doc_count"]})
+
+    def count_properties(self, selection=None, properties=None) -> collections.Counter:
+        """
+        Count the number of documents having each flexible property in a single request, using a
+        filters aggregation with an exists filter per property.
+
+        @param selection: filter DSL (e.g. from build_filter), or None to count the whole index
+        @param properties: properties to count, defaults to all flexible properties
+        @return: a Counter of property name to number of documents (only if > 0)
+        """
+        if properties is None:
+            properties = set(self.get_properties()) - ALL_FIELDS
+        if not properties:
+            return collections.Counter()
+
+        return self._count_properties(selection, properties)[1]
+
+    def _count_properties(self, selection, properties) -> Tuple[int, collections.Counter]:
+        """Return the number of documents in the selection, and a Counter of the given properties"""
+        body = {}
+        if properties:
+            body["aggregations"] = {"properties": self._get_properties_aggregation(properties)}
+        if selection is not None:
+            body["query"] = {"constant_score": {"filter": selection}}
+
+        result = self.search(body, size=0)
+        counts = collections.Counter()
+        if properties:
+            counts = self._parse_properties_aggregation(result["aggregations"]["properties"])
+        return result["hits"]["total"], counts
+
+    def _get_indexed_properties(self, article_ids, properties) -> Dict[int, Tuple[List[int], List[str]]]:
+        """
+        Get the sets and which of the given properties the given articles have in the index. This uses a
+        realtime mget rather than a search, so articles that were indexed or changed but not yet refreshed
+        are included as well.
 
+        @return: a mapping of article id to a tuple of (set ids, properties), for articles in the index
+        """
+        result = {}
+        if not properties or not article_ids:
+            return result
+
+        for batch in splitlist(list(article_ids), itemsperbatch=10000):
+            response = self.es.mget(index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE, body={"ids": batch},
+                                    _source=["sets"] + sorted(properties), realtime=True)
+            for doc in response['docs']:
+                if doc['found']:
+                    source = doc['_source']
+                    props = [prop for prop in properties if source.get(prop) not in (None, [])]
+                    result[int(doc['_id'])] = (source.get("sets") or [], props)
         return result
 
-    def _get_used_properties(self, body__prop):
-        body, prop = body__prop
-        body["query"]["bool"]["must"][1]["exists"]["field"] = prop
-        return bool(self.es.count(index=self.index, doc_type=self.doc_type, body=body)['count'])
+    def _get_property_counts_deltas(self, dicts, properties, new=False) -> Dict[int, Dict[int, collections.Counter]]:
+        """
+        Compute the changes in the property counters of sets caused by (re)indexing the given article
+        dicts, per article. Must be called before indexing, as the current state of the articles is
+        subtracted. See sum_property_counts_deltas to combine the changes of the articles that were indexed.
+
+        @param properties: all flexible properties in the index
+        @param new: the articles are not in the index yet (e.g. they were just created), so there is
+                    no current state to look up
+        @return: a mapping of article id to a mapping of set id to the change in count per property
+        """
+        old = {} if new else self._get_indexed_properties([d["id"] for d in dicts], properties)
+        deltas = {}
+        for d in dicts:
+            delta = collections.defaultdict(collections.Counter)
+            props = [k for k, v in d.items() if k not in ALL_FIELDS and v is not None]
+            for setid in d.get("sets") or ():
+                delta[setid].update(props)
+            old_sets, old_props = old.get(d["id"], ((), ()))
+            for setid in old_sets:
+                delta[setid].subtract(old_props)
+            deltas[d["id"]] = delta
+        return deltas
 
     def get_used_properties(self, set_ids=None, article_ids=None, **filters):
         """
@@ -547,24 +809,7 @@ class _ES(object):
         if article_ids is not None:
             filters["ids"] = article_ids
 
-        all_properties = self.get_properties()
-        flexible_properties = set(all_properties) - set(ALL_FIELDS)
-
-        body = {"query": {"bool": {"must": [
-            build_filter(**filters),
-            {"exists": {"field": "fakeprop"}}
-        ]}}}
-
-        bodies = (copy.deepcopy(body) for _ in range(len(flexible_properties)))
-        pool = ThreadPool()
-        results = pool.imap(self._get_used_properties, zip(bodies, flexible_properties))
-
-        try:
-            for found, prop in zip(results, flexible_properties):
-                if found:
-                    yield prop
-        finally:
-            pool.close()
+        return iter(self.count_properties(build_filter(**filters)))
 
     def add_articles(self, article_ids, batch_size=1000):
         """
@@ -576,42 +821,114 @@ class _ES(object):
         from amcat.models import Article, ArticleSetArticle
 
         n = len(article_ids) // batch_size
+        sets = set()
         for i, batch in enumerate(splitlist(article_ids, itemsperbatch=batch_size)):
             log.info("Adding batch {i}/{n}".format(**locals()))
             all_sets = multidict((aa.article_id, aa.articleset_id)
                                  for aa in ArticleSetArticle.objects.filter(article__in=batch))
             dicts = (get_article_dict(article, list(all_sets.get(article.id, [])))
                      for article in Article.objects.filter(pk__in=batch))
-            self.bulk_insert(dicts, batch_size=None)
+            self.bulk_insert(dicts, batch_size=None, refresh=False)
+            sets.update(*all_sets.values())
+        self.refresh_sets(*sets)
 
-    def remove_from_set(self, setid, article_ids, flush=True):
-        """Remove the given articles from the given set. This is done in batches, so there
-        is no limit on the length of article_ids (which can be a generator)."""
-        if not article_ids: return
-        for batch in splitlist(article_ids, itemsperbatch=1000):
-            self.bulk_update(batch, UPDATE_SCRIPT_REMOVE_FROM_SET, params={'set': setid})
+    def remove_from_set(self, setid, article_ids=None, monitor=NullMonitor(), batch_size=10000,
+                        requests_per_second=None):
+        """
+        Remove the given articles from the given set, using update_by_query on batches of batch_size
+        ids, so there is no limit on the length of article_ids (which can be a generator). If article_ids
+        is None, all articles are removed from the set by a single server side task, without fetching
+        their ids.
 
-    def add_to_set(self, setid, article_ids, monitor=NullMonitor()):
-        """Add the given articles to the given set. This is done in batches, so there
-        is no limit on the length of article_ids (which can be a generator)."""
+        @param requests_per_second: throttle the updates, defaults to settings.ES_TASK_REQUESTS_PER_SECOND
+        """
+        if article_ids is None:
+            # Articles indexed (or added to the set) after the last refresh would not be updated
+            self.refresh()
+            self.run_task("update_by_query", build_filter(sets=setid), monitor=monitor,
+                          script=dict(UPDATE_SCRIPT_REMOVE_FROM_SET, params={'set': setid}),
+                          requests_per_second=requests_per_second)
+            amcates_cache.set_property_counts(setid, {})
+            return
 
+        batches = list(splitlist(article_ids, itemsperbatch=batch_size))
+        monitor = monitor.submonitor(total=max(1, len(batches)))
+        if not batches:
+            monitor.update()
+            return
+
+        properties = self.get_properties() - ALL_FIELDS
+        script = dict(UPDATE_SCRIPT_REMOVE_FROM_SET, params={'set': setid})
+        options = self._get_task_options(requests_per_second)
+        refreshed = False
+        nbatches = len(batches)
+        for i, batch in enumerate(batches):
+            monitor.update(message="Removing batch {iplus}/{nbatches}..".format(iplus=i + 1, nbatches=nbatches))
+            selection = build_filter(ids=batch, sets=setid)
+            # Decrement property counters by the properties of articles actually in this set
+            n, removed = self._count_properties(selection, properties)
+            if n < len(batch) and not refreshed:
+                # Some articles might have been indexed (or added to the set) after the last refresh,
+                # and would not be found by the count nor by update_by_query
+                self.refresh()
+                refreshed = True
+                n, removed = self._count_properties(selection, properties)
+            if n:
+                self.update_by_query(selection, script, **options)
+                amcates_cache.update_property_counts({setid: {prop: -n for prop, n in removed.items()}})
+
+    def add_to_set(self, setid, article_ids, monitor=NullMonitor(), batch_size=10000):
+        """
+        Add the given articles to the given set. Articles already in the set are skipped based on a
+        single (sliced) scroll over the set, and the others are updated in batches of batch_size with
+        an update_by_query on their ids. There is no limit on the length of article_ids (which can be
+        a generator). Articles that are not in the index at all are indexed.
+        """
         if not article_ids:
             if monitor:
                 monitor.update()
             return
 
-        batches = [set(batch) for batch in splitlist(article_ids, itemsperbatch=1000)]
-        monitor = monitor.submonitor(total=len(batches))
+        article_ids = IdSet(article_ids)
+        # Skip articles already in the set. For a few articles, only their own membership is checked
+        # rather than scrolling through the whole set.
+        in_set = {"sets": [setid]}
+        if len(article_ids) <= batch_size:
+            in_set["ids"] = list(article_ids)
+        to_add = article_ids - IdSet(self.query_ids_array(filters=in_set, slices=None))
+        batches = list(splitlist(to_add, itemsperbatch=batch_size))
+        monitor = monitor.submonitor(total=max(1, len(batches)))
+        if not batches:
+            monitor.update()
+            return
+
+        properties = self.get_properties() - ALL_FIELDS
+        script = dict(UPDATE_SCRIPT_ADD_TO_SET, params={'set': setid})
+        refreshed = False
 
         nbatches = len(batches)
         for i, batch in enumerate(batches):
             monitor.update(message="Adding batch {iplus}/{nbatches}..".format(iplus=i + 1, nbatches=nbatches))
-            missing = batch - set(self.in_index(batch))
-            if missing:
-                logging.warning("Adding {} missing articles to elastic".format(len(missing)))
-                self.add_articles(missing)
-            if batch - missing:
-                self.bulk_update(batch - missing, UPDATE_SCRIPT_ADD_TO_SET, params={'set': setid})
+            selection = {"bool": {"filter": build_filter(ids=batch), "must_not": {"terms": {"sets": [setid]}}}}
+
+            # Count properties of the articles before adding them, to increment the property counters
+            n, added = self._count_properties(selection, properties)
+            if n < len(batch) and not refreshed:
+                # Some articles might have been indexed (or added to the set) after the last refresh
+                self.refresh()
+                refreshed = True
+                n, added = self._count_properties(selection, properties)
+
+            missing = ()
+            if n < len(batch):
+                missing = set(batch) - set(self.in_index(batch))
+                if missing:
+                    log.warning("Adding {} missing articles to elastic".format(len(missing)))
+                    self.add_articles(missing)
+
+            if n:
+                self.update_by_query(selection, script)
+                amcates_cache.update_property_counts({setid: added})
 
     def get_tokens(self, aid: int, fields=["text", "title"]):
         """
@@ -629,24 +946,140 @@ class _ES(object):
                     for token in info['tokens']:
                         yield field, token['position'], term
 
-    def bulk_insert(self, dicts, batch_size=1000, monitor=NullMonitor()):
+    def bulk_insert(self, dicts, batch_size=1000, monitor=NullMonitor(), refresh=True, new=False):
         """
         Bulk insert the given articles in batches of batch_size
+
+        @param refresh: invalidate cached results on the sets of the articles afterwards (see refresh_sets)
+        @param new: the articles are not in the index yet, so their current state is not looked up to
+                    update the property counters (see _get_property_counts_deltas)
         """
-        batches = list(toolkit.splitlist(dicts, itemsperbatch=batch_size)) if batch_size else [dicts]
+        batches = list(toolkit.splitlist(dicts, itemsperbatch=batch_size)) if batch_size else [list(dicts)]
         monitor = monitor.submonitor(total=len(batches))
         nbatches = len(batches)
+        properties = self.get_properties() - ALL_FIELDS
+        sets = set()
         for i, batch in enumerate(batches):
             monitor.update(1, "Adding batch {iplus}/{nbatches}".format(iplus=i + 1, **locals()))
             props, articles = set(), {}
             for d in batch:
                 props |= (set(d.keys()) - ALL_FIELDS)
                 articles[d["id"]] = serialize(d)
+                sets.update(d.get("sets") or ())
             self.check_properties(props)
+            properties |= props
+            deltas = self._get_property_counts_deltas(batch, properties, new=new)
             body = get_bulk_body(articles)
             resp = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
+            # Only articles that were indexed change the property counters
+            failed = {error.id for error in get_bulk_errors(resp)}
+            amcates_cache.update_property_counts(sum_property_counts_deltas(deltas, exclude=failed))
             if resp["errors"]:
                 raise ElasticSearchError(resp)
+        if refresh:
+            self.refresh_sets(*sets)
+
+    def _get_bulk_chunks(self, dicts, max_chunk_bytes, max_chunk_docs, count_properties=True, new=False):
+        """
+        Serialize the given article dicts to bulk bodies of at most max_chunk_bytes bytes (and
+        max_chunk_docs documents), adding mappings for new properties before they are yielded.
+        @param count_properties: compute the changes in the property counters of the sets of the articles
+        @param new: the articles are not in the index yet (see _get_property_counts_deltas)
+        @return: a sequence of (ndocs, body, deltas) tuples, with deltas the changes in the property counters
+                 per article (or None if not count_properties), to be applied once the chunk is indexed
+        """
+        known_properties = self.get_properties()
+        lines, chunk, nbytes = [], [], 0
+
+        def get_chunk():
+            # The changes are computed before the chunk is sent, as the old state of the articles is needed
+            deltas = None
+            if count_properties:
+                deltas = self._get_property_counts_deltas(chunk, known_properties - ALL_FIELDS, new=new)
+            return len(chunk), "\n".join(lines) + "\n", deltas
+
+        for d in dicts:
+            new_properties = set(d.keys()) - ALL_FIELDS - known_properties
+            if new_properties:
+                self.add_properties(new_properties)
+                known_properties |= new_properties
+
+            # serialize() escapes non-ascii characters, so len() is the number of bytes
+            action, source = serialize({"index": {"_id": d["id"]}}), serialize(d)
+            size = len(action) + len(source) + 2
+            if lines and (nbytes + size > max_chunk_bytes or len(chunk) >= max_chunk_docs):
+                yield get_chunk()
+                lines, chunk, nbytes = [], [], 0
+
+            lines.extend((action, source))
+            chunk.append(d)
+            nbytes += size
+
+        if lines:
+            yield get_chunk()
+
+    def _send_bulk_chunk(self, body):
+        resp = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
+        return list(get_bulk_errors(resp))
+
+    def parallel_bulk_insert(self, dicts, concurrency=None, max_chunk_bytes=None,
+                             max_chunk_docs=None, monitor=NullMonitor(), count_properties=True, refresh=True,
+                             new=False):
+        """
+        Bulk insert the given articles, serializing the next chunks while at most `concurrency`
+        earlier chunks are being indexed. Chunks are sized by bytes rather than by number of
+        documents, so dicts can be a (long) generator.
+
+        @param concurrency: number of bulk requests in flight, defaults to settings.ES_BULK_CONCURRENCY
+        @param max_chunk_bytes: maximum size of a single bulk request, defaults to settings.ES_BULK_MAX_BYTES
+        @param max_chunk_docs: maximum number of documents in a single bulk request
+        @param count_properties: update the property counters of the sets of the articles
+        @param refresh: invalidate cached results on the sets of the articles afterwards (see refresh_sets)
+        @param new: the articles are not in the index yet, so their current state is not looked up to
+                    update the property counters (see _get_property_counts_deltas)
+        @return: a list of BulkError objects for documents that could not be indexed
+        """
+        concurrency = concurrency or settings.ES_BULK_CONCURRENCY
+        max_chunk_bytes = max_chunk_bytes or settings.ES_BULK_MAX_BYTES
+        max_chunk_docs = max_chunk_docs or settings.ES_BULK_MAX_DOCS
+
+        errors, ndone = [], 0
+        pending = collections.deque()  # type: Deque[Tuple[int, Optional[dict], Future]]
+
+        def wait_for_oldest():
+            nonlocal ndone
+            ndocs, deltas, result = pending.popleft()
+            chunk_errors = result.result()
+            errors.extend(chunk_errors)
+            if deltas is not None:
+                # Only articles that were indexed change the property counters
+                failed = {error.id for error in chunk_errors}
+                amcates_cache.update_property_counts(sum_property_counts_deltas(deltas, exclude=failed))
+            ndone += ndocs
+            monitor.update(0, "Indexed {ndone} articles ({nerrors} errors)".format(ndone=ndone, nerrors=len(errors)))
+
+        sets = set()
+
+        def record_sets(dicts):
+            for d in dicts:
+                sets.update(d.get("sets") or ())
+                yield d
+
+        executor = amcates_client.get_executor()
+        chunks = self._get_bulk_chunks(record_sets(dicts), max_chunk_bytes, max_chunk_docs, count_properties, new)
+        for ndocs, body, deltas in chunks:
+            if len(pending) >= concurrency:
+                wait_for_oldest()
+            pending.append((ndocs, deltas, executor.submit(self._send_bulk_chunk, body)))
+        while pending:
+            wait_for_oldest()
+
+        if refresh:
+            self.refresh_sets(*sets)
+        if errors:
+            log.warning("Could not index {} articles, first error: {}".format(len(errors), errors[0]))
+
+        return errors
 
     def update_values(self, article_id, values):
         """Update properties of existing article.
@@ -660,10 +1093,87 @@ class _ES(object):
         """
         body = get_bulk_body({aid: serialize({"doc": a}) for aid, a in articles.items()}, action="update")
         resp = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
+        amcates_cache.bump_generation(amcates_cache.INDEX_GENERATION, visible=False)
 
         if resp["errors"]:
             raise ElasticSearchError(resp)
 
+    def update_by_query(self, selection, script, **options):
+        """
+        Execute an update script on all documents matching the given filter
+
+        @param selection: filter DSL, e.g. from build_filter
+        @param script: script with params, e.g. dict(UPDATE_SCRIPT_ADD_TO_SET, params=...)
+        @param options: additional arguments to es.update_by_query
+        @return: the number of updated documents
+        """
+        body = {"query": {"constant_score": {"filter": selection}}, "script": script}
+        resp = self.es.update_by_query(index=self.index, doc_type=self.doc_type, body=body, **options)
+        if resp["failures"]:
+            raise ElasticSearchError(resp)
+        return resp["updated"]
+
+    def _get_task_options(self, requests_per_second=None):
+        if requests_per_second is None:
+            requests_per_second = settings.ES_TASK_REQUESTS_PER_SECOND
+        # Abort on conflicting concurrent updates rather than silently skipping documents
+        options = {"conflicts": "abort"}
+        if requests_per_second:
+            options["requests_per_second"] = requests_per_second
+        return options
+
+    def run_task(self, action, selection, script=None, monitor=NullMonitor(), requests_per_second=None):
+        """
+        Run an update_by_query or delete_by_query on all documents matching the given filter as a
+        server side task, which is polled for progress (reported to monitor) until it completes.
+
+        @param action: "update_by_query" or "delete_by_query"
+        @param selection: filter DSL, e.g. from build_filter
+        @param script: update script with params (for update_by_query)
+        @param requests_per_second: throttle the task, defaults to settings.ES_TASK_REQUESTS_PER_SECOND
+        @return: the status of the completed task, containing e.g. the number of updated or deleted documents
+        """
+        body = {"query": {"constant_score": {"filter": selection}}}
+        if script is not None:
+            body["script"] = script
+
+        options = self._get_task_options(requests_per_second)
+        method = getattr(self.es, action)
+        task_id = method(index=self.index, doc_type=self.doc_type, body=body, wait_for_completion=False,
+                         **options)["task"]
+        return self.wait_for_task(task_id, action, monitor)
+
+    def wait_for_task(self, task_id, action="task", monitor=NullMonitor()):
+        """
+        Poll a server side (update/delete by query or reindex) task until it completes, reporting its
+        progress to monitor.
+
+        @return: the status of the completed task
+        """
+        log.info("Waiting for {action} task {task_id}".format(**locals()))
+        monitor = monitor.submonitor(total=100)
+        done, interval = 0, 0.1
+        while True:
+            task = self.es.tasks.get(task_id=task_id)
+            status = task["task"]["status"]
+            if status["total"]:
+                processed = sum(status[k] for k in ("created", "updated", "deleted", "noops", "version_conflicts"))
+                percent = min(99, 100 * processed // status["total"])
+                if percent > done:
+                    monitor.update(percent - done, "{action}: {processed}/{total} documents".format(
+                        processed=processed, total=status["total"], **locals()))
+                    done = percent
+            if task.get("completed"):
+                break
+            time.sleep(interval)
+            interval = min(interval * 2, settings.ES_TASK_POLL_INTERVAL)
+
+        monitor.update(100 - done)
+        response = task.get("response", {})
+        if task.get("error") or response.get("failures"):
+            raise ElasticSearchError(task)
+        return response or status
+
     def bulk_update(self, article_ids, script, params):
         """
         Execute a bulk update script with the given params on the given article ids.
@@ -675,25 +1185,52 @@ class _ES(object):
         if resp["errors"]:
             raise ElasticSearchError(resp)
 
-    def synchronize_articleset(self, aset, full_refresh=False):
+    def synchronize_articleset(self, aset, full_refresh=False, verify=False):
         """
-        Make sure the given articleset is correctly stored in the index
+        Make sure the given articleset is correctly stored in the index. By default, only the changes
+        in the change journal (see ArticleSetChange) since the last synchronization are applied. Sets
+        that were never synchronized with the journal are compared in full.
+
         @param full_refresh: if true, re-add all articles to the index. Use this
                              after changing properties of articles
+        @param verify: if true, compare all ids in the set with the ids in the index instead of
+                       replaying the journal, to repair an index that is out of sync
         """
+        from amcat.models import ArticleSet, ArticleSetChange
         self.check_index()  # make sure index exists and is at least 'yellow'
 
+        # Changes made during synchronization are applied by the next synchronization
+        until = ArticleSetChange.get_last_id(aset)
+        change_ids, to_add, to_remove = ArticleSetChange.get_changes(aset, until)
+
+        if full_refresh or verify or aset.index_watermark is None:
+            self._synchronize_articleset_full(aset, full_refresh)
+        else:
+            log.info("Replaying {} changes: |to_add_set|={}, |to_remove_set|={}".format(
+                len(change_ids), len(to_add), len(to_remove)))
+            self.remove_from_set(aset.id, to_remove)
+            self.add_to_set(aset.id, to_add)
+
+        ArticleSetChange.delete_changes(change_ids)
+        aset.index_watermark = max(until, aset.index_watermark or 0)
+        ArticleSet.objects.filter(pk=aset.pk).update(index_watermark=aset.index_watermark)
+
+        log.info("Refreshing")
+        self.refresh()
+
+    def _synchronize_articleset_full(self, aset, full_refresh=False):
+        """Synchronize the given articleset by comparing all ids in the set with the ids in the index"""
         log.debug("Getting SOLR ids from set")
-        solr_set_ids = set(self.query_ids(filters=dict(sets=[aset.id])))
+        solr_set_ids = IdSet(self.query_ids_array(filters=dict(sets=[aset.id]), slices=None))
         log.debug("Getting DB ids")
         db_ids = aset.get_article_ids()
         log.debug("Getting SOLR ids")
-        solr_ids = set(self.in_index(db_ids))
+        solr_ids = IdSet(self.in_index(db_ids))
 
         to_remove = solr_set_ids - db_ids
         if full_refresh:
             to_add_docs = db_ids
-            to_add_set = set()
+            to_add_set = IdSet()
         else:
             to_add_docs = db_ids - solr_ids
             to_add_set = (db_ids & solr_ids) - solr_set_ids
@@ -710,8 +1247,6 @@ class _ES(object):
         self.add_to_set(aset.id, to_add_set)
         log.info("Adding {} articles to index".format(len(to_add_docs)))
         self.add_articles(to_add_docs)
-        log.info("Refreshing")
-        self.refresh()
 
     def _count(self, body):
         """Raw version of count directly passing given query to elastic, while setting the index and doc_type"""
@@ -723,7 +1258,7 @@ class _ES(object):
         """
         filters = dict(build_body(query, filters, query_as_filter=True))
         body = {"query": {"constant_score": filters}}
-        return self._count(body)["count"]
+        return amcates_cache.cached(self.index, "count", body, lambda: self._count(body)["count"])
 
     def search_aggregate(self, aggregation, query=None, filters=None, **options):
         """
@@ -858,15 +1393,7 @@ class _ES(object):
             }
         }
 
-        stats = self.search(body, size=0)['aggregations']['stats']
-        result = Result()
-        result.n = stats['count']
-        if result.n == 0:
-            result.start_date, result.end_date = None, None
-        else:
-            result.start_date = get_date(stats['min'])
-            result.end_date = get_date(stats['max'])
-        return result
+        return get_statistics_result(self.cached_search(body, size=0)['aggregations']['stats'])
 
     def list_dates(self, query=None, filters=None, interval="day"):
         from amcat.tools.aggregate_es import aggregate, IntervalCategory
@@ -878,7 +1405,7 @@ class _ES(object):
         Check whether the given ids are already indexed.
         @return: a sequence of ids that are in the index
         """
-        if not isinstance(ids, list): ids = list(ids)
+        if not isinstance(ids, (list, IdSet)): ids = list(ids)
         log.info("Checking existence of {nids} documents".format(nids=len(ids)))
         if not ids: return
         for batch in splitlist(ids, itemsperbatch=10000):
@@ -898,19 +1425,16 @@ class _ES(object):
         hash = get_article_dict(article).hash
         return self.query(filters={'hashes': hash}, _source=["sets"], score=False)
 
-    def _get_purge_actions(self, query):
-        for id in self.query_ids(body=query):
-            yield {
-                "_op_type": "delete",
-                "_id": id,
-                "_index": self.index,
-                "_type": settings.ES_ARTICLE_DOCTYPE
-            }
+    def purge_orphans(self, monitor=NullMonitor(), requests_per_second=None):
+        """
+        Remove all articles without set from the index, using a server side delete_by_query task
 
-    def purge_orphans(self):
-        """Remove all articles without set from the index"""
-        query = {"query": {"bool": {"must_not": {"exists": {"field": "sets"}}}}}
-        return bulk(self.es, self._get_purge_actions(query))
+        @param requests_per_second: throttle the deletes, defaults to settings.ES_TASK_REQUESTS_PER_SECOND
+        @return: the number of deleted articles
+        """
+        selection = {"bool": {"must_not": {"exists": {"field": "sets"}}}}
+        result = self.run_task("delete_by_query", selection, monitor=monitor, requests_per_second=requests_per_second)
+        return result["deleted"]
 
     def get_child_type_counts(self, **filters):
         """Get the number of child documents per type"""
@@ -958,6 +1482,18 @@ def get_date(timestamp):
     return datetime.datetime(d.year, d.month, d.day)
 
 
+def get_statistics_result(stats):
+    """Convert the result of a stats aggregation on date to a Result with n, start_date and end_date"""
+    result = Result()
+    result.n = stats['count']
+    if result.n == 0:
+        result.start_date, result.end_date = None, None
+    else:
+        result.start_date = get_date(stats['min'])
+        result.end_date = get_date(stats['max'])
+    return result
+
+
 def get_filter_clauses(start_date=None, end_date=None, on_date=None, **filters):
     """
     Build a elastic DSL query from the 'form' fields.
@@ -0,0 +1,353 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Shared cache for results of elastic counts and aggregations.
+
+Results are cached on the normalized (json serialized) request body, so they are
+reused across users and query actions. Only requests which are restricted to one
+or more articlesets are cached. Every articleset has a generation counter, which
+is bumped whenever articles are added to or removed from the set. The generations
+of all sets in the request are part of the cache key, so any change to a set
+invalidates all results computed on it. A global index generation is bumped when
+articles are changed in place. Changes that are not yet visible (as the index was not
+refreshed) bump the generation and mark the set as pending: results on pending sets are
+not cached until elastic has refreshed the index.
+
+This module also maintains the property counters of articlesets: for every set a Redis
+hash maps each flexible property to the number of articles in the set that have it. The
+counters are updated by the indexing operations of amcates, so the properties used in a
+set are known without querying elastic. Finally, it marks whether the index is being
+rebuilt, and records which articles changed during the rebuild (see amcates_rebuild).
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional, Set, Iterable, Mapping
+
+import django_redis
+from django import db
+from django.conf import settings
+from django.core.cache import cache
+
+from amcat.tools.idset import IdSet
+from amcat.tools.toolkit import splitlist
+
+log = logging.getLogger(__name__)
+
+INDEX_GENERATION = "index"
+
+
+def _get_generation_key(id):
+    db_name = db.connections.databases['default']['NAME']
+    return "{}.articleset.{}.generation".format(db_name, id)
+
+
+def _get_required_sets(query) -> Iterable[int]:
+    """Yield ids of articlesets all results of the given query must be in"""
+    if not isinstance(query, dict):
+        return
+
+    terms = query.get("terms", {})
+    if "sets" in terms:
+        yield from terms["sets"]
+    if "term" in query and "sets" in query["term"]:
+        yield query["term"]["sets"]
+
+    for clause in ("constant_score", "filtered"):
+        if clause in query:
+            yield from _get_required_sets(query[clause].get("filter"))
+            yield from _get_required_sets(query[clause].get("query"))
+
+    if "bool" in query:
+        for clause in ("filter", "must"):
+            subqueries = query["bool"].get(clause, [])
+            for subquery in subqueries if isinstance(subqueries, list) else [subqueries]:
+                yield from _get_required_sets(subquery)
+
+
+def get_required_sets(body) -> Optional[Set[int]]:
+    """
+    Determine the articlesets a search body is restricted to, i.e. all matching
+    articles are in at least one of these sets.
+
+    @return: set of articleset ids, or None if the body is not restricted to any set
+    """
+    sets = set(map(int, _get_required_sets(body.get("query"))))
+    return sets or None
+
+
+def _get_pending_key(id):
+    db_name = db.connections.databases['default']['NAME']
+    return "{}.articleset.{}.pending".format(db_name, id)
+
+
+def get_generations(articleset_ids) -> Optional[dict]:
+    """
+    Get the current generation of the given articlesets (or INDEX_GENERATION)
+
+    @return: a dictionary of generations, or None if changes to any of the sets might not be
+             visible in elastic yet (see bump_generation)
+    """
+    articleset_ids = sorted(articleset_ids, key=str)
+    keys = [_get_generation_key(id) for id in articleset_ids]
+    redis = django_redis.get_redis_connection()
+
+    values = redis.mget(keys + [_get_pending_key(id) for id in articleset_ids])
+    generations, pending = values[:len(keys)], values[len(keys):]
+    if any(pending):
+        return None
+
+    if None in generations:
+        # Counters are initialized to the current time, so a counter that was lost (or
+        # belongs to a previous set with the same id) never yields a generation that
+        # was used before.
+        now = int(time.time() * 1000000)
+        for key, generation in zip(keys, generations):
+            if generation is None:
+                redis.setnx(key, now)
+        generations = redis.mget(keys)
+
+    return {str(id): int(generation) for id, generation in zip(articleset_ids, generations)}
+
+
+def bump_generation(*articleset_ids, visible=True):
+    """
+    Invalidate all cached results on the given articlesets.
+
+    @param articleset_ids: ids of articlesets, or INDEX_GENERATION to invalidate all results
+    @param visible: whether the changes are visible in elastic (i.e., the index was refreshed). If not,
+                    no results on these sets are cached until the next periodic refresh of elastic.
+    """
+    if not articleset_ids or not settings.ES_RESULT_CACHE_TIMEOUT:
+        return
+
+    now = int(time.time() * 1000000)
+    # Allow for the duration of the refresh itself
+    pending = int(settings.ES_REFRESH_INTERVAL * 2000)
+    redis = django_redis.get_redis_connection()
+    pipe = redis.pipeline()
+    for id in articleset_ids:
+        key = _get_generation_key(id)
+        pipe.setnx(key, now)
+        pipe.incr(key)
+        if not visible and pending:
+            pipe.set(_get_pending_key(id), 1, px=pending)
+    pipe.execute()
+
+
+def get_cache_key(index: str, kind: str, body: dict, **options) -> Optional[str]:
+    """
+    Get the cache key for a request, which includes the current generations of all
+    articlesets the request is restricted to.
+
+    @return: a cache key, or None if this request cannot be cached
+    """
+    if not settings.ES_RESULT_CACHE_TIMEOUT:
+        return None
+
+    sets = get_required_sets(body)
+    if sets is None:
+        return None
+
+    generations = get_generations(sets | {INDEX_GENERATION})
+    if generations is None:
+        return None
+
+    request = json.dumps([index, kind, body, options, generations], sort_keys=True, default=str)
+    return "es-result.{}".format(hashlib.sha256(request.encode("utf-8")).hexdigest())
+
+
+def get_result(key: Optional[str]):
+    """Get a cached result, or None if it is not in the cache"""
+    if key is not None:
+        return cache.get(key)
+
+
+def set_result(key: Optional[str], value):
+    """Store a result in the cache"""
+    if key is not None:
+        cache.set(key, value, settings.ES_RESULT_CACHE_TIMEOUT)
+
+
+def cached(index: str, kind: str, body: dict, func, **options):
+    """
+    Return the cached result of a request, or call func to compute and cache it.
+
+    @param kind: type of request (e.g. count, search), part of the cache key
+    @param func: function without arguments performing the request
+    """
+    key = get_cache_key(index, kind, body, **options)
+    value = get_result(key)
+    if value is None:
+        value = func()
+        set_result(key, value)
+    else:
+        log.debug("Using cached {kind} result {key}".format(**locals()))
+    return value
+
+
+# Field in property counters marking that the counters were initialized
+_COUNTED = ""
+
+# Increment counters in a hash, but only if it exists: otherwise the set was never counted,
+# and we should not create a hash with only the counts of the new articles.
+_INCREMENT_IF_EXISTS = """
+if redis.call('exists', KEYS[1]) == 1 then
+    for i = 1, #ARGV, 2 do
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+
+def _get_property_counts_key(id):
+    db_name = db.connections.databases['default']['NAME']
+    return "{}.articleset.{}.property_counts".format(db_name, id)
+
+
+def get_property_counts(articleset_id) -> Optional[Counter]:
+    """Return the number of articles per property in the given set, or None if not counted yet"""
+    redis = django_redis.get_redis_connection()
+    counts = redis.hgetall(_get_property_counts_key(articleset_id))
+    if not counts:
+        return None
+    return Counter({prop.decode(): int(n) for prop, n in counts.items() if prop.decode() != _COUNTED})
+
+
+def set_property_counts(articleset_id, counts: Mapping[str, int]):
+    """Replace the property counters of the given set"""
+    key = _get_property_counts_key(articleset_id)
+    pipe = django_redis.get_redis_connection().pipeline()
+    pipe.delete(key)
+    pipe.hset(key, _COUNTED, 0)
+    for prop, n in counts.items():
+        pipe.hset(key, prop, n)
+    pipe.execute()
+
+
+def update_property_counts(deltas: Mapping[int, Mapping[str, int]]):
+    """
+    Add the given deltas to the property counters of sets that were counted before
+
+    @param deltas: mapping of articleset id to a mapping of property to the change in count
+    """
+    redis = django_redis.get_redis_connection()
+    increment = redis.register_script(_INCREMENT_IF_EXISTS)
+    for articleset_id, counts in deltas.items():
+        args = [x for prop, n in counts.items() if n for x in (prop, n)]
+        if args:
+            increment(keys=[_get_property_counts_key(articleset_id)], args=args)
+
+
+def delete_property_counts(articleset_id):
+    """Discard the property counters of the given set, they will be recounted when needed"""
+    django_redis.get_redis_connection().delete(_get_property_counts_key(articleset_id))
+
+
+def delete_all_property_counts():
+    """Discard property counters of all articlesets of the current database. This runs in O(n)
+    with n being the number of keys in Redis."""
+    redis = django_redis.get_redis_connection()
+    keys = redis.keys(_get_property_counts_key("*"))
+    if keys:
+        redis.delete(*keys)
+
+
+def _get_rebuilding_key():
+    db_name = db.connections.databases['default']['NAME']
+    return "{}.index.rebuilding".format(db_name)
+
+
+def _get_rebuild_changes_key():
+    db_name = db.connections.databases['default']['NAME']
+    return "{}.index.rebuild_changes".format(db_name)
+
+
+# Seconds after which the mark that the index is being rebuilt expires unless it is renewed, so a
+# rebuild that is killed does not leave it behind
+REBUILDING_TIMEOUT = 300
+
+
+def set_rebuilding(rebuilding: bool):
+    """Mark that the index is (no longer) being rebuilt by this process. The mark expires after REBUILDING_TIMEOUT
+    seconds, use rebuilding() to keep it while the rebuild runs."""
+    redis = django_redis.get_redis_connection()
+    if rebuilding:
+        timeout = int(REBUILDING_TIMEOUT * 1000)
+        pipe = redis.pipeline()
+        pipe.set(_get_rebuilding_key(), os.getpid(), px=timeout)
+        pipe.pexpire(_get_rebuild_changes_key(), timeout)
+        pipe.execute()
+    else:
+        redis.delete(_get_rebuilding_key(), _get_rebuild_changes_key())
+
+
+@contextmanager
+def rebuilding():
+    """Context manager marking that the index is being rebuilt, renewing the mark in a background
+    thread until the context is left"""
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(REBUILDING_TIMEOUT / 3):
+            set_rebuilding(True)
+
+    django_redis.get_redis_connection().delete(_get_rebuild_changes_key())
+    set_rebuilding(True)
+    thread = threading.Thread(target=renew, name="renew-rebuilding", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        set_rebuilding(False)
+
+
+def is_rebuilding() -> bool:
+    """Return whether the index is being rebuilt"""
+    return bool(django_redis.get_redis_connection().exists(_get_rebuilding_key()))
+
+
+def record_rebuild_changes(article_ids: Iterable[int], batch_size=10000):
+    """
+    Record that the given articles were changed (e.g. added to or removed from a set) while the index
+    is being rebuilt, so the rebuild copies them again (see amcates_rebuild.catch_up). Does nothing if
+    the index is not being rebuilt.
+    """
+    if not is_rebuilding():
+        return
+    key = _get_rebuild_changes_key()
+    pipe = django_redis.get_redis_connection().pipeline()
+    for batch in splitlist(list(article_ids), itemsperbatch=batch_size):
+        pipe.sadd(key, *batch)
+    # The rebuild might have finished since is_rebuilding was checked
+    pipe.pexpire(key, int(REBUILDING_TIMEOUT * 1000))
+    pipe.execute()
+
+
+def get_rebuild_changes() -> IdSet:
+    """Return the ids of the articles changed since the rebuild of the index started"""
+    return IdSet(int(aid) for aid in django_redis.get_redis_connection().smembers(_get_rebuild_changes_key()))
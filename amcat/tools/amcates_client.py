@@ -0,0 +1,185 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Process-wide elasticsearch clients and worker threads.
+
+Clients are shared between all threads of a process (the elasticsearch client is thread
+safe), and keep a pool of at most ES_POOL_SIZE keep-alive connections per node. If
+ES_SNIFF is set, the other nodes of the cluster are discovered on start and every
+ES_SNIFF_INTERVAL seconds. The latency of requests is tracked per node, see get_stats().
+
+Parallel requests (e.g. sliced scrolls and bulk requests) are run on a single bounded
+thread pool, see get_executor(). Clients, pools and statistics are reset after a fork
+(e.g. in celery worker processes), as connections cannot be shared between processes. As
+os.register_at_fork is not available before Python 3.7, a fork is also detected by a change
+of the process id.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_clients = {}
+_node_stats = {}
+_executor = None
+_pid = os.getpid()
+
+
+class NodeStats(object):
+    """Request statistics of a single elastic node"""
+    # Weight of the latest request in the moving average of latencies
+    ALPHA = 0.1
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.latency = None
+
+    def add(self, duration, failed=False):
+        self.requests += 1
+        self.failures += int(failed)
+        self.total_time += duration
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency += self.ALPHA * (duration - self.latency)
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "mean_latency": self.total_time / self.requests if self.requests else None,
+            "latency": self.latency,
+        }
+
+
+def _record_request(host, duration, failed=False):
+    with _lock:
+        try:
+            stats = _node_stats[host]
+        except KeyError:
+            stats = _node_stats[host] = NodeStats()
+        stats.add(duration, failed)
+
+
+class TimedConnection(Urllib3HttpConnection):
+    """Connection to a single node, which records the latency of all requests"""
+
+    def log_request_success(self, method, full_url, path, body, status_code, response, duration):
+        _record_request(self.host, duration)
+        super().log_request_success(method, full_url, path, body, status_code, response, duration)
+
+    def log_request_fail(self, method, full_url, path, body, duration, status_code=None, response=None,
+                         exception=None):
+        _record_request(self.host, duration, failed=True)
+        super().log_request_fail(method, full_url, path, body, duration, status_code, response, exception)
+
+
+def get_client(host, port, timeout=300, **kwargs) -> Elasticsearch:
+    """
+    Get the elasticsearch client for the given node, creating it if needed
+
+    @param kwargs: additional arguments for the Elasticsearch client
+    """
+    key = (host, port, timeout, tuple(sorted(kwargs.items())))
+    _check_fork()
+    with _lock:
+        try:
+            return _clients[key]
+        except KeyError:
+            pass
+
+        options = dict(timeout=timeout, connection_class=TimedConnection, maxsize=settings.ES_POOL_SIZE)
+        if settings.ES_SNIFF:
+            options.update(sniff_on_start=True, sniff_on_connection_fail=True,
+                           sniffer_timeout=settings.ES_SNIFF_INTERVAL)
+        options.update(kwargs)
+
+        log.debug("Creating elastic client for {host}:{port}".format(**locals()))
+        client = _clients[key] = Elasticsearch(hosts=[{"host": host, "port": port}], **options)
+        return client
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get the thread pool shared by all parallel elastic requests of this process"""
+    global _executor
+    _check_fork()
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.ES_EXECUTOR_WORKERS)
+        return _executor
+
+
+def get_stats() -> list:
+    """
+    Return statistics of all nodes the clients of this process are connected to: the number of
+    requests, failures and latency (moving average) and connection pool usage.
+    """
+    _check_fork()
+    with _lock:
+        clients = list(_clients.values())
+        node_stats = {host: stats.to_dict() for host, stats in _node_stats.items()}
+
+    result = []
+    for client in clients:
+        pool = client.transport.connection_pool
+        # A pool for a single node (DummyConnectionPool) never marks its connection dead
+        dead_queue = list(pool.dead.queue) if hasattr(pool, "dead") else ()
+        dead = {connection for _, connection in dead_queue}
+        for connection in list(pool.connections) + list(dead):
+            http_pool = connection.pool
+            stats = {
+                "host": connection.host,
+                "alive": connection not in dead,
+                "pool_size": http_pool.pool.maxsize if http_pool.pool else 0,
+                "idle_connections": http_pool.pool.qsize() if http_pool.pool else 0,
+                "opened_connections": http_pool.num_connections,
+                "pool_requests": http_pool.num_requests,
+            }
+            stats.update(node_stats.get(connection.host, NodeStats().to_dict()))
+            result.append(stats)
+    return result
+
+
+def reset():
+    """Forget all clients, worker threads and statistics. Called automatically after a fork, as the
+    child cannot use the connections (and threads) of its parent."""
+    global _lock, _executor, _pid
+    _lock = threading.Lock()
+    _clients.clear()
+    _node_stats.clear()
+    _executor = None
+    _pid = os.getpid()
+
+
+def _check_fork():
+    if _pid != os.getpid():
+        reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset)
@@ -17,7 +17,7 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 import datetime
-import functools
+import itertools
 import random
 import collections
 import regex
@@ -39,6 +39,10 @@ from amcat.tools.amcates import ALL_FIELDS, ES, get_property_primitive_type
 from amcat.tools.queryparser import Term
 
 
+# Elastic refuses from + size beyond index.max_result_window (default 10000): scroll beyond it
+MAX_RESULT_WINDOW = 10000
+SCROLL_SIZE = 1000
+
 TOKEN_START = toolkit.random_alphanum(16)
 TOKENIZER_PATTERN = settings.ES_SETTINGS["analysis"]["tokenizer"]["unicode_letters_digits"]["pattern"]
 TOKENIZER_INV = regex.compile(TOKENIZER_PATTERN.replace("^", "") + "+")
@@ -348,29 +352,34 @@ class ESQuerySet:
         self._query = None
         self._count_cache = None
 
-        # HACK: Set size to default max of elastic. We should think about pagination..
-        self.size = 10000
+        # Number of articles to fetch (None for all) and number of articles to skip. Use slicing
+        # to set these, e.g. qs[100:140].
+        self.size = None
         self.offset = 0
 
-    def _do_query(self, query):
-        result = ES().search(query)
-
-        if len(result["hits"]["hits"]) == self.size:
-            raise NotImplementedError("Returned 10000 articles exactly. Time to implement scroll :)")
+    def _do_query(self, query: dict) -> Iterable[dict]:
+        """Execute query and yield its hits. If the requested window fits within elastic's result
+        window, a single search request is made; otherwise the results are scrolled through."""
+        if self.size is not None and self.offset + self.size <= MAX_RESULT_WINDOW:
+            yield from ES().search(query)["hits"]["hits"]
+            return
 
-        return result
+        # Scrolling does not support from, so skip documents before offset ourselves
+        query = {k: v for k, v in query.items() if k not in ("from", "size")}
+        hits = ES().scan(query, preserve_order=bool(self.ordering), size=SCROLL_SIZE)
+        stop = None if self.size is None else self.offset + self.size
+        yield from itertools.islice(hits, self.offset, stop)
 
     def __iter__(self) -> Iterable[ESArticle]:
         if not self.highlights:
             # Case 1: no highlighters
-            hits = ES().search(self.get_query())["hits"]["hits"]
-            for hit in hits:
+            for hit in self._do_query(self.get_query()):
                 _to_flat_dict(hit["_source"])
                 yield ESArticle(self.fields, hit["_source"])
         else:
             # Case 2: at least one highlighter present. We need to execute a query for every
             # highlighter plus one for the original text.
-            original_texts = self._do_query(self.get_query())["hits"]["hits"]
+            original_texts = list(self._do_query(self.get_query()))
             for hit in original_texts:
                 _to_flat_dict(hit["_source"])
 
@@ -379,10 +388,10 @@ class ESQuerySet:
             highlighted_texts = []
             for highlight in self.highlights:
                 unordered.get_query(highlight)
-                result = self._do_query(self.get_query(highlight))
-                for hit in result["hits"]["hits"]:
+                result = list(self._do_query(self.get_query(highlight)))
+                for hit in result:
                     _to_flat_dict(hit["highlight"])
-                highlighted_texts.append({d["_id"]: d["highlight"] for d in result["hits"]["hits"]})
+                highlighted_texts.append({d["_id"]: d["highlight"] for d in result})
 
             markers = [h.mark for h in self.highlights]
             for text in original_texts:
@@ -390,59 +399,50 @@ class ESQuerySet:
                 merged = dict(merge_highlighted_document(text["_source"], highlighted, markers))
                 yield HighlightedESArticle(self.fields, ChainMap(merged, text["_source"]))
 
-    @functools.lru_cache()
     def __len__(self):
-        """For a more efficient way of determining this size of this set use count(). This
-        method will execute the query (which includes fetching all documents) and count
-        the size of that set.
-
-        This method is left 'inefficient' due to the following common pattern:
-
-            qs = list(ESQuerySet(...))
-
-        list() will first determine the size of its given argument (if it detects __len__)
-        to allocate a sufficient amount of memory. Therefore; if we would call count() we
-        would execute the query twice which is clearly undesirable.
-        """
-        if self._count_cache:
-            return self._count_cache
-        return sum(1 for _ in self)
+        """Determine the size of this set using a count query (taking slicing into account),
+        so no documents need to be fetched. The result is cached on this object."""
+        if self._count_cache is None:
+            count = max(0, self.count() - self.offset)
+            self._count_cache = count if self.size is None else min(count, self.size)
+        return self._count_cache
 
     def __bool__(self):
         return bool(len(self))
 
     def __getitem__(self, item: Union[int, slice]):
-        # TODO: Query elastic for pagination
+        """Index or slice this queryset. Slices are translated to from / size parameters, so
+        qs[100:140] only fetches 40 documents."""
         if isinstance(item, int):
             if item < 0:
                 raise TypeError("Negative indexing not supported")
 
-            for i, article in enumerate(self):
-                if i == item:
-                    return article
-            raise IndexError("IndexError: list index out of range")
+            try:
+                return next(iter(self[item:item+1]))
+            except StopIteration:
+                raise IndexError("IndexError: list index out of range")
 
-        start, stop, step = item
+        start, stop, step = item.start, item.stop, item.step
         start = start or 0
-        stop = len(self) if stop is None else stop
         step = 1 if step is None else step
 
-        if start < 0 or stop < 0:
+        if start < 0 or (stop is not None and stop < 0):
             raise TypeError("Negative indexing not supported")
 
         if step <= 0:
             raise TypeError("Step can't be negative or zero")
 
-        articles = []
-        for i, article in enumerate(self):
-            if i >= stop:
-                break
-            elif len(articles) % step != 0:
-                continue
-            elif i >= start:
-                articles.append(article)
+        # Translate slice relative to current window
+        offset = self.offset + start
+        if stop is None:
+            size = None if self.size is None else max(0, self.size - start)
+        else:
+            size = max(0, stop - start)
+            if self.size is not None:
+                size = max(0, min(size, self.size - start))
 
-        return articles
+        articles = list(self._copy(offset=offset, size=size))
+        return articles[::step]
 
     def _check_fields(self, fields):
         for field in fields:
@@ -483,7 +483,7 @@ class ESQuerySet:
         query = {
             "track_scores": True if "?" in self.ordering else self.track_scores,
             "_source": tuple(set(self.fields) | {"_doc"}),
-            "size": self.size,
+            "size": MAX_RESULT_WINDOW if self.size is None else self.size,
             "from": self.offset,
             "query": {
                 "function_score": {
@@ -600,7 +600,7 @@ class ESQuerySet:
 
         # Parse result
         articles = collections.OrderedDict()
-        for hit in new._do_query(dsl)["hits"]["hits"]:
+        for hit in new._do_query(dsl):
             articles[hit["_source"]["id"]] = {
                 field: hit["highlight"].get(field,[""]) for field in fields
             }
@@ -749,13 +749,17 @@ class ESQuerySet:
         return self._copy(ordering=tuple(ordering), seed=seed)
 
     def count(self):
-        return ES()._count(self.get_query())["count"]
+        """Return the number of documents matching this queryset, ignoring slicing"""
+        return ES()._count({"query": self.get_query()["query"]})["count"]
 
     def _copy(self, **kwargs):
         new = ESQuerySet(ArticleSet.objects.none())
         for slot in self.__slots__:
             setattr(new, slot, getattr(self, slot))
 
+        # Cached count is no longer valid for a modified queryset
+        new._count_cache = None
+
         for attr, value in kwargs.items():
             setattr(new, attr, value)
 
@@ -0,0 +1,194 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Rebuild the elastic index without downtime. A new, versioned index is created with the current
+ES_MAPPING and ES_SETTINGS (and e.g. a different number of shards), filled from postgres or from the
+current index, and the alias settings.ES_INDEX is then pointed to it in a single atomic request.
+Searches and indexing use the alias, so they continue on the old index until the swap.
+
+Articles created or added to / removed from sets while copying are copied again from postgres before
+and after the swap. New articles are found by their id, changes to sets are recorded in Redis while
+rebuilding (see amcates_cache.record_rebuild_changes), as the change journal of a set is deleted when it
+is synchronized or deleted. Changes to existing articles that do not change sets (e.g. bulk_update_values)
+while copying are not copied again.
+"""
+import datetime
+import logging
+
+from django.conf import settings
+
+from amcat.tools import amcates, amcates_cache
+from amcat.tools.amcates import ES, get_article_dict
+from amcat.tools.progress import NullMonitor
+from amcat.tools.toolkit import multidict, splitlist
+
+log = logging.getLogger(__name__)
+
+SOURCE_POSTGRES = "postgres"
+SOURCE_INDEX = "index"
+
+
+def get_versioned_index_name(alias: str) -> str:
+    return "{}_{}".format(alias, datetime.datetime.now().strftime("%Y%m%d%H%M%S%f"))
+
+
+def _get_marker():
+    """Return the last article id, to find articles created after this point"""
+    from amcat.models import Article
+    return Article.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+
+def _get_article_batches(article_ids=None, batch_size=1000):
+    from amcat.models import Article
+    if article_ids is not None:
+        for batch in splitlist(sorted(article_ids), itemsperbatch=batch_size):
+            yield list(Article.objects.filter(pk__in=batch).order_by("pk"))
+        return
+
+    last = 0
+    while True:
+        batch = list(Article.objects.filter(pk__gt=last).order_by("pk")[:batch_size])
+        if not batch:
+            return
+        last = batch[-1].pk
+        yield batch
+
+
+def get_article_dicts(article_ids=None, batch_size=1000, skip_orphans=True):
+    """
+    Yield the article dicts (including set membership) of the given articles, or of all articles.
+    Articles are read in batches ordered by id, so this can be used for any number of articles.
+
+    @param skip_orphans: skip articles that are not in any set
+    """
+    from amcat.models import ArticleSetArticle
+    for batch in _get_article_batches(article_ids, batch_size):
+        sets = multidict(ArticleSetArticle.objects.filter(article_id__in=[a.pk for a in batch])
+                         .values_list("article_id", "articleset_id"))
+        for article in batch:
+            if article.pk in sets or not skip_orphans:
+                yield get_article_dict(article, sorted(sets.get(article.pk, ())))
+
+
+def copy_from_postgres(target, monitor=NullMonitor()):
+    """Index all articles in postgres into the target index, with pipelined parallel bulk requests"""
+    errors = target.parallel_bulk_insert(get_article_dicts(), monitor=monitor, count_properties=False)
+    if errors:
+        raise amcates.ElasticSearchError(errors)
+
+
+def copy_from_index(source, target, slices=None, requests_per_second=None, monitor=NullMonitor()):
+    """Copy all documents from the source index to the target index with a (sliced) reindex task"""
+    body = {"source": {"index": source.index, "size": 1000}, "dest": {"index": target.index}}
+    options = source._get_task_options(requests_per_second)
+    options.pop("conflicts")
+    if slices:
+        options["slices"] = slices
+    task_id = source.es.reindex(body=body, wait_for_completion=False, **options)["task"]
+    source.wait_for_task(task_id, "reindex", monitor)
+
+
+def catch_up(target, marker):
+    """
+    Copy articles created after the given marker, and articles changed since the rebuild started (see
+    amcates_cache.get_rebuild_changes), from postgres to the target index
+    """
+    from amcat.models import Article
+    article_ids = set(Article.objects.filter(pk__gt=marker).values_list("pk", flat=True))
+    article_ids |= amcates_cache.get_rebuild_changes()
+    log.info("Copying {} changed articles to {}".format(len(article_ids), target.index))
+    if not article_ids:
+        return
+
+    copied = set()
+
+    def record_copied(dicts):
+        for d in dicts:
+            copied.add(d["id"])
+            yield d
+
+    # Articles removed from their last set must lose their set membership in the target index
+    dicts = get_article_dicts(article_ids, skip_orphans=False)
+    errors = target.parallel_bulk_insert(record_copied(dicts), count_properties=False)
+    if errors:
+        raise amcates.ElasticSearchError(errors)
+
+    # Articles deleted from postgres (e.g. with their set) are deleted from the target index
+    deleted = article_ids - copied
+    if deleted:
+        body = "".join(amcates.serialize({"delete": {"_id": aid}}) + "\n" for aid in sorted(deleted))
+        target.es.bulk(body=body, index=target.index, doc_type=target.doc_type)
+
+
+def rebuild(es=None, shards=5, replicas=1, source=SOURCE_POSTGRES, slices=None, keep_old=False,
+            monitor=NullMonitor()) -> str:
+    """
+    Rebuild the index in a new versioned index, and atomically point the alias es.index to it
+
+    @param source: SOURCE_POSTGRES to index all articles from the database, or SOURCE_INDEX to copy
+                   the documents in the current index (faster, but keeps their current content)
+    @param slices: number of parallel slices of the reindex task (for SOURCE_INDEX)
+    @param keep_old: do not delete the old index after the swap (it is deleted if it was not an alias)
+    @return: the name of the new index
+    """
+    es = es or ES()
+    es.check_index()
+    monitor = monitor.submonitor(total=4)
+
+    # Changes to sets are recorded while rebuilding, so they are copied by catch_up
+    with amcates_cache.rebuilding():
+        marker = _get_marker()
+        target = ES(index=get_versioned_index_name(es.index), doc_type=es.doc_type, host=es.host, port=es.port)
+        log.info("Rebuilding {es.index} in {target.index} from {source}".format(**locals()))
+        target.create_index(shards=shards, replicas=0)
+        # Replicas and refreshes only slow down the initial copy
+        target.es.indices.put_settings(index=target.index, body={"index": {"refresh_interval": "-1"}})
+
+        monitor.update(message="Copying documents to {target.index}".format(**locals()))
+        if source == SOURCE_INDEX:
+            copy_from_index(es, target, slices=slices, monitor=monitor)
+        else:
+            copy_from_postgres(target, monitor=monitor)
+
+        monitor.update(message="Copying changes since start of rebuild")
+        new_marker = _get_marker()
+        catch_up(target, marker)
+        refresh_interval = "{}ms".format(int(settings.ES_REFRESH_INTERVAL * 1000))
+        target.es.indices.put_settings(index=target.index, body={
+            "index": {"refresh_interval": refresh_interval, "number_of_replicas": replicas}})
+        target.es.indices.refresh(index=target.index)
+        target.es.cluster.health(index=target.index, wait_for_status="yellow")
+
+        monitor.update(message="Swapping alias {es.index} to {target.index}".format(**locals()))
+        old = es.swap_alias(target.index)
+        # Changes written to the old index after the first catch up
+        catch_up(es, new_marker)
+        es.refresh()
+
+    # Counters were not updated while copying, so recount properties when needed
+    amcates_cache.delete_all_property_counts()
+    amcates_cache.bump_generation(amcates_cache.INDEX_GENERATION)
+
+    if not keep_old:
+        for index in old:
+            log.info("Deleting old index {index}".format(**locals()))
+            es.es.indices.delete(index=index)
+    monitor.update(message="Rebuilt {es.index} in {target.index}".format(**locals()))
+    return target.index
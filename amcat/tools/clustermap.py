@@ -28,15 +28,18 @@ visualisation software such as:
 import os
 import subprocess
 
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 from itertools import chain
 from tempfile import NamedTemporaryFile
 
+import numpy
 from django.conf import settings
 from django.template import Context
 from django.template.loader import get_template
 from lxml import html
 
+from amcat.tools.idset import IdSet
+
 try:
     from StringIO import StringIO
 except ImportError:
@@ -78,19 +81,31 @@ def get_clusters(queries) -> dict:
     determining the cluster it belongs to.
 
     @param queries.keys(): SearchQuery
-    @param queries.values(): List of ids
-    @returns: mapping of cluster (frozenset of queries) to a set of article ids
+    @param queries.values(): Iterable of ids (preferably an IdSet)
+    @returns: mapping of cluster (frozenset of queries) to an IdSet of article ids
     """
-    queries = {q: set(ids) for q, ids in queries.items()}
-
-    article_clusters = defaultdict(set)
-    for query, aids in queries.items():
-        for aid in aids:
-            article_clusters[aid].add(query)
-
-    clusters = defaultdict(set)
-    for aid, queries in article_clusters.items():
-        clusters[frozenset(queries)].add(aid)
+    queries = OrderedDict((q, IdSet(ids)) for q, ids in queries.items())
+    allids = IdSet().union(*queries.values())
+    if not allids:
+        return {}
+
+    # Determine for each article a bitmask of the queries it matches. Use Python ints
+    # as bitmasks if there are too many queries to fit in 64 bits.
+    dtype, bit = (numpy.uint64, numpy.uint64) if len(queries) < 64 else (object, int)
+    masks = numpy.zeros(len(allids), dtype=dtype)
+    for i, ids in enumerate(queries.values()):
+        masks[numpy.searchsorted(allids.ids, ids.ids)] |= bit(1 << i)
+
+    # Group articles on their bitmask
+    order = numpy.argsort(masks, kind="stable")
+    masks, aids = masks[order], allids.ids[order]
+    boundaries = numpy.flatnonzero(masks[1:] != masks[:-1]) + 1
+
+    clusters = {}
+    for start, end in zip(numpy.r_[0, boundaries], numpy.r_[boundaries, len(masks)]):
+        mask = int(masks[start])
+        cluster = frozenset(q for i, q in enumerate(queries) if mask & (1 << i))
+        clusters[cluster] = IdSet(aids[start:end])
 
     return clusters
 
@@ -99,22 +114,13 @@ def get_clustermap_table(queries):
     """
     Given a mapping of query to ids, return a table with the #hits for each boolean combination
     """
-    queries = OrderedDict((k, set(v)) for (k,v) in queries.items())
+    clusters = get_clusters(queries)
     header = sorted(queries.keys(), key=lambda q: str(q))
     rows = []
-    allids = set(chain.from_iterable(queries.values()))
     for c in combinations(header):
-        ids = allids.copy()
-        row = []
-        for q in header:
-            row.append(int(q in c))
-            if q in c:
-                ids &= queries[q]
-            else:
-                ids -= queries[q]
-        n = len(ids)
+        n = len(clusters.get(frozenset(c), ()))
         if n:
-            rows.append(tuple(row + [n]))
+            rows.append(tuple([int(q in c) for q in header] + [n]))
 
     return [h.label for h in header] + ["Total"], rows
 
@@ -3,9 +3,15 @@ from typing import Union, Iterable
 
 import binascii
 import hashlib
+import logging
+import math
+import threading
 
+import numpy
 from django.db import models
 
+log = logging.getLogger(__name__)
+
 HASH = hashlib.sha224
 
 
@@ -73,4 +79,105 @@ class HashField(models.BinaryField):
         if value:
             if len(value) < self.max_length:
                 value = value.rjust(self.max_length, b'\0')
-            return bytes(Digest(value))
\ No newline at end of file
+            return bytes(Digest(value))
+
+
+class HashFilter:
+    """
+    Bloom filter of digests. A digest that was added is always reported as possibly present,
+    other digests are falsely reported as present with probability error_rate (as long as no
+    more than capacity digests were added). As digests are already uniformly distributed, the
+    bit positions are taken directly from the bytes of the digest, so no further hashing is needed.
+    """
+
+    def __init__(self, capacity: int, error_rate: float=0.01, digest_size: int=224//8):
+        """
+        @param capacity: expected number of digests in this filter
+        @param error_rate: desired rate of false positives at capacity
+        @param digest_size: size of the digests in bytes, which limits the number of bit positions per digest
+        """
+        self.capacity = max(1, capacity)
+        self.m = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.k = min(digest_size // 4, max(1, round(self.m / self.capacity * math.log(2))))
+        self.bits = numpy.zeros((self.m + 7) // 8, dtype=numpy.uint8)
+        self.n = 0
+
+    def _get_positions(self, digests: Iterable[Union[Digest, bytes, str]]) -> numpy.ndarray:
+        data = b"".join(bytes(Digest(d))[:4 * self.k] for d in digests)
+        words = numpy.frombuffer(data, dtype="<u4").astype(numpy.uint64)
+        return (words % self.m).reshape(-1, self.k)
+
+    def add(self, digests: Iterable[Union[Digest, bytes, str]]):
+        positions = self._get_positions(digests)
+        numpy.bitwise_or.at(self.bits, positions >> 3, numpy.left_shift(1, positions & 7).astype(numpy.uint8))
+        self.n += len(positions)
+
+    def might_contain(self, digests: Iterable[Union[Digest, bytes, str]]) -> numpy.ndarray:
+        """@return: a boolean array which is False for every digest that was certainly not added"""
+        positions = self._get_positions(digests)
+        if not len(positions):
+            return numpy.zeros(0, dtype=bool)
+        bits = self.bits[positions >> 3] & numpy.left_shift(1, positions & 7).astype(numpy.uint8)
+        return (bits != 0).all(axis=1)
+
+    def __contains__(self, digest) -> bool:
+        return bool(self.might_contain([digest])[0])
+
+
+class ModelHashFilter:
+    """
+    Filter of all values of a HashField of a model. The filter is kept up to date by adding the
+    hashes of rows with a primary key above the highest key seen in the previous update. As rows
+    of concurrent transactions may be committed out of order, the last `overlap` keys are read
+    again on every update. Rows inserted with lower keys than that are missed, so callers should
+    be prepared for a unique violation on insert. Deleted rows stay in the filter, which only
+    causes false positives.
+    """
+
+    def __init__(self, model, field: str="hash", error_rate: float=0.01, batch_size: int=100000,
+                 overlap: int=10000):
+        self.model = model
+        self.field = field
+        self.error_rate = error_rate
+        self.batch_size = batch_size
+        self.overlap = overlap
+        self.filter = None
+        self.last_id = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def _add_rows(self, min_id):
+        """Add hashes of all rows with id > min_id to the filter"""
+        pk = self.model._meta.pk.name
+        rows = self.model.objects.order_by(pk).values_list(pk, self.field)
+        while True:
+            batch = list(rows.filter(**{pk + "__gt": min_id})[:self.batch_size])
+            if not batch:
+                return
+            self.filter.add(h for _, h in batch if h)
+            self.count += sum(1 for id, _ in batch if id > self.last_id)
+            min_id = batch[-1][0]
+            self.last_id = max(self.last_id, min_id)
+
+    def _rebuild(self):
+        count = self.model.objects.count()
+        digest_size = self.model._meta.get_field(self.field).max_length
+        log.info("Building hash filter of {count} {self.model.__name__} objects".format(**locals()))
+        self.filter = HashFilter(2 * count + self.batch_size, self.error_rate, digest_size)
+        self.last_id = self.count = 0
+        self._add_rows(0)
+
+    def update(self):
+        """Add the hashes of rows inserted since the last update, rebuilding the filter if it is full"""
+        if self.filter is None or self.count > self.filter.capacity:
+            self._rebuild()
+        else:
+            self._add_rows(max(0, self.last_id - self.overlap))
+
+    def might_contain(self, digests) -> numpy.ndarray:
+        """Update the filter, and check which of the given digests might be in the database
+        @return: a boolean array which is False for every digest certainly not in the database"""
+        digests = list(digests)
+        with self.lock:
+            self.update()
+            return self.filter.might_contain(digests)
@@ -32,9 +32,10 @@ from django.db.models import Q
 
 from amcat.models import Label, CodingValue, CodedArticle, Coding
 from amcat.tools import queryparser
-from amcat.tools.aggregate_es import aggregate, TermCategory
+from amcat.tools.aggregate_es import aggregate, AggregationPlan, TermCategory
 from amcat.tools.amcates import ES
-from amcat.tools.caching import cached
+from amcat.tools.caching import cached, set_cache
+from amcat.tools.idset import IdSet
 from amcat.tools.toolkit import strip_accents
 
 REFERENCE_RE = re.compile(r"<(?P<reference>.*?)(?P<recursive>\+?)>")
@@ -153,14 +154,17 @@ class SelectionSearch:
 
         return [q for q in resolved if not q.label.startswith("_")]
 
+    def _check_queries(self):
+        """Parse queries one by one, to raise an error pointing to the offending query"""
+        for i, q in enumerate(self.get_queries()):
+            queryparser.parse_to_terms(q.query, context=(q.declared_label or i + 1))
+
     @cached
     def get_count(self):
         try:
             return self.es.count(self.get_query(), self.get_filters())
         except queryparser.QueryParseError:
-            # try queries one by one
-            for i, q in enumerate(self.get_queries()):
-                queryparser.parse_to_terms(q.query, context=(q.declared_label or i + 1))
+            self._check_queries()
             # if error wasn't raised yet, re-raise original
             raise
 
@@ -168,23 +172,52 @@ class SelectionSearch:
     def get_statistics(self):
         return self.es.statistics(self.get_query(), self.get_filters())
 
-    def get_aggregate(self, categories, flat=True, objects=True):
+    def _get_aggregate_query(self, categories):
         # If we're aggregating on terms, we don't want a global filter
-        query = None
         if not any(isinstance(c, TermCategory) for c in categories):
-            query = self.get_query()
+            return self.get_query()
 
+    def get_aggregate(self, categories, flat=True, objects=True):
+        query = self._get_aggregate_query(categories)
         return aggregate(query, self.get_filters(), categories, flat=flat, objects=objects)
 
+    def get_aggregates(self, aggregations=(), count=True, statistics=False, flat=True, objects=True):
+        """
+        Compute the count, statistics and any number of aggregations of this selection in a
+        single round trip to elastic. Count and statistics are cached, so subsequent calls
+        to get_count() and get_statistics() do not query elastic again.
+
+        @param aggregations: sequence of category lists, as accepted by get_aggregate
+        @return: list with an aggregation result per category list in aggregations
+        """
+        plan = AggregationPlan(es=self.es)
+        try:
+            query, filters = self.get_query(), self.get_filters()
+            count_key = plan.add_count(query, filters) if count else None
+            statistics_key = plan.add_statistics(query, filters) if statistics else None
+            keys = [plan.add_aggregate(self._get_aggregate_query(categories), filters, categories,
+                                       flat=flat, objects=objects)
+                    for categories in aggregations]
+            result = plan.execute()
+        except queryparser.QueryParseError:
+            self._check_queries()
+            raise
+
+        if count:
+            set_cache(self, "get_count", result[count_key])
+        if statistics:
+            set_cache(self, "get_statistics", result[statistics_key])
+        return [result[key] for key in keys]
+
     def get_nested_aggregate(self, categories):
         return to_nested(self.get_aggregate(categories))
 
-    def get_article_ids(self):
-        return ES().query_ids(self.get_query(), self.get_filters())
+    def get_article_ids(self) -> IdSet:
+        return IdSet(ES().query_ids_array(self.get_query(), self.get_filters()))
 
     def _get_article_ids_per_query(self):
         for q in self.get_queries():
-            yield q, list(ES().query_ids(q.query, self.get_filters()))
+            yield q, IdSet(ES().query_ids_array(q.query, self.get_filters()))
 
     def get_article_ids_per_query(self):
         return dict(self._get_article_ids_per_query())
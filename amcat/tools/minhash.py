@@ -0,0 +1,223 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Near-duplicate detection using MinHash and locality sensitive hashing (LSH).
+
+Every document is reduced to the set of its word shingles (sequences of SHINGLE_SIZE
+words). The MinHash signature of a document consists of the minimum of NUM_PERM random
+hash functions over its shingles; the fraction of equal signature values of two documents
+estimates the Jaccard similarity of their shingle sets. Only 16 bits of each value
+are kept, so a signature takes 2 * NUM_PERM bytes, and signatures of all documents
+are kept in one numpy array.
+
+To avoid comparing all pairs of documents, signatures are split into bands of
+ROWS_PER_BAND values. Documents with an identical band are candidates, and are compared
+with the full signature. Candidate pairs are found by sorting the band values, one band
+at a time, so memory use is linear in the number of documents:
+
+    >>> index = NearDuplicateIndex()
+    >>> index.add([1, 2, 3], [text, text + " (ANP)", other_text])
+    >>> index.get_representatives(threshold=0.8)
+    array([1, 1, 3])
+"""
+import logging
+import re
+import zlib
+from typing import Iterable, Sequence
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+NUM_PERM = 64
+ROWS_PER_BAND = 4  # 4 x 16 bits, so the values of a band can be viewed as a single uint64
+SHINGLE_SIZE = 4
+
+# Random (multiply-shift) hash functions h(x) = (a * x + b) mod 2^64 on 32 bit shingle hashes.
+# Bits 32-47 of the minima are used as signature values.
+_random = numpy.random.RandomState(42)
+_A = _random.randint(0, 2 ** 63, size=NUM_PERM, dtype=numpy.uint64) | numpy.uint64(1)
+_B = _random.randint(0, 2 ** 63, size=NUM_PERM, dtype=numpy.uint64)
+_SHIFT = numpy.uint64(32)
+
+# Multiplier used to combine the hashes of the words in a shingle
+_SHINGLE_MULTIPLIER = numpy.uint64(1000003)
+
+# Number of candidate pairs compared at once
+COMPARE_BATCH_SIZE = 1000000
+
+_WORD = re.compile(r"\w+")
+
+
+def get_shingles(text: str, shingle_size: int=SHINGLE_SIZE) -> numpy.ndarray:
+    """
+    Hash all (lowercased) word shingles of the text to 32 bit values. Texts shorter than
+    shingle_size words yield a single shingle of all words.
+
+    @return: a uint64 array of shingle hashes (which may contain duplicates)
+    """
+    words = _WORD.findall(text.lower())
+    if not words:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    hashes = numpy.fromiter((zlib.crc32(w.encode("utf-8")) for w in words), dtype=numpy.uint64, count=len(words))
+    n = max(1, len(words) - shingle_size + 1)
+    shingles = hashes[:n].copy()
+    for i in range(1, min(shingle_size, len(words))):
+        shingles *= _SHINGLE_MULTIPLIER
+        shingles += hashes[i:i + n]
+    return shingles & numpy.uint64(0xFFFFFFFF)
+
+
+def get_signatures(texts: Iterable[str], shingle_size: int=SHINGLE_SIZE) -> numpy.ndarray:
+    """
+    Compute MinHash signatures of the given texts. The hash functions are applied to the
+    shingles of all texts at once, and the minimum per text is taken with reduceat.
+
+    @return: an array of shape (len(texts), NUM_PERM) of uint16 signature values. Texts
+             without any words get a signature of zeros.
+    """
+    shingles = [get_shingles(text or "", shingle_size) for text in texts]
+    signatures = numpy.zeros((len(shingles), NUM_PERM), dtype=numpy.uint16)
+    nonempty = numpy.array([len(s) > 0 for s in shingles], dtype=bool)
+    if not nonempty.any():
+        return signatures
+
+    lengths = [len(s) for s in shingles if len(s)]
+    offsets = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+    values = numpy.concatenate([s for s in shingles if len(s)])
+    minima = numpy.empty((len(lengths), NUM_PERM), dtype=numpy.uint64)
+    with numpy.errstate(over="ignore"):
+        for i in range(NUM_PERM):
+            minima[:, i] = numpy.minimum.reduceat(_A[i] * values + _B[i], offsets)
+    # The highest bits of a minimum are mostly zero, so use bits that are uniformly distributed
+    signatures[nonempty] = (minima >> _SHIFT) & numpy.uint64(0xFFFF)
+    return signatures
+
+
+class _UnionFind:
+    """Disjoint sets of indices, with the lowest index of every set as its root"""
+
+    def __init__(self, n):
+        self.parent = numpy.arange(n, dtype=numpy.int64)
+
+    def find(self, i):
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i < j:
+            self.parent[j] = i
+        elif j < i:
+            self.parent[i] = j
+
+    def get_roots(self) -> numpy.ndarray:
+        """Return the root of every index, by following parents (pointer jumping) until all are roots"""
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if numpy.array_equal(grandparent, parent):
+                return parent
+            parent = grandparent
+
+
+class NearDuplicateIndex:
+    """
+    Collects MinHash signatures of documents (see get_signatures), and groups documents
+    whose estimated similarity is at least a threshold. Documents can be added in chunks,
+    the texts themselves are not kept.
+    """
+
+    def __init__(self, capacity: int=1024, shingle_size: int=SHINGLE_SIZE):
+        """
+        @param capacity: expected number of documents, the arrays are grown when needed
+        """
+        self.shingle_size = shingle_size
+        self.ids = numpy.zeros(capacity, dtype=numpy.int64)
+        self.signatures = numpy.zeros((capacity, NUM_PERM), dtype=numpy.uint16)
+        self.empty = numpy.zeros(capacity, dtype=bool)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, capacity):
+        self.ids = numpy.resize(self.ids, capacity)
+        self.signatures = numpy.resize(self.signatures, (capacity, NUM_PERM))
+        self.empty = numpy.resize(self.empty, capacity)
+
+    def add(self, ids: Sequence[int], texts: Sequence[str]):
+        """Add documents with the given ids and texts"""
+        self.add_signatures(ids, get_signatures(texts, self.shingle_size))
+
+    def add_signatures(self, ids: Sequence[int], signatures: numpy.ndarray):
+        """Add documents with the given ids and (previously computed) signatures"""
+        n = len(ids)
+        if self.n + n > len(self.ids):
+            self._grow(max(self.n + n, 2 * len(self.ids)))
+
+        self.ids[self.n:self.n + n] = ids
+        self.signatures[self.n:self.n + n] = signatures
+        self.empty[self.n:self.n + n] = ~signatures.any(axis=1)
+        self.n += n
+
+    def _get_candidates(self, band: int, order: numpy.ndarray):
+        """Yield (document, first document with the same band) pairs of indices into order"""
+        columns = slice(band * ROWS_PER_BAND, (band + 1) * ROWS_PER_BAND)
+        keys = numpy.ascontiguousarray(self.signatures[order, columns]).view(numpy.uint64).ravel()
+        by_key = numpy.argsort(keys, kind="stable")
+        keys = keys[by_key]
+
+        starts = numpy.flatnonzero(numpy.concatenate([[True], keys[1:] != keys[:-1]]))
+        sizes = numpy.diff(numpy.concatenate([starts, [len(keys)]]))
+        firsts = numpy.repeat(by_key[starts], sizes)
+        duplicate = firsts != by_key
+        return order[by_key[duplicate]], order[firsts[duplicate]]
+
+    def get_representatives(self, threshold: float=0.9) -> numpy.ndarray:
+        """
+        Group all documents with an estimated similarity of at least threshold to another
+        document in the group.
+
+        @return: an array with for every document (in the order they were added) the lowest id
+                 of its group. Documents without words are never considered duplicates.
+        """
+        # Sort documents by id, so the root (lowest index) of a group has the lowest id
+        by_id = numpy.argsort(self.ids[:self.n], kind="stable")
+        order = by_id[~self.empty[:self.n][by_id]]
+        rank = numpy.empty(self.n, dtype=numpy.int64)
+        rank[by_id] = numpy.arange(self.n)
+
+        groups = _UnionFind(self.n)
+        for band in range(NUM_PERM // ROWS_PER_BAND):
+            docs, firsts = self._get_candidates(band, order)
+            for i in range(0, len(docs), COMPARE_BATCH_SIZE):
+                a, b = docs[i:i + COMPARE_BATCH_SIZE], firsts[i:i + COMPARE_BATCH_SIZE]
+                similarity = (self.signatures[a] == self.signatures[b]).mean(axis=1)
+                for x, y in zip(rank[a[similarity >= threshold]].tolist(), rank[b[similarity >= threshold]].tolist()):
+                    groups.union(x, y)
+            log.debug("Compared candidates of band {band}, {n} candidates".format(n=len(docs), **locals()))
+
+        return self.ids[by_id[groups.get_roots()]][rank]
@@ -20,9 +20,9 @@ import datetime
 
 from amcat.models import ArticleSet
 from amcat.tools import amcattest
-from amcat.tools.aggregate_es.aggregate import aggregate
+from amcat.tools.aggregate_es.aggregate import aggregate, AggregationPlan, AggregationResult
 from amcat.tools.aggregate_es.categories import ArticlesetCategory, IntervalCategory, \
-    TermCategory, FieldCategory
+    TermCategory, FieldCategory, IntegerFieldCategory
 from amcat.tools.amcates import ES
 from amcat.tools.keywordsearch import SearchQuery
 
@@ -177,3 +177,50 @@ class TestAggregateES(amcattest.AmCATTestCase):
             ("aap", 2),
             ("noot", 2)
         })
+
+    @amcattest.use_elastic
+    def test_aggregation_plan(self):
+        self.set_up()
+
+        filters = {"sets": [self.aset1.id, self.aset2.id]}
+        term1 = SearchQuery("aap")
+        term2 = SearchQuery("lamp")
+
+        plan = AggregationPlan()
+        count = plan.add_count("aap", filters)
+        statistics = plan.add_statistics("aap", filters)
+        aggr1 = plan.add_aggregate("aap", filters, [IntervalCategory("day", fill_zeros=False)], objects=False)
+        aggr2 = plan.add_aggregate(None, filters, [TermCategory([term1, term2])])
+        total = plan.add_count(None, filters)
+        result = plan.execute()
+
+        self.assertEqual(result[count], 2)
+        self.assertEqual(result[total], 3)
+        self.assertEqual(result[statistics].n, 2)
+        self.assertEqual(result[statistics].start_date, datetime.datetime(2010, 1, 1))
+        self.assertEqual(set(result[aggr1]), {(datetime.datetime(2010, 1, 1), 2)})
+        self.assertEqual(set(result[aggr2]), {(term1, 2), (term2, 1)})
+
+        # Results are identical to those of separate requests
+        self.assertEqual(result[count], ES().count("aap", filters))
+        self.assertEqual(result[aggr1], aggregate("aap", filters, [IntervalCategory("day", fill_zeros=False)], objects=False))
+
+    def test_aggregation_result(self):
+        cat1, cat2 = IntegerFieldCategory("a_int"), IntegerFieldCategory("b_int")
+        raw = {"a_int": {"buckets": [
+            {"key": 1, "doc_count": 3, "b_int": {"buckets": [{"key": 10, "doc_count": 3}]}},
+            {"key": 2, "doc_count": 4, "b_int": {"buckets": [{"key": 20, "doc_count": 4}]}},
+        ]}}
+
+        result = AggregationResult.from_aggregation(raw, [cat1, cat2])
+        self.assertEqual(result.values, [[1, 2], [10, 20]])
+        self.assertEqual(result.to_tuples(), [(1, 10, 3), (2, 20, 4)])
+        self.assertEqual(result.to_tuples(flat=False), [((1, 10), (3,)), ((2, 20), (4,))])
+        self.assertEqual(result.to_dense().tolist(), [[3, 0], [0, 4]])
+
+        dense = result.fill_zeros()
+        self.assertEqual(len(dense), 4)
+        self.assertEqual(dense.to_tuples(), [(1, 10, 3), (1, 20, 0), (2, 10, 0), (2, 20, 4)])
+
+        empty = AggregationResult.from_aggregation({"a_int": {"buckets": []}}, [cat1])
+        self.assertEqual(empty.fill_zeros().to_tuples(), [])
@@ -19,9 +19,11 @@
 import datetime
 import shutil
 import unittest
+from unittest.mock import patch
 
 from amcat.tools.aggregate_orm.categories import ArticleFieldCategory, GroupedCodebookFieldCategory
 from amcat.tools.table.table2spss import get_pspp_version, PSPPVersion
+from django.db import connection
 from django.test import TransactionTestCase
 
 from amcat.models import Coding
@@ -29,6 +31,7 @@ from amcat.tools import amcattest, aggregate_orm
 from amcat.tools.aggregate_orm import CountArticlesValue, TermCategory, ArticleSetCategory, \
     IntervalCategory
 from amcat.tools.aggregate_orm import SchemafieldCategory, AverageValue
+from amcat.tools.aggregate_orm.sqlobj import CopyStatement, ParametrizedStatement, execute_statement
 from amcat.tools.sbd import get_or_create_sentences
 
 
@@ -114,8 +117,8 @@ class TestAggregateORM(TransactionTestCase):
         self.sentence_coding.update_values({self.scodef: self.scode_A1b.id, self.sintf: 1})
 
         # Try to confuse aggregator by inserting multiple codingjobs
-        job = amcattest.create_test_job(articleset=self.s1, articleschema=self.schema)
-        c4 = amcattest.create_test_coding(codingjob=job, article=self.a[2])
+        self.job2 = amcattest.create_test_job(articleset=self.s1, articleschema=self.schema)
+        c4 = amcattest.create_test_coding(codingjob=self.job2, article=self.a[2])
         c4.update_values({self.codef: self.code_B.id, self.intf: 10, self.qualf: 8})
 
     def _get_aggr(self, **kwargs):
@@ -383,6 +386,47 @@ class TestAggregateORM(TransactionTestCase):
         result = {(c, ct) for (c, (ct, _)) in result}
         self.assertEqual(result, {(self.code_A, 2), (self.code_B, 1), (self.code_A1, 1)})
 
+    def test_codings_queryset(self):
+        """Is the (parametrized) query of the codings filtered on in the codings_queryset table?"""
+        for job, expected in [(self.job, {(self.code_A, 3.0), (self.code_B, 1.0), (self.code_A1, 1.0)}),
+                              (self.job2, {(self.code_B, 10.0)})]:
+            codings = Coding.objects.filter(coded_article__codingjob=job, sentence__isnull=True)
+            aggr = aggregate_orm.ORMAggregate(codings, flat=True, threaded=False)
+            result = set(aggr.get_aggregate([SchemafieldCategory(self.codef)], [AverageValue(self.intf)]))
+            self.assertEqual({(c, av) for (c, (av, _)) in result}, expected)
+
+    def test_server_side_cursor(self):
+        """Do aggregations give the same results with and without server side cursors?"""
+        aggr = self._get_aggr(flat=True)
+        categories, values = [SchemafieldCategory(self.codef)], [CountArticlesValue(), AverageValue(self.intf)]
+        result = set(aggr.get_aggregate(categories, values))
+        with patch.dict(connection.settings_dict, DISABLE_SERVER_SIDE_CURSORS=True):
+            self.assertEqual(set(aggr.get_aggregate(categories, values)), result)
+        self.assertEqual(len(result), 3)
+
+    def test_statements(self):
+        """Are ParametrizedStatement and CopyStatement executed, and can tables be filled with COPY?"""
+        with connection.cursor() as c:
+            execute_statement(c, "CREATE TEMPORARY TABLE t_test_copy (article_id int, term int)")
+            execute_statement(c, CopyStatement("t_test_copy", ("article_id", "term"), iter([(1, 0), (2, 0), (2, 1)])))
+            execute_statement(c, CopyStatement("t_test_copy", ("article_id", "term"), []))
+            execute_statement(c, ParametrizedStatement("SELECT article_id FROM t_test_copy WHERE term = %s", [1]))
+            self.assertEqual(c.fetchall(), [(2,)])
+            execute_statement(c, "SELECT article_id, term FROM t_test_copy ORDER BY article_id, term")
+            self.assertEqual(c.fetchall(), [(1, 0), (2, 0), (2, 1)])
+            execute_statement(c, "DROP TABLE t_test_copy")
+
+    def test_term_category_codings_filter(self):
+        """Are terms (filled with COPY) combined with the codingjob filter of the codings?"""
+        terms = {"a": self.ids[:3], "b": self.ids[2:]}
+        aggr = aggregate_orm.ORMAggregate.from_articles(self.ids, [self.job2.id], flat=True, threaded=False,
+                                                        terms=terms)
+        result = set(aggr.get_aggregate([TermCategory()], [CountArticlesValue()]))
+        self.assertEqual(result, {("a", (1, (self.ids[2],))), ("b", (1, (self.ids[2],)))})
+
+        result = set(aggr.get_aggregate([TermCategory(), SchemafieldCategory(self.codef)], [AverageValue(self.intf)]))
+        self.assertEqual({(c, av) for (c, (av, _)) in result}, {(("a", self.code_B), 10.0), (("b", self.code_B), 10.0)})
+
     def test_no_codings(self):
         aggr = aggregate_orm.ORMAggregate(Coding.objects.none(), threaded=False)
         self.assertEqual(set(aggr.get_aggregate(values=[CountArticlesValue()])), set())
@@ -18,15 +18,17 @@
 ###########################################################################
 
 import datetime
+from unittest.mock import patch
 
 import iso8601
 from django.conf import settings
 
 from amcat.models import Article
-from amcat.tools import amcattest
-from amcat.tools.amcates import ES, get_article_dict, ALL_FIELDS, get_property_primitive_type
+from amcat.tools import amcattest, amcates_cache, amcates_client
+from amcat.tools.amcates import ES, _ES, ElasticSearchError, get_article_dict, ALL_FIELDS, get_property_primitive_type, _hash_dict
 from amcat.tools.amcattest import create_test_project
 from amcat.tools.keywordsearch import SearchQuery
+from amcat.tools.progress import ProgressMonitor
 
 class TestAmcatES(amcattest.AmCATTestCase):
     def setup(self):
@@ -77,8 +79,96 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual(all_ids - {e.id}, set(ES().query_ids(body=missing_query)))
 
         # Purge orphans, query again
-        ES().purge_orphans()
+        monitor = ProgressMonitor(total=1)
+        self.assertEqual(ES().purge_orphans(monitor=monitor), 4)
+        self.assertEqual(monitor.progress, 1)
         ES().refresh()
+        self.assertEqual({e.id}, set(ES().query_ids()))
+
+    @amcattest.use_elastic
+    def test_remove_from_set(self):
+        s1, s2, a, b, c, d, e = self.setup()
+        ES().remove_from_set(s1.id, [a.id, b.id, e.id], batch_size=2)
+        ES().refresh()
+        self.assertEqual(set(ES().query_ids(filters={"sets": s1.id})), {c.id, d.id})
+        self.assertEqual(set(ES().query_ids(filters={"sets": s2.id})), {e.id})
+
+        # Remove all articles of a set in a single task
+        monitor = ProgressMonitor(total=1)
+        ES().remove_from_set(s1.id, monitor=monitor)
+        ES().refresh()
+        self.assertEqual(monitor.progress, 1)
+        self.assertEqual(set(ES().query_ids(filters={"sets": s1.id})), set())
+        self.assertEqual(set(ES().query_ids()), {a.id, b.id, c.id, d.id, e.id})
+
+    @amcattest.use_elastic
+    def test_remove_unrefreshed(self):
+        # Articles are removed from the index even if they were added after the last refresh
+        with self.settings(ES_WAIT_FOR_VISIBILITY=False):
+            s = amcattest.create_test_set()
+            a, b = [amcattest.create_test_article(articleset=s) for _ in range(2)]
+            s.remove_articles([a])
+            c = amcattest.create_test_article()
+            s.add_articles([c])
+            s.remove_articles([c])
+            s2 = amcattest.create_test_set()
+            s2.add_articles([a, b])
+            ES().remove_from_set(s2.id)
+        ES().refresh()
+        self.assertEqual(set(ES().query_ids(filters={"sets": s.id})), {b.id})
+        self.assertEqual(set(ES().query_ids(filters={"sets": s2.id})), set())
+
+    @amcattest.use_elastic
+    def test_query_ids_array(self):
+        s1, s2, a, b, c, d, e = self.setup()
+        ids = {a.id, b.id, c.id, d.id}
+        self.assertEqual(sorted(ES().query_ids_array(filters={"sets": s1.id}, slices=1)), sorted(ids))
+        self.assertEqual(sorted(ES().query_ids_array(filters={"sets": s1.id}, slices=2)), sorted(ids))
+        self.assertEqual(sorted(ES().query_ids_array(query="aap", slices=3)), sorted({a.id, e.id}))
+
+        # By default a single scroll is used, with slices=None only for selections of at least the minimum size
+        with patch.object(_ES, "_query_ids_slice", autospec=True, side_effect=_ES._query_ids_slice) as query_slice:
+            with self.settings(ES_SCROLL_SLICES=2, ES_SCROLL_SLICES_MIN_HITS=4):
+                self.assertEqual(sorted(ES().query_ids_array(filters={"sets": s1.id})), sorted(ids))
+                self.assertEqual(query_slice.call_count, 1)
+                self.assertEqual(list(ES().query_ids_array(filters={"sets": s2.id}, slices=None)), [e.id])
+                self.assertEqual(query_slice.call_count, 2)
+                self.assertEqual(sorted(ES().query_ids_array(filters={"sets": s1.id}, slices=None)), sorted(ids))
+                self.assertEqual(query_slice.call_count, 4)
+
+    @amcattest.use_elastic
+    def test_add_to_set(self):
+        s1, s2, a, b, c, d, e = self.setup()
+        s3 = amcattest.create_test_set()
+
+        # Articles already in the set are skipped, other batches are added with update_by_query
+        ES().add_to_set(s3.id, [a.id, b.id], batch_size=2)
+        ES().refresh()
+        ES().add_to_set(s3.id, [a.id, b.id, c.id, d.id, e.id], batch_size=2)
+        ES().refresh()
+        self.assertEqual(set(ES().query_ids(filters={"sets": s3.id})), {a.id, b.id, c.id, d.id, e.id})
+        self.assertEqual(set(ES().query_ids(filters={"sets": s1.id})), {a.id, b.id, c.id, d.id})
+
+        # Articles that are not in the index are indexed
+        f = amcattest.create_test_article()
+        ES().es.delete(index=ES().index, doc_type=settings.ES_ARTICLE_DOCTYPE, id=f.id)
+        ES().refresh()
+        s3.add_articles([f], wait_for_visibility=True)
+        self.assertIn(f.id, set(ES().query_ids(filters={"sets": s3.id})))
+
+    @amcattest.use_elastic
+    def test_client(self):
+        es = ES()
+        self.assertIs(es.es, amcates_client.get_client(es.host, es.port))
+        self.assertIs(es.es, ES(index="other_index").es)
+
+        es.es.ping()
+        stats = {s["host"]: s for s in amcates_client.get_stats()}
+        self.assertIn("http://{}:{}".format(es.host, es.port), stats)
+        node = stats["http://{}:{}".format(es.host, es.port)]
+        self.assertGreater(node["requests"], 0)
+        self.assertGreater(node["latency"], 0)
+        self.assertEqual(node["pool_size"], settings.ES_POOL_SIZE)
 
     @amcattest.use_elastic
     def test_aggregate(self):
@@ -141,6 +231,21 @@ class TestAmcatES(amcattest.AmCATTestCase):
         r = ES().query_all(filters=dict(sets=s.id), size=10)
         self.assertEqual(len(list(r)), len(arts))
 
+    @amcattest.use_elastic
+    def test_parallel_bulk_insert(self):
+        """Test that parallel_bulk_insert indexes all documents in byte-sized chunks"""
+        project = create_test_project()
+        arts = [amcattest.create_test_article(create=False, project=project, properties={"p1_int": i}) for i in range(20)]
+        Article.create_articles(arts, add_to_index=False)
+        dicts = [get_article_dict(a, sets=[]) for a in arts]
+
+        errors = ES().parallel_bulk_insert(iter(dicts), concurrency=2, max_chunk_bytes=1024)
+        ES().refresh()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(set(ES().query_ids(filters={"ids": [a.id for a in arts]})), {a.id for a in arts})
+        self.assertIn("p1_int", ES().get_mapping())
+
     @amcattest.use_elastic
     def test_highlight_article(self):
         s1, s2, a, b, c, d, e = self.setup()
@@ -262,6 +367,53 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual(set(solr_ids), {a.id for a in arts[1:-1]})
 
 
+    @amcattest.use_elastic
+    def test_refresh_index_journal(self):
+        """Is only the change journal replayed, unless verifying?"""
+        from amcat.models import ArticleSetArticle, ArticleSetChange
+        s = amcattest.create_test_set()
+        a, b, c = [amcattest.create_test_article() for _ in range(3)]
+
+        s.add_articles([a.id, b.id], add_to_index=False)
+        s.remove_articles([b.id], remove_from_index=False)
+        self.assertEqual(ArticleSetChange.objects.filter(articleset=s).count(), 3)
+        s.refresh_index()
+        self.assertEqual({a.id}, set(ES().query_ids(filters=dict(sets=s.id))))
+        self.assertFalse(ArticleSetChange.objects.filter(articleset=s).exists())
+        self.assertGreater(s.index_watermark, 0)
+
+        # Changes bypassing the journal are only found by verifying
+        ArticleSetArticle.objects.create(articleset=s, article=c)
+        s.refresh_index()
+        self.assertEqual({a.id}, set(ES().query_ids(filters=dict(sets=s.id))))
+        s.refresh_index(verify=True)
+        self.assertEqual({a.id, c.id}, set(ES().query_ids(filters=dict(sets=s.id))))
+
+    @amcattest.use_elastic
+    def test_journal_applied_changes(self):
+        """Are only changes not applied to the index journaled?"""
+        from amcat.models import ArticleSetChange
+        s = amcattest.create_test_set(2)
+        a, b = s.articles.all()
+        s.remove_articles([a.id], remove_from_index=False)
+        self.assertEqual(ArticleSetChange.objects.filter(articleset=s).count(), 1)
+
+        # Applying a change directly supersedes the journaled change
+        s.remove_articles([a.id])
+        s.remove_articles([b.id])
+        self.assertFalse(ArticleSetChange.objects.filter(articleset=s).exists())
+
+        # Applied changes are not journaled while the index is being rebuilt, but recorded for the rebuild
+        with amcates_cache.rebuilding():
+            s.add_articles([a.id])
+            self.assertFalse(ArticleSetChange.objects.filter(articleset=s).exists())
+            self.assertEqual(set(amcates_cache.get_rebuild_changes()), {a.id})
+        self.assertEqual(set(amcates_cache.get_rebuild_changes()), set())
+        s.remove_articles([b.id])
+        self.assertEqual(set(amcates_cache.get_rebuild_changes()), set())
+        s.refresh_index()
+        self.assertEqual({a.id}, set(ES().query_ids(filters=dict(sets=s.id))))
+
     @amcattest.use_elastic
     def test_full_refresh(self):
         """test full refresh, e.g. document content change"""
@@ -401,6 +553,24 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual(hash, es_article.hash)
         self.assertEqual(hash, article.hash)
 
+    def test_article_dict_cache(self):
+        """Is the article dict (and hash) reused until the article changes?"""
+        article = Article(title="title", text="a, b and \\c", date=datetime.datetime(2015, 1, 1), url=None,
+                          project=create_test_project())
+        article.properties["tags_tag"] = {"a", "b"}
+        d = get_article_dict(article)
+        self.assertEqual(d["hash"], _hash_dict({k: v for k, v in d.items() if k not in ("hash", "id", "sets")}))
+
+        with patch("amcat.tools.amcates._hash_dict") as hash_dict:
+            self.assertEqual(get_article_dict(article, sets=[1]), dict(d, sets=[1]))
+            self.assertFalse(hash_dict.called)
+
+        article.text = "changed"
+        self.assertNotEqual(get_article_dict(article)["hash"], d["hash"])
+        article.text = "a, b and \\c"
+        article.properties["tags_tag"].add("c")
+        self.assertNotEqual(get_article_dict(article)["hash"], d["hash"])
+
     @amcattest.use_elastic
     def test_properties(self):
         """Are properties stored as flat fields and with correct mapping?"""
@@ -451,7 +621,48 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual(set(ES().get_used_properties([s1.id])), {"p1", "p2_date"})
         self.assertEqual(set(ES().get_used_properties([s1.id, s2.id])), {"p1", "p2_date", "p3_num"})
         self.assertEqual(set(ES().get_used_properties([s3.id])), {"p1", "p2_date", "p4"})
-        
+
+    @amcattest.use_elastic
+    def test_property_counts_realtime(self):
+        """Are changes that are not refreshed yet taken into account when updating property counters?"""
+        s = amcattest.create_test_set()
+        a = amcattest.create_test_article(articleset=s, properties={"aap": "noot"})
+        ES().refresh()
+        amcates_cache.set_property_counts(s.id, {"aap": 1})
+
+        d = dict(get_article_dict(a, sets=[s.id]))
+        del d["aap"]
+        d["jan"] = "mies"
+        with self.settings(ES_WAIT_FOR_VISIBILITY=False):
+            # The second update must subtract the (unrefreshed) first update rather than the original
+            ES().bulk_insert([d])
+            ES().bulk_insert([d])
+        self.assertEqual(amcates_cache.get_property_counts(s.id), {"aap": 0, "jan": 1})
+
+        # New articles are not looked up
+        b = amcattest.create_test_article(create=False, properties={"aap": "noot"})
+        with patch.object(_ES, "_get_indexed_properties") as count:
+            Article.create_articles([b], articleset=s)
+        count.assert_not_called()
+        self.assertEqual(amcates_cache.get_property_counts(s.id), {"aap": 1, "jan": 1})
+
+    @amcattest.use_elastic
+    def test_property_counts_errors(self):
+        """Are articles that could not be indexed left out of the property counters?"""
+        s = amcattest.create_test_set()
+        amcates_cache.set_property_counts(s.id, {})
+        a, b = [amcattest.create_test_article(create=False, properties={"aap": "noot"}) for _i in range(2)]
+        Article.create_articles([a, b], add_to_index=False)
+        good = dict(get_article_dict(a, sets=[s.id]))
+        bad = dict(get_article_dict(b, sets=[s.id]), errortest_int="not a number")
+
+        errors = ES().parallel_bulk_insert([good, bad])
+        self.assertEqual([e.id for e in errors], [b.id])
+        self.assertEqual(amcates_cache.get_property_counts(s.id), {"aap": 1})
+
+        self.assertRaises(ElasticSearchError, ES().bulk_insert, [bad])
+        self.assertEqual(amcates_cache.get_property_counts(s.id), {"aap": 1})
+
     def test_date(self):
         # Test iso8601 parsing, database parsing, etc.
         iso8601_date_string = '1992-12-31T23:59:00'
@@ -0,0 +1,114 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import time
+from unittest.mock import patch
+
+from amcat.models import Article
+from amcat.tools import amcattest, amcates_cache
+from amcat.tools.amcates import ES, build_body
+
+
+class TestAmcatesCache(amcattest.AmCATTestCase):
+    def test_get_required_sets(self):
+        body = lambda query=None, **filters: {"query": {"constant_score": dict(build_body(query, filters, True))}}
+        self.assertEqual(amcates_cache.get_required_sets(body(sets=[1, 2])), {1, 2})
+        self.assertEqual(amcates_cache.get_required_sets(body("test", sets=3, start_date="2010-01-01")), {3})
+        self.assertIsNone(amcates_cache.get_required_sets(body("test")))
+        self.assertIsNone(amcates_cache.get_required_sets({}))
+
+        # Sets that are not required do not restrict the results
+        self.assertIsNone(amcates_cache.get_required_sets(
+            {"query": {"bool": {"must_not": [{"terms": {"sets": [1]}}]}}}))
+        self.assertIsNone(amcates_cache.get_required_sets(
+            {"query": {"bool": {"should": [{"terms": {"sets": [1]}}, {"match_all": {}}]}}}))
+
+    def test_get_cache_key(self):
+        body = {"query": {"terms": {"sets": [1]}}}
+        key = amcates_cache.get_cache_key("index", "count", body)
+        self.assertEqual(key, amcates_cache.get_cache_key("index", "count", {"query": {"terms": {"sets": [1]}}}))
+        self.assertNotEqual(key, amcates_cache.get_cache_key("index", "search", body))
+        self.assertIsNone(amcates_cache.get_cache_key("index", "count", {"query": {"match_all": {}}}))
+
+        amcates_cache.bump_generation(1)
+        self.assertNotEqual(key, amcates_cache.get_cache_key("index", "count", body))
+
+    @amcattest.use_elastic
+    def test_invalidation(self):
+        aset = amcattest.create_test_set(2)
+        self.assertEqual(ES().count(filters={"sets": aset.id}), 2)
+
+        # A cached result is only valid until the set is changed
+        a = amcattest.create_test_article()
+        aset.add_articles([a])
+        self.assertEqual(ES().count(filters={"sets": aset.id}), 3)
+        aset.remove_articles([a])
+        self.assertEqual(ES().count(filters={"sets": aset.id}), 2)
+        self.assertEqual(ES().statistics(filters={"sets": aset.id}).n, 2)
+
+    @amcattest.use_elastic
+    def test_invalidation_bulk_insert(self):
+        aset = amcattest.create_test_set(2)
+        self.assertEqual(ES().count(filters={"sets": aset.id}), 2)
+
+        # Uploaded articles are indexed with their sets, which invalidates results on these sets
+        articles = [amcattest.create_test_article(create=False, project=aset.project) for _ in range(2)]
+        Article.create_articles(articles, articleset=aset)
+        self.assertEqual(ES().count(filters={"sets": aset.id}), 4)
+
+        # As does (re)indexing articles that were added to the set in the database only
+        a = amcattest.create_test_article()
+        aset.add_articles([a], add_to_index=False)
+        self.assertEqual(ES().count(filters={"sets": aset.id}), 4)
+        ES().add_articles([a.id])
+        self.assertEqual(ES().count(filters={"sets": aset.id}), 5)
+
+    def test_pending(self):
+        body = {"query": {"terms": {"sets": [1]}}}
+        key = amcates_cache.get_cache_key("index", "count", body)
+
+        # Results are not cached while changes might not be visible yet
+        with self.settings(ES_REFRESH_INTERVAL=0.05):
+            amcates_cache.bump_generation(1, visible=False)
+            self.assertIsNone(amcates_cache.get_cache_key("index", "count", body))
+            time.sleep(0.2)
+            new_key = amcates_cache.get_cache_key("index", "count", body)
+            self.assertIsNotNone(new_key)
+            self.assertNotEqual(key, new_key)
+
+    @amcattest.use_elastic
+    def test_wait_for_visibility(self):
+        aset = amcattest.create_test_set()
+        a = amcattest.create_test_article()
+        with self.settings(ES_WAIT_FOR_VISIBILITY=False):
+            aset.add_articles([a], wait_for_visibility=True)
+        self.assertEqual(ES().count(filters={"sets": aset.id}), 1)
+
+    def test_rebuilding(self):
+        # The mark expires unless it is renewed, so a killed rebuild does not leave it behind
+        with patch.object(amcates_cache, "REBUILDING_TIMEOUT", 0.3):
+            with amcates_cache.rebuilding():
+                self.assertTrue(amcates_cache.is_rebuilding())
+                time.sleep(0.5)
+                self.assertTrue(amcates_cache.is_rebuilding())
+            self.assertFalse(amcates_cache.is_rebuilding())
+
+            amcates_cache.set_rebuilding(True)
+            self.assertTrue(amcates_cache.is_rebuilding())
+            time.sleep(0.5)
+            self.assertFalse(amcates_cache.is_rebuilding())
@@ -146,6 +146,20 @@ class TestAmcatesQuerySet(amcattest.AmCATTestCase):
             {self.a1.id, self.a2.id}
         )
 
+    @amcattest.use_elastic
+    def test_slicing(self):
+        self.set_up()
+        qs = self.qs.order_by("date")
+
+        self.assertEqual(2, len(qs))
+        self.assertEqual(1, len(qs[1:]))
+        self.assertEqual(0, len(qs[2:]))
+        self.assertEqual([self.a2.id], [a.id for a in qs[:1]])
+        self.assertEqual([self.a1.id], [a.id for a in qs[1:2]])
+        self.assertEqual([self.a2.id], [a.id for a in qs[::2]])
+        self.assertEqual(self.a1.id, qs[1].id)
+        self.assertRaises(IndexError, qs.__getitem__, 2)
+
     @amcattest.use_elastic
     def test_only(self):
         self.set_up()
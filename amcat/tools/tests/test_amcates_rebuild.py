@@ -0,0 +1,79 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+from amcat.tools import amcattest, amcates_cache, amcates_rebuild
+from amcat.tools.amcates import ES
+
+
+class TestAmcatesRebuild(amcattest.AmCATTestCase):
+    @amcattest.use_elastic
+    def test_rebuild(self):
+        s = amcattest.create_test_set(3)
+        ids = set(s.get_article_ids())
+        es = ES()
+
+        # The concrete index is replaced by an alias to a versioned index
+        index = amcates_rebuild.rebuild(shards=2, replicas=0)
+        self.assertEqual(es.get_aliased_indices(), [index])
+        self.assertEqual(set(es.query_ids(filters={"sets": s.id})), ids)
+        self.assertEqual(es.es.indices.get_settings(index=index)[index]["settings"]["index"]["number_of_shards"], "2")
+
+        # Rebuilding from the index swaps the alias and deletes the old index
+        new_index = amcates_rebuild.rebuild(replicas=0, source=amcates_rebuild.SOURCE_INDEX, slices=2)
+        self.assertNotEqual(index, new_index)
+        self.assertEqual(es.get_aliased_indices(), [new_index])
+        self.assertFalse(es.es.indices.exists(index))
+        self.assertEqual(set(es.query_ids(filters={"sets": s.id})), ids)
+
+        # Mappings are read and articles are indexed through the alias
+        self.assertIn("title", es.get_properties())
+        a = amcattest.create_test_article(articleset=s)
+        es.refresh()
+        self.assertEqual(set(es.query_ids(filters={"sets": s.id})), ids | {a.id})
+
+        # Changes are copied to the index through the alias
+        marker = amcates_rebuild._get_marker()
+        b = amcattest.create_test_article(articleset=s)
+        amcates_rebuild.catch_up(es, marker)
+        es.refresh()
+        self.assertEqual(set(es.query_ids(filters={"sets": s.id})), ids | {a.id, b.id})
+
+    @amcattest.use_elastic
+    def test_catch_up_synchronized(self):
+        """Are set changes copied if their journal is deleted while rebuilding?"""
+        s, s2 = amcattest.create_test_set(), amcattest.create_test_set()
+        a, b, c = [amcattest.create_test_article() for _i in range(3)]
+        s2.add_articles([b, c])
+        es = ES()
+        target = ES(index=amcates_rebuild.get_versioned_index_name(es.index))
+        target.create_index(shards=1, replicas=0)
+        try:
+            with amcates_cache.rebuilding():
+                marker = amcates_rebuild._get_marker()
+                # Synchronizing the set deletes the journaled change
+                s.add_articles([a, b], add_to_index=False)
+                s.refresh_index()
+                # Deleting a set deletes its journal, and its articles that are in no other set
+                s2.delete()
+                amcates_rebuild.catch_up(target, marker)
+            target.refresh()
+            self.assertEqual(set(target.query_ids(filters={"sets": s.id})), {a.id, b.id})
+            self.assertEqual(set(target.query_ids(filters={"sets": s2.id})), set())
+            self.assertEqual(set(target.query_ids()), {a.id, b.id})
+        finally:
+            target.delete_index()
@@ -0,0 +1,32 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import hashlib
+
+from amcat.tools import amcattest
+from amcat.tools.hashing import HashFilter
+
+
+class TestHashFilter(amcattest.AmCATTestCase):
+    def test_hash_filter(self):
+        digests = [hashlib.sha224(str(i).encode()).digest() for i in range(2000)]
+        f = HashFilter(1000, error_rate=0.01)
+        f.add(digests[:1000])
+        self.assertTrue(f.might_contain(digests[:1000]).all())
+        self.assertLess(f.might_contain(digests[1000:]).sum(), 50)
+        self.assertIn(digests[0].hex(), f)
@@ -0,0 +1,59 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import pickle
+from array import array
+
+from amcat.tools import amcattest
+from amcat.tools.idset import IdSet
+
+
+class TestIdSet(amcattest.AmCATTestCase):
+    def test_create(self):
+        self.assertEqual(list(IdSet([3, 1, 2, 1])), [1, 2, 3])
+        self.assertEqual(list(IdSet({3, 1})), [1, 3])
+        self.assertEqual(list(IdSet(array("l", [5, 4]))), [4, 5])
+        self.assertEqual(list(IdSet(i for i in (2, 1))), [1, 2])
+        self.assertEqual(len(IdSet()), 0)
+        self.assertFalse(IdSet())
+
+    def test_set_operations(self):
+        ids = IdSet([1, 2, 3])
+        self.assertEqual(ids | {4}, {1, 2, 3, 4})
+        self.assertEqual({4} | ids, {1, 2, 3, 4})
+        self.assertEqual(ids & IdSet([2, 3, 4]), {2, 3})
+        self.assertEqual(ids - {1}, {2, 3})
+        self.assertEqual({1, 5} - ids, {5})
+        self.assertEqual(ids ^ {3, 4}, {1, 2, 4})
+        self.assertEqual(ids.union([7], [8]), {1, 2, 3, 7, 8})
+        self.assertTrue(ids.isdisjoint({9}))
+        self.assertTrue(ids <= {1, 2, 3, 4})
+
+    def test_contains_eq(self):
+        ids = IdSet([1, 2, 3])
+        self.assertIn(2, ids)
+        self.assertNotIn(4, ids)
+        self.assertNotIn("2", ids)
+        self.assertEqual({1, 2, 3}, ids)
+        self.assertEqual(ids, IdSet([3, 2, 1]))
+        self.assertNotEqual(ids, {1, 2})
+        self.assertIsInstance(next(iter(ids)), int)
+
+    def test_pickle(self):
+        ids = IdSet([1, 2, 3])
+        self.assertEqual(pickle.loads(pickle.dumps(ids)), ids)
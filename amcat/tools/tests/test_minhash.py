@@ -0,0 +1,49 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import numpy
+
+from amcat.tools import amcattest
+from amcat.tools.minhash import get_shingles, get_signatures, NearDuplicateIndex, NUM_PERM
+
+TEXT = ("The minister announced on Tuesday that the new budget will include significant cuts to defence "
+        "spending and increases in education, according to a statement released by the ministry.")
+
+
+class TestMinHash(amcattest.AmCATTestCase):
+    def test_shingles(self):
+        self.assertEqual(len(get_shingles("one two three four five", shingle_size=4)), 2)
+        self.assertEqual(len(get_shingles("one two", shingle_size=4)), 1)
+        self.assertEqual(len(get_shingles("", shingle_size=4)), 0)
+        self.assertEqual(set(get_shingles("One, two!")), set(get_shingles("one two")))
+
+    def test_signatures(self):
+        signatures = get_signatures([TEXT, TEXT + " (ANP)", "Something else entirely", ""])
+        self.assertEqual(signatures.shape, (4, NUM_PERM))
+        self.assertEqual(signatures.dtype, numpy.uint16)
+        self.assertGreater((signatures[0] == signatures[1]).mean(), 0.8)
+        self.assertLess((signatures[0] == signatures[2]).mean(), 0.2)
+        self.assertFalse(signatures[3].any())
+
+    def test_index(self):
+        index = NearDuplicateIndex(capacity=1)
+        index.add([10, 5], [TEXT + " (ANP)", "Something else entirely"])
+        index.add([7, 3, 2], [TEXT, "", ""])
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.get_representatives(0.8).tolist(), [7, 5, 7, 3, 2])
+        self.assertEqual(index.get_representatives(1).tolist(), [10, 5, 7, 3, 2])
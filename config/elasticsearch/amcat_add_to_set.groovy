@@ -1 +0,0 @@
-s=ctx._source; if (s.sets) {if (!(set in s.sets)) s.sets += set} else {s.sets = [set]}
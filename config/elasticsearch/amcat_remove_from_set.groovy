@@ -1 +0,0 @@
-s=ctx._source; if (s.sets) {s.sets -= set}
@@ -51,6 +51,12 @@ if DEBUG:
     ]
     INTERNAL_IPS = ['127.0.0.1']
 
+# Keep an in-process filter of all article hashes, so most new articles skip the duplicate check in the database
+ARTICLE_HASH_FILTER = amcat_config["database"].getboolean("hash_filter", fallback=False)
+
+# Number of processes parsing the files of an upload, for upload plugins that support it
+UPLOAD_PARSE_WORKERS = int(amcat_config["base"].get("upload_parse_workers", 4))
+
 # Database
 DATABASE_OPTIONS = {
     "init_command": "set transaction isolation level read uncommitted"
@@ -41,6 +41,40 @@ if TESTING:
 
 ES_ARTICLE_DOCTYPE = 'article'
 
+# Number of concurrent requests and maximum request size used by parallel bulk indexing
+ES_BULK_CONCURRENCY = int(amcat_config["elasticsearch"].get("bulk_concurrency", 4))
+ES_BULK_MAX_BYTES = int(amcat_config["elasticsearch"].get("bulk_max_bytes", 10 * 1024 * 1024))
+ES_BULK_MAX_DOCS = int(amcat_config["elasticsearch"].get("bulk_max_docs", 5000))
+
+# Number of slices read in parallel when scrolling through all ids of large selections (see query_ids_array),
+# which are only used for selections of at least ES_SCROLL_SLICES_MIN_HITS articles
+ES_SCROLL_SLICES = int(amcat_config["elasticsearch"].get("scroll_slices", 4))
+ES_SCROLL_SLICES_MIN_HITS = int(amcat_config["elasticsearch"].get("scroll_slices_min_hits", 100000))
+
+# Maximum number of (keep-alive) connections to each elastic node per process
+ES_POOL_SIZE = int(amcat_config["elasticsearch"].get("pool_size", 10))
+
+# Discover other nodes of the cluster, and refresh the list of nodes every ES_SNIFF_INTERVAL seconds
+ES_SNIFF = amcat_config["elasticsearch"].getboolean("sniff", fallback=False)
+ES_SNIFF_INTERVAL = int(amcat_config["elasticsearch"].get("sniff_interval", 60))
+
+# Number of threads per process used for parallel elastic requests
+ES_EXECUTOR_WORKERS = int(amcat_config["elasticsearch"].get("executor_workers", 8))
+
+# Seconds to keep results of counts and aggregations in the shared result cache (0 disables it)
+ES_RESULT_CACHE_TIMEOUT = int(amcat_config["elasticsearch"].get("result_cache_timeout", 3600))
+
+# Seconds between the periodic refreshes of the index, which make changes visible to searches.
+# Unless ES_WAIT_FOR_VISIBILITY is set, changes to articlesets do not refresh the index explicitly,
+# but wait for the next periodic refresh. Tests expect changes to be visible immediately.
+ES_REFRESH_INTERVAL = float(amcat_config["elasticsearch"].get("refresh_interval", 1))
+ES_WAIT_FOR_VISIBILITY = amcat_config["elasticsearch"].getboolean("wait_for_visibility", fallback=TESTING)
+
+# Throttle server side update/delete by query tasks (documents per second, 0 for no throttling),
+# and the maximum number of seconds between polls of their progress
+ES_TASK_REQUESTS_PER_SECOND = float(amcat_config["elasticsearch"].get("task_requests_per_second", 0))
+ES_TASK_POLL_INTERVAL = float(amcat_config["elasticsearch"].get("task_poll_interval", 2))
+
 
 ES_MAPPING_TYPE_PRIMITIVES = {
     "int": int,